@@ -0,0 +1,11 @@
+"""Performance benchmarks for django-user-connections.
+
+Generates a synthetic power-law connection graph into a test database and
+reports the query count, wall time and peak memory of the manager methods,
+view mixins and form fields for users with different numbers of connections.
+
+Run from the repository root with the test settings::
+
+    PYTHONPATH=tests python -m benchmarks --edges 100000 --output run.json
+    PYTHONPATH=tests python -m benchmarks --edges 100000 --compare run.json
+"""
@@ -0,0 +1,143 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import sys
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmarks django-user-connections against a synthetic '
+                    'power-law connection graph generated into a test '
+                    'database.')
+    parser.add_argument('--edges', type=int, default=10000,
+                        help='The number of connections to generate. '
+                             'Default is 10000.')
+    parser.add_argument('--users', type=int, default=None,
+                        help='The number of users to generate. Defaults to a '
+                             'tenth of the number of connections.')
+    parser.add_argument('--degrees', type=int, nargs='+', default=None,
+                        help='The numbers of connections of the users to '
+                             'benchmark. Default is 10 100 1000 10000.')
+    parser.add_argument('--exponent', type=float, default=2.1,
+                        help='The power-law exponent. Default is 2.1.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The random seed. Default is 0.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of timed runs per benchmark. '
+                             'Default is 5.')
+    parser.add_argument('--case', dest='names', action='append',
+                        help='Only run this benchmark case. Can be repeated.')
+    parser.add_argument('--warm-cache', action='store_true', default=False,
+                        help="Don't clear the cache between runs.")
+    parser.add_argument('--keepdb', action='store_true', default=False,
+                        help='Keep the test database between runs.')
+    parser.add_argument('--output', default=None,
+                        help='Writes the json report to this file instead of '
+                             'stdout.')
+    parser.add_argument('--compare', default=None,
+                        help='A json report of a previous run to compare '
+                             'against. Exits with status 1 if anything '
+                             'regressed.')
+    parser.add_argument('--check-time', action='store_true', default=False,
+                        help='Also report wall time increases as '
+                             'regressions. By default only query count '
+                             'increases are.')
+    parser.add_argument('--check-memory', action='store_true', default=False,
+                        help='Also report peak memory increases as '
+                             'regressions.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='The relative increase of the min wall time or '
+                             'peak memory that is a regression. Default is '
+                             '0.1.')
+    parser.add_argument('--min-time-delta', type=float, default=0.001,
+                        help='The min increase of the min wall time in '
+                             'seconds that is a regression. Default is '
+                             '0.001.')
+    return parser
+
+
+def print_comparison(rows, stream):
+    template = '{0:<45} {1:>7} {2:>9} {3:>12} {4:>8}'
+    print(template.format('benchmark', 'degree', 'queries', 'min ms',
+                          'change'), file=stream)
+
+    for row in rows:
+        print(template.format(
+            row['name'],
+            row['target_degree'],
+            '{0}->{1}'.format(*row['queries']),
+            '{0:.2f}'.format(row['wall_time'][1] * 1000),
+            '{0:+.0%}{1}'.format(row['wall_time_change'],
+                                 ' !' if row['regressed'] else '')
+        ), file=stream)
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from django.test.utils import teardown_test_environment
+
+    from .measure import compare
+    from .run import DEFAULT_DEGREES
+    from .run import run_benchmarks
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, serialize=False,
+                                       keepdb=args.keepdb)
+
+    if args.keepdb:
+        # Start from an empty database so runs are comparable.
+        call_command('flush', interactive=False, verbosity=0)
+
+    try:
+        report = run_benchmarks(num_edges=args.edges,
+                                num_users=args.users,
+                                degrees=args.degrees or DEFAULT_DEGREES,
+                                names=args.names,
+                                repeat=args.repeat,
+                                exponent=args.exponent,
+                                seed=args.seed,
+                                warm_cache=args.warm_cache)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0,
+                                            keepdb=args.keepdb)
+        teardown_test_environment()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        rows = compare(baseline, report,
+                       threshold=args.threshold,
+                       check_time=args.check_time,
+                       check_memory=args.check_memory,
+                       min_time_delta=args.min_time_delta)
+        print_comparison(rows, sys.stdout)
+
+        if any(row['regressed'] for row in rows):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
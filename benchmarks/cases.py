@@ -0,0 +1,172 @@
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from collections import OrderedDict
+
+from django import forms
+from django.contrib.auth import get_user_model
+from django.test.client import RequestFactory
+from django.views.generic.base import View
+from user_connections import cache
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+from user_connections.forms.fields import UserConnectionChoiceField
+from user_connections.forms.fields import UserConnectionsMultipleChoiceField
+from user_connections.mixins.forms import UserConnectionsFormMixin
+from user_connections.mixins.views import UserConnectionViewMixin
+from user_connections.mixins.views import UserConnectionsByUserViewMixin
+from user_connections.mixins.views import UserConnectionsViewMixin
+
+
+#: The user a benchmark runs for, one of their accepted connections and the
+#: user on the other side of it.
+Subject = namedtuple('Subject', ['user', 'degree', 'connection',
+                                 'connected_user'])
+
+#: Ordered dict of benchmark name to function that takes a Subject.
+CASES = OrderedDict()
+
+
+def register(name):
+    """Decorator that registers a benchmark case."""
+    def decorator(func):
+        CASES[name] = func
+        return func
+
+    return decorator
+
+
+def get_subject(user_id, degree):
+    UserConnection = get_user_connection_model()
+    connection = (UserConnection.objects.get_by_user_id(user_id=user_id,
+                                                        status=Status.ACCEPTED)
+                                        .order_by('id')
+                                        .first())
+    return Subject(user=get_user_model().objects.get(pk=user_id),
+                   degree=degree,
+                   connection=connection,
+                   connected_user=connection.get_connected_user(user_id))
+
+
+def clear_cache():
+    user_connections_cache = cache.get_cache()
+
+    if user_connections_cache is not None:
+        user_connections_cache.clear()
+
+
+class _ContextView(View):
+
+    def get(self, request, *args, **kwargs):
+        return self.get_context_data()
+
+    def get_context_data(self, **kwargs):
+        return kwargs
+
+
+class _UserConnectionView(UserConnectionViewMixin, _ContextView):
+    pass
+
+
+class _UserConnectionsView(UserConnectionsViewMixin, _ContextView):
+    pass
+
+
+class _UserConnectionsByUserView(UserConnectionsByUserViewMixin,
+                                 _ContextView):
+    pass
+
+
+class _UserConnectionsForm(UserConnectionsFormMixin, forms.Form):
+    to_user = UserConnectionChoiceField()
+    cc_users = UserConnectionsMultipleChoiceField()
+
+
+def _get_form(subject, **kwargs):
+    return _UserConnectionsForm(
+        user=subject.user,
+        user_connections=get_user_connection_model().objects.get_by_user(
+            subject.user, status=Status.ACCEPTED),
+        **kwargs)
+
+
+def _get_request(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    return request
+
+
+@register('manager.get_for_users')
+def get_for_users(subject):
+    get_user_connection_model().objects.get_for_users(
+        subject.user, subject.connected_user)
+
+
+@register('manager.get_by_user_id')
+def get_by_user_id(subject):
+    list(get_user_connection_model().objects.get_by_user_id(
+        user_id=subject.user.id, status=Status.ACCEPTED))
+
+
+@register('manager.get_page_by_user')
+def get_page_by_user(subject):
+    get_user_connection_model().objects.get_page_by_user(
+        subject.user, status=Status.ACCEPTED)
+
+
+@register('manager.get_user_ids')
+def get_user_ids(subject):
+    get_user_connection_model().objects.get_user_ids(user_id=subject.user.id)
+
+
+@register('manager.get_connection_count')
+def get_connection_count(subject):
+    get_user_connection_model().objects.get_connection_count(subject.user)
+
+
+@register('manager.mutual_connection_ids')
+def mutual_connection_ids(subject):
+    get_user_connection_model().objects.mutual_connection_ids(
+        subject.user, subject.connected_user)
+
+
+@register('manager.second_degree_suggestions')
+def second_degree_suggestions(subject):
+    get_user_connection_model().objects.second_degree_suggestions(
+        subject.user)
+
+
+@register('views.UserConnectionViewMixin')
+def user_connection_view(subject):
+    context = _UserConnectionView.as_view()(
+        _get_request(subject.user),
+        connection_token=subject.connection.token)
+    context['connection_user'].id
+
+
+@register('views.UserConnectionsViewMixin')
+def user_connections_view(subject):
+    context = _UserConnectionsView.as_view()(_get_request(subject.user))
+    list(context['user_connections_accepted'])
+
+
+@register('views.UserConnectionsByUserViewMixin')
+def user_connections_by_user_view(subject):
+    context = _UserConnectionsByUserView.as_view()(
+        _get_request(subject.user))
+    list(context['user_connections_by_user'].items())
+
+
+@register('forms.construct')
+def construct_form(subject):
+    form = _get_form(subject)
+    list(form.fields['to_user'].choices)
+
+
+@register('forms.validate')
+def validate_form(subject):
+    form = _get_form(subject, data={
+        'to_user': subject.connection.token,
+        'cc_users': [subject.connection.token],
+    })
+    form.is_valid()
@@ -0,0 +1,159 @@
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_right
+import random
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+
+
+class SyntheticGraph(object):
+    """The users and connection counts of a generated graph.
+
+    :param user_ids: list of the generated user ids.
+    :param degrees: sequence of the number of connections per user, in the
+        same order as user_ids.
+    :param num_edges: the number of connections generated.
+    """
+
+    def __init__(self, user_ids, degrees, num_edges):
+        self.user_ids = user_ids
+        self.degrees = degrees
+        self.num_edges = num_edges
+
+    def get_user_id_for_degree(self, degree):
+        """Gets the (user id, degree) of the user whose number of connections
+        is closest to ``degree``.
+        """
+        i = min(range(len(self.degrees)),
+                key=lambda i: (abs(self.degrees[i] - degree), i))
+        return self.user_ids[i], self.degrees[i]
+
+
+def generate_edges(num_users, num_edges, exponent=2.1, seed=None):
+    """Generates the unique, undirected edges of a graph whose degree
+    distribution follows a power-law, like the connections of a social
+    network where a few users have most of the connections.
+
+    Edge end points are sampled with Chung-Lu weights ``(i + 1) ** (-1 /
+    (exponent - 1))`` so user index 0 has the most connections. Self
+    connections and duplicate edges are skipped.
+
+    :param num_users: the number of users (nodes).
+    :param num_edges: the number of edges to generate.
+    :param exponent: the power-law exponent of the degree distribution. Must
+        be greater than 1. Social graphs are usually between 2 and 3.
+    :param seed: the random seed. The same seed generates the same graph.
+    :return: generator of (user index, user index) tuples.
+    """
+    if exponent <= 1:
+        raise ValueError('exponent must be greater than 1.')
+
+    if num_edges > num_users * (num_users - 1) // 2:
+        raise ValueError('{0} users can have at most {1} '
+                         'connections.'.format(num_users,
+                                               num_users * (num_users - 1) //
+                                               2))
+
+    rng = random.Random(seed)
+    power = -1.0 / (exponent - 1)
+    cumulative_weights = array('d')
+    total_weight = 0.0
+
+    for i in range(num_users):
+        total_weight += (i + 1) ** power
+        cumulative_weights.append(total_weight)
+
+    # Edges are stored as a single int key so 10M edges fit in memory.
+    seen = set()
+    max_index = num_users - 1
+
+    while len(seen) < num_edges:
+        index_1 = min(bisect_right(cumulative_weights,
+                                   rng.random() * total_weight), max_index)
+        index_2 = min(bisect_right(cumulative_weights,
+                                   rng.random() * total_weight), max_index)
+
+        if index_1 == index_2:
+            continue
+
+        key = (min(index_1, index_2) * num_users +
+               max(index_1, index_2))
+
+        if key in seen:
+            continue
+
+        seen.add(key)
+        yield index_1, index_2
+
+
+def create_users(num_users, batch_size=1000, username_prefix=None):
+    """Bulk creates users.
+
+    :param username_prefix: the prefix of the usernames. Defaults to a unique
+        prefix per call so users from previous runs or other users aren't
+        picked up.
+    :return: the list of the created user ids.
+    """
+    User = get_user_model()
+    username_field = User.USERNAME_FIELD
+
+    if username_prefix is None:
+        username_prefix = 'bench{0}_'.format(uuid4().hex[:8])
+
+    for start in range(0, num_users, batch_size):
+        User.objects.bulk_create([
+            User(**{username_field: '{0}{1}'.format(username_prefix, i)})
+            for i in range(start, min(start + batch_size, num_users))
+        ])
+
+    # bulk_create doesn't set primary keys on every database.
+    return list(User.objects.filter(**{
+        '{0}__startswith'.format(username_field): username_prefix
+    }).order_by('pk').values_list('pk', flat=True))
+
+
+def populate(num_edges, num_users=None, exponent=2.1, seed=None,
+             status=Status.ACCEPTED, batch_size=1000):
+    """Generates a power-law connection graph into the database with bulk
+    inserts.
+
+    :param num_edges: the number of connections to create.
+    :param num_users: the number of users to create. Defaults to a tenth of
+        the number of connections.
+    :param exponent: see generate_edges.
+    :param seed: see generate_edges.
+    :param status: the status of the created connections.
+    :param batch_size: the number of rows inserted per query.
+    :return: a SyntheticGraph.
+    """
+    UserConnection = get_user_connection_model()
+
+    if num_users is None:
+        num_users = max(num_edges // 10, 2)
+
+    user_ids = create_users(num_users, batch_size=batch_size)
+    degrees = array('l', [0]) * num_users
+    pairs = []
+
+    def create_connections():
+        UserConnection.objects.bulk_create_connections(pairs,
+                                                       status=status,
+                                                       batch_size=batch_size)
+        del pairs[:]
+
+    for index_1, index_2 in generate_edges(num_users, num_edges,
+                                           exponent=exponent, seed=seed):
+        degrees[index_1] += 1
+        degrees[index_2] += 1
+        pairs.append((user_ids[index_1], user_ids[index_2]))
+
+        if len(pairs) >= batch_size * 10:
+            create_connections()
+
+    create_connections()
+    return SyntheticGraph(user_ids=user_ids, degrees=degrees,
+                          num_edges=num_edges)
@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+import timeit
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    # python < 3.4
+    tracemalloc = None
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(func, repeat=5, setup=None, using=DEFAULT_DB_ALIAS):
+    """Measures a function.
+
+    The function is timed ``repeat`` times and then run once more with
+    tracemalloc tracing, which slows it down, to get the query count and
+    peak memory.
+
+    :param func: the function to measure. Anything it returns is discarded.
+    :param repeat: the number of timed runs.
+    :param setup: optional function that's called before every run and isn't
+        measured, like clearing the cache.
+    :param using: the database alias to count queries for.
+    :return: dict with the number of ``queries``, the ``wall_time`` min,
+        median and max in seconds and the ``peak_memory`` in bytes (None
+        when tracemalloc isn't available).
+    """
+    timings = []
+
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - start)
+
+    if setup is not None:
+        setup()
+
+    peak_memory = None
+
+    with CaptureQueriesContext(connections[using]) as queries:
+        if tracemalloc is None:
+            func()
+        else:
+            tracemalloc.start()
+
+            try:
+                func()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return {
+        'queries': len(queries),
+        'wall_time': {
+            'min': min(timings),
+            'median': _median(timings),
+            'max': max(timings),
+        },
+        'peak_memory': peak_memory,
+    }
+
+
+def compare(baseline, current, threshold=0.1, check_time=False,
+            check_memory=False, min_time_delta=0.001,
+            min_memory_delta=64 * 1024):
+    """Compares the results of two benchmark runs.
+
+    By default only an increase of the query count is a regression since it
+    doesn't depend on the machine or its load. Wall time is compared by the
+    fastest of the timed runs, which is the least affected by noise, and both
+    wall time and peak memory have to increase by more than the relative
+    ``threshold`` and by more than an absolute amount to be a regression.
+
+    :param baseline: the report of the run to compare against.
+    :param current: the report of the new run.
+    :param threshold: the relative increase of the min wall time or peak
+        memory that's considered a regression.
+    :param check_time: boolean indicating if wall time increases are
+        regressions. Default is False.
+    :param check_memory: boolean indicating if peak memory increases are
+        regressions. Default is False.
+    :param min_time_delta: the min increase of the min wall time in seconds
+        that's considered a regression. Default is 1ms.
+    :param min_memory_delta: the min increase of the peak memory in bytes
+        that's considered a regression. Default is 64KiB.
+    :return: list of dicts, one per benchmark in both runs, with the
+        ``name``, ``target_degree``, the baseline and current ``queries``,
+        ``wall_time`` (min) and ``peak_memory``, the relative
+        ``wall_time_change`` and a ``regressed`` boolean.
+    """
+    def get_key(result):
+        return result['name'], result['target_degree']
+
+    def is_increase(old_value, new_value, min_delta):
+        return (new_value - old_value > min_delta and
+                new_value > old_value * (1 + threshold))
+
+    baseline_results = dict((get_key(result), result)
+                            for result in baseline['results'])
+    rows = []
+
+    for result in current['results']:
+        old_result = baseline_results.get(get_key(result))
+
+        if old_result is None:
+            continue
+
+        old_time = old_result['wall_time']['min']
+        new_time = result['wall_time']['min']
+        time_change = (new_time - old_time) / old_time if old_time else 0.0
+        regressed = result['queries'] > old_result['queries']
+
+        if check_time:
+            regressed = regressed or is_increase(old_time, new_time,
+                                                 min_time_delta)
+
+        if (check_memory and result['peak_memory'] and
+                old_result['peak_memory']):
+            regressed = regressed or is_increase(old_result['peak_memory'],
+                                                 result['peak_memory'],
+                                                 min_memory_delta)
+
+        rows.append({
+            'name': result['name'],
+            'target_degree': result['target_degree'],
+            'queries': (old_result['queries'], result['queries']),
+            'wall_time': (old_time, new_time),
+            'peak_memory': (old_result['peak_memory'],
+                            result['peak_memory']),
+            'wall_time_change': time_change,
+            'regressed': regressed,
+        })
+
+    return rows
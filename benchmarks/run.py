@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+import platform
+import timeit
+
+import django
+from django.db import connection
+
+from .cases import CASES
+from .cases import clear_cache
+from .cases import get_subject
+from .graph import populate
+from .measure import measure
+
+
+#: Report format version. Bump when the report structure changes.
+REPORT_VERSION = 1
+
+DEFAULT_DEGREES = (10, 100, 1000, 10000)
+
+
+def run_benchmarks(num_edges, num_users=None, degrees=DEFAULT_DEGREES,
+                   names=None, repeat=5, exponent=2.1, seed=0,
+                   warm_cache=False):
+    """Generates a synthetic graph into the current database and runs the
+    benchmark cases for the users whose number of connections is closest to
+    each of ``degrees``.
+
+    :param num_edges: the number of connections to generate.
+    :param num_users: the number of users to generate. See
+        benchmarks.graph.populate.
+    :param degrees: the numbers of connections of the users to benchmark.
+    :param names: the names of the cases to run. Defaults to all of them.
+    :param repeat: the number of timed runs per case.
+    :param exponent: the power-law exponent of the generated graph.
+    :param seed: the random seed of the generated graph.
+    :param warm_cache: boolean indicating if the cache is kept between runs.
+        By default it's cleared before each run.
+    :return: the report dict. It only contains json serializable values.
+    """
+    start = timeit.default_timer()
+    graph = populate(num_edges, num_users=num_users, exponent=exponent,
+                     seed=seed)
+    populate_time = timeit.default_timer() - start
+
+    # Small graphs may not have users with the larger degrees so the same
+    # user is only benchmarked once.
+    subjects = []
+    subject_user_ids = set()
+
+    for target_degree in sorted(set(degrees)):
+        user_id, degree = graph.get_user_id_for_degree(target_degree)
+
+        if degree and user_id not in subject_user_ids:
+            subject_user_ids.add(user_id)
+            subjects.append((target_degree, get_subject(user_id, degree)))
+
+    results = []
+
+    for name, case in CASES.items():
+        if names and name not in names:
+            continue
+
+        for target_degree, subject in subjects:
+            result = measure(lambda: case(subject),
+                             repeat=repeat,
+                             setup=None if warm_cache else clear_cache)
+            result.update({
+                'name': name,
+                'target_degree': target_degree,
+                'degree': subject.degree,
+            })
+            results.append(result)
+
+    return {
+        'version': REPORT_VERSION,
+        'meta': {
+            'created': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'num_users': len(graph.user_ids),
+            'num_edges': num_edges,
+            'exponent': exponent,
+            'seed': seed,
+            'repeat': repeat,
+            'warm_cache': warm_cache,
+            'populate_time': populate_time,
+            'max_degree': max(graph.degrees),
+        },
+        'results': results,
+    }
@@ -27,7 +27,7 @@ setup(
     maintainer='Troy Grosfield',
     url='https://github.com/infoagetech/django-user-connections',
     license='MIT',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests']),
     include_package_data=True,
     zip_safe=False,
     test_suite='nose.collector',
@@ -34,3 +34,6 @@ DATABASES = {
         'NAME': here('test_db.db')
     }
 }
+
+# Tests run in a single process so the local memory cache is fine here.
+USER_CONNECTIONS_CACHE = 'default'
@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test.utils import override_settings
+from django_testing.testcases.users import SingleUserTestCase
+from django_testing.user_utils import create_user
+from user_connections import get_user_connection_model
+from user_connections.activity import ActivityCountBuffer
+from user_connections.activity import get_activity_count_buffer
+
+
+UserConnection = get_user_connection_model()
+
+
+class ActivityCountBufferTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(ActivityCountBufferTestCase, self).setUp()
+        self.buffer = ActivityCountBuffer(model=UserConnection,
+                                          flush_interval=60)
+
+    def test_increments_coalesced(self):
+        """Test increments are buffered until the buffer is flushed and then
+        written with a single update.
+        """
+        user_2 = create_user()
+        user_3 = create_user()
+        conn_2 = UserConnection.objects.create(created_user=self.user,
+                                               with_user=user_2)
+        conn_3 = UserConnection.objects.create(created_user=user_3,
+                                               with_user=self.user)
+
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.buffer.increment(conn_2.id)
+
+            self.buffer.increment(conn_3.id)
+
+        self.assertEqual(len(self.buffer), 2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.buffer.flush(), 2)
+
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(UserConnection.objects.get(id=conn_2.id)
+                                               .activity_count, 4)
+        self.assertGreater(UserConnection.objects.get(id=conn_2.id)
+                                                 .last_modified_dttm,
+                           conn_2.last_modified_dttm)
+        self.assertEqual(UserConnection.objects.get(id=conn_3.id)
+                                               .activity_count, 2)
+        self.assertEqual(self.buffer.stats['flushes'], 1)
+        self.assertEqual(self.buffer.stats['flushed_increments'], 4)
+        self.assertEqual(self.buffer.stats['flushed_rows'], 2)
+
+    def test_increments_by_users_merged(self):
+        """Test increments by connection id and by users for the same
+        connection are merged.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+
+        self.buffer.increment(conn.id)
+        self.buffer.increment_by_users(user_2.id, self.user.id)
+        self.buffer.increment_by_users(self.user.id, user_2.id, count=2)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.buffer.flush(), 1)
+
+        self.assertEqual(UserConnection.objects.get(id=conn.id)
+                                               .activity_count, 5)
+
+    def test_failed_flush(self):
+        """Test the increments that weren't written when a flush fails are
+        put back in the buffer.
+        """
+        user_2 = create_user()
+        conns = [UserConnection.objects.create(created_user=self.user,
+                                               with_user=create_user())
+                 for i in range(2)]
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+        self.buffer.batch_size = 1
+
+        for i in range(2):
+            self.buffer.increment(conns[i].id, count=2)
+
+        self.buffer.increment_by_users(self.user.id, user_2.id, count=3)
+        update_counts = self.buffer._update_counts
+        batches = []
+
+        def fail_second_batch(counts_by_id):
+            batches.append(counts_by_id)
+
+            if len(batches) > 1:
+                raise DatabaseError()
+
+            return update_counts(counts_by_id)
+
+        with mock.patch.object(self.buffer, '_update_counts',
+                               side_effect=fail_second_batch):
+            self.assertRaises(DatabaseError, self.buffer.flush)
+
+        self.assertEqual(len(self.buffer), 2)
+        self.buffer.increment(conn.id)
+        self.assertEqual(self.buffer.flush(), 2)
+
+        for conn_2 in conns:
+            self.assertEqual(UserConnection.objects.get(id=conn_2.id)
+                                                   .activity_count, 3)
+
+        self.assertEqual(UserConnection.objects.get(id=conn.id)
+                                               .activity_count, 5)
+
+        # Resolving the user pairs fails.
+        self.buffer.increment(conn.id)
+        self.buffer.increment_by_users(user_2.id, self.user.id)
+
+        with mock.patch.object(self.buffer, '_merge_user_pair_counts',
+                               side_effect=DatabaseError()):
+            self.assertRaises(DatabaseError, self.buffer.flush)
+
+        self.assertEqual(len(self.buffer), 2)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(UserConnection.objects.get(id=conn.id)
+                                               .activity_count, 7)
+
+    def test_max_size_flush(self):
+        """Test the buffer is flushed once it's full."""
+        self.buffer.max_size = 2
+        conns = [UserConnection.objects.create(created_user=self.user,
+                                               with_user=create_user())
+                 for i in range(2)]
+
+        self.buffer.increment(conns[0].id)
+        self.assertEqual(len(self.buffer), 1)
+        self.buffer.increment(conns[1].id)
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_synchronous(self):
+        """Test a synchronous buffer writes every increment immediately."""
+        self.buffer.synchronous = True
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.buffer.increment_by_users(self.user.id,
+                                                           user_2.id))
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.buffer.increment(conn.id))
+
+        self.assertFalse(self.buffer.increment_by_users(self.user.id,
+                                                        create_user().id))
+        self.assertEqual(UserConnection.objects.get(id=conn.id)
+                                               .activity_count, 3)
+
+    def test_buffer_settings(self):
+        """Test the model's buffer follows setting changes and writes what the
+        replaced buffer holds.
+        """
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=create_user())
+
+        with override_settings(USER_CONNECTIONS_ACTIVITY_BUFFER=True,
+                               USER_CONNECTIONS_ACTIVITY_FLUSH_INTERVAL=60):
+            buffer = get_activity_count_buffer(UserConnection)
+            self.assertFalse(buffer.synchronous)
+            self.assertEqual(buffer.flush_interval, 60)
+            self.assertIs(get_activity_count_buffer(UserConnection), buffer)
+            buffer.increment(conn.id)
+
+        synchronous_buffer = get_activity_count_buffer(UserConnection)
+        self.assertTrue(synchronous_buffer.synchronous)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(UserConnection.objects.get(id=conn.id)
+                                               .activity_count, 2)
@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+
+import sys
+import threading
+from unittest import mock
+from unittest import skipIf
+
+from django.db import close_old_connections
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django_testing.user_utils import create_user
+from user_connections import cache
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from user_connections import aio
+    from user_connections.aio import UserConnectionLoader
+
+
+UserConnection = get_user_connection_model()
+
+
+def run_inline(func, *args, **kwargs):
+    """Runs the sync function in the test thread so it uses the test
+    transaction.
+    """
+    future = asyncio.get_event_loop().create_future()
+
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+
+@skipIf(sys.version_info < (3, 5), 'The async API requires python 3.5+.')
+class AsyncUserConnectionManagerTestCase(TestCase):
+
+    def setUp(self):
+        super(AsyncUserConnectionManagerTestCase, self).setUp()
+        cache.get_cache().clear()
+        patcher = mock.patch('user_connections.aio.run_sync', run_inline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+        self.user = create_user()
+        self.users = [create_user() for i in range(3)]
+        self.conns = [
+            UserConnection.objects.create(created_user=self.user,
+                                          with_user=user,
+                                          status=Status.ACCEPTED)
+            for user in self.users[:2]
+        ]
+
+    def run_async(self, *coroutines):
+        return self.loop.run_until_complete(asyncio.gather(*coroutines))
+
+    def test_aget_for_users_batched(self):
+        """Test concurrent aget_for_users calls are a single query."""
+        with self.assertNumQueries(1):
+            conns = self.run_async(*[
+                UserConnection.objects.aget_for_users(user, self.user)
+                for user in self.users
+            ])
+
+        self.assertEqual(conns, self.conns + [None])
+
+    def test_aget_user_ids_batched(self):
+        """Test concurrent aget_user_ids calls are a single query and the
+        results are cached.
+        """
+        with self.assertNumQueries(1):
+            user_ids = self.run_async(*[
+                UserConnection.objects.aget_user_ids(user_id,
+                                                     status=Status.ACCEPTED)
+                for user_id in [self.user.id] + [u.id for u in self.users]
+            ])
+
+        self.assertEqual(sorted(user_ids[0]),
+                         sorted([self.users[0].id, self.users[1].id]))
+        self.assertEqual(user_ids[1:], [[self.user.id], [self.user.id], []])
+
+        with self.assertNumQueries(0):
+            user_ids = self.run_async(
+                UserConnection.objects.aget_user_ids(self.user.id,
+                                                     status=Status.ACCEPTED))
+
+    def test_loader_cache_results(self):
+        """Test a loader that caches results only loads a key once."""
+        loader = UserConnectionLoader(UserConnection, cache_results=True)
+
+        with self.assertNumQueries(1):
+            self.run_async(loader.load_for_users(self.user, self.users[0]))
+            conn = self.run_async(loader.load_for_users(self.users[0],
+                                                        self.user))[0]
+
+        self.assertEqual(conn, self.conns[0])
+
+    def test_aget_or_create_and_transition(self):
+        """Test creating and changing the status of connections."""
+        conn, created = self.run_async(
+            UserConnection.objects.aget_or_create(self.user,
+                                                  self.users[2]))[0]
+        self.assertTrue(created)
+
+        self.assertTrue(self.run_async(
+            UserConnection.objects.atransition(conn, Status.ACCEPTED))[0])
+        self.assertEqual(
+            self.run_async(UserConnection.objects.abulk_transition(
+                [c.id for c in self.conns], Status.INACTIVE))[0],
+            2
+        )
+
+        conns = self.run_async(UserConnection.objects.aget_by_user_id(
+            self.user.id, status=Status.ACCEPTED))[0]
+        self.assertEqual(conns, [conn])
+
+
+@skipIf(sys.version_info < (3, 5), 'The async API requires python 3.5+.')
+class AsyncExecutorTestCase(TransactionTestCase):
+    """Runs the async API through the dedicated executor thread that's used
+    when asgiref isn't installed.
+    """
+
+    def setUp(self):
+        super(AsyncExecutorTestCase, self).setUp()
+        cache.get_cache().clear()
+        patcher = mock.patch('user_connections.aio.sync_to_async', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+        self.user = create_user()
+        self.user_2 = create_user()
+        self.conn = UserConnection.objects.create(created_user=self.user,
+                                                  with_user=self.user_2,
+                                                  status=Status.ACCEPTED)
+
+    def test_executor(self):
+        """Test calls run in the executor thread and check its database
+        connections before and after each call.
+        """
+        with mock.patch('user_connections.aio.close_old_connections',
+                        wraps=close_old_connections) as close_connections:
+            conn, user_ids = self.loop.run_until_complete(asyncio.gather(
+                UserConnection.objects.aget_for_users(self.user,
+                                                      self.user_2),
+                UserConnection.objects.aget_user_ids(self.user.id)
+            ))
+
+        self.assertEqual(conn, self.conn)
+        self.assertEqual(user_ids, [self.user_2.id])
+        # The loader batches both calls into a single thread hop.
+        self.assertEqual(close_connections.call_count, 2)
+
+        thread_ids = self.loop.run_until_complete(asyncio.gather(*[
+            aio.run_sync(threading.get_ident) for i in range(3)
+        ]))
+        self.assertEqual(len(set(thread_ids)), 1)
+        self.assertNotEqual(thread_ids[0], threading.get_ident())
@@ -0,0 +1,148 @@
+from __future__ import unicode_literals
+
+from benchmarks.graph import generate_edges
+from benchmarks.graph import populate
+from benchmarks.measure import compare
+from benchmarks.run import run_benchmarks
+from django.test.testcases import TestCase
+from user_connections import get_user_connection_model
+
+
+UserConnection = get_user_connection_model()
+
+
+class GenerateEdgesTestCase(TestCase):
+
+    def test_generate_edges(self):
+        """Test the edges are unique, have no self connections and are the
+        same for the same seed.
+        """
+        edges = list(generate_edges(100, 500, seed=1))
+
+        self.assertEqual(len(edges), 500)
+        self.assertEqual(len(set(tuple(sorted(edge)) for edge in edges)), 500)
+        self.assertFalse([edge for edge in edges if edge[0] == edge[1]])
+        self.assertEqual(edges, list(generate_edges(100, 500, seed=1)))
+        self.assertNotEqual(edges, list(generate_edges(100, 500, seed=2)))
+
+    def test_power_law(self):
+        """Test the first users have most of the connections."""
+        degrees = [0] * 1000
+
+        for index_1, index_2 in generate_edges(1000, 5000, seed=1):
+            degrees[index_1] += 1
+            degrees[index_2] += 1
+
+        self.assertGreater(sum(degrees[:100]), sum(degrees[100:]))
+        self.assertGreater(degrees[0], 10 * degrees[500])
+
+    def test_too_many_edges(self):
+        self.assertRaises(ValueError, list, generate_edges(10, 46))
+        self.assertRaises(ValueError, list, generate_edges(10, 10,
+                                                           exponent=1))
+
+
+class BenchmarksTestCase(TestCase):
+
+    def test_populate(self):
+        graph = populate(300, num_users=50, seed=1, batch_size=20)
+
+        self.assertEqual(UserConnection.objects.count(), 300)
+        self.assertEqual(sum(graph.degrees), 600)
+        user_id, degree = graph.get_user_id_for_degree(1000)
+        self.assertEqual(degree, max(graph.degrees))
+        self.assertEqual(UserConnection.objects.get_by_user_id(
+            user_id=user_id).count(), degree)
+
+    def test_populate_again(self):
+        """Test populating a database that has a previous graph creates new
+        users and only returns those.
+        """
+        graph = populate(30, num_users=10, seed=1)
+        graph_2 = populate(30, num_users=10, seed=1)
+
+        self.assertEqual(len(graph_2.user_ids), 10)
+        self.assertFalse(set(graph.user_ids).intersection(graph_2.user_ids))
+        self.assertEqual(UserConnection.objects.count(), 60)
+
+    def test_run_and_compare(self):
+        """Test the report has a result per case and degree and comparing a
+        report with itself doesn't regress.
+        """
+        report = run_benchmarks(200, num_users=40, degrees=(2, 20),
+                                names=['manager.get_by_user_id',
+                                       'views.UserConnectionViewMixin'],
+                                repeat=1)
+
+        self.assertEqual(report['meta']['num_edges'], 200)
+        self.assertEqual([(result['name'], result['target_degree'])
+                          for result in report['results']],
+                         [('manager.get_by_user_id', 2),
+                          ('manager.get_by_user_id', 20),
+                          ('views.UserConnectionViewMixin', 2),
+                          ('views.UserConnectionViewMixin', 20)])
+
+        for result in report['results']:
+            self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['wall_time']['median'], 0)
+
+        rows = compare(report, report)
+        self.assertEqual(len(rows), 4)
+        self.assertFalse([row for row in rows if row['regressed']])
+
+
+class CompareTestCase(TestCase):
+
+    def get_report(self, queries=3, wall_time=0.01, peak_memory=100000):
+        return {'results': [{
+            'name': 'manager.get_by_user_id',
+            'target_degree': 10,
+            'queries': queries,
+            'wall_time': {'min': wall_time, 'median': wall_time * 2,
+                          'max': wall_time * 10},
+            'peak_memory': peak_memory,
+        }]}
+
+    def test_queries(self):
+        """Test a query count increase is a regression by default and wall
+        time and peak memory increases aren't.
+        """
+        baseline = self.get_report()
+
+        row = compare(baseline, self.get_report(queries=4))[0]
+        self.assertTrue(row['regressed'])
+        self.assertEqual(row['queries'], (3, 4))
+
+        row = compare(baseline, self.get_report(wall_time=1,
+                                                peak_memory=10 ** 7))[0]
+        self.assertFalse(row['regressed'])
+        self.assertEqual(row['wall_time'], (0.01, 1))
+
+    def test_wall_time(self):
+        """Test the min wall time has to increase by the threshold and the
+        absolute min delta.
+        """
+        baseline = self.get_report()
+
+        row = compare(baseline, self.get_report(wall_time=0.02),
+                      check_time=True)[0]
+        self.assertTrue(row['regressed'])
+        self.assertAlmostEqual(row['wall_time_change'], 1)
+
+        # Below the threshold
+        self.assertFalse(compare(baseline, self.get_report(wall_time=0.0105),
+                                 check_time=True)[0]['regressed'])
+        # Below the absolute min delta
+        self.assertFalse(compare(self.get_report(wall_time=0.0001),
+                                 self.get_report(wall_time=0.0005),
+                                 check_time=True)[0]['regressed'])
+
+    def test_peak_memory(self):
+        baseline = self.get_report()
+
+        self.assertTrue(compare(baseline,
+                                self.get_report(peak_memory=200000),
+                                check_memory=True)[0]['regressed'])
+        self.assertFalse(compare(baseline,
+                                 self.get_report(peak_memory=150000),
+                                 check_memory=True)[0]['regressed'])
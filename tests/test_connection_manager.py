@@ -1,8 +1,21 @@
 from __future__ import unicode_literals
 
+from unittest import mock
+from unittest import skipUnless
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models.signals import pre_save
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.utils.six import StringIO
 from django_testing.user_utils import create_user
+from user_connections import cache
 from user_connections import get_user_connection_model
 from user_connections.constants import Status
 
@@ -81,3 +94,587 @@ class ConnectionManagerTestCase(TestCase):
                                                          user_2=self.user)
 
         self.assertEqual(conn, conn_db_2)
+
+    def test_create_single_query(self):
+        """Test creating a new connection is a single insert statement."""
+        user_2 = create_user()
+
+        with self.assertNumQueries(1):
+            conn, is_created = UserConnection.objects.get_or_create(
+                created_user=self.user,
+                with_user=user_2)
+
+        self.assertTrue(is_created)
+        self.assertIsNotNone(conn.id)
+        self.assertEqual(UserConnection.objects.get(id=conn.id), conn)
+
+    def test_create_existing_reverse(self):
+        """Test creating a connection that already exists in the reverse
+        direction returns the existing connection.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+        conn_2, is_created = UserConnection.objects.get_or_create(
+            created_user=user_2,
+            with_user=self.user)
+
+        self.assertFalse(is_created)
+        self.assertEqual(conn, conn_2)
+        self.assertEqual(UserConnection.objects.get_by_user(user_2).count(), 1)
+
+    def test_get_or_create_without_on_conflict(self):
+        """Test get or create for databases that don't support ON CONFLICT."""
+        user_2 = create_user()
+
+        with mock.patch.object(UserConnection.objects, '_supports_on_conflict',
+                               return_value=False):
+            conn, is_created = UserConnection.objects.get_or_create(
+                created_user=self.user,
+                with_user=user_2)
+            conn_2, is_created_2 = UserConnection.objects.get_or_create(
+                created_user=user_2,
+                with_user=self.user)
+
+        self.assertTrue(is_created)
+        self.assertFalse(is_created_2)
+        self.assertEqual(conn, conn_2)
+
+    def test_get_or_create_token_collision(self):
+        """Test creating a connection whose token is already taken retries
+        with a new token.
+        """
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=create_user())
+
+        for supports_on_conflict in (True, False):
+            user_2 = create_user()
+            token = 'a' * 15 + str(user_2.id)
+
+            with mock.patch('user_connections.managers.random_alphanum',
+                            side_effect=[conn.token, token]):
+                with mock.patch.object(UserConnection.objects,
+                                       '_supports_on_conflict',
+                                       return_value=supports_on_conflict):
+                    conn_2, is_created = UserConnection.objects.get_or_create(
+                        created_user=self.user,
+                        with_user=user_2)
+
+            self.assertTrue(is_created)
+            self.assertEqual(conn_2.token, token)
+            self.assertEqual(UserConnection.objects.get(id=conn_2.id), conn_2)
+
+    def test_get_or_create_attempts(self):
+        """Test get or create gives up when every insert is ignored and no
+        connection is found.
+        """
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=create_user())
+
+        with mock.patch('user_connections.managers.random_alphanum',
+                        return_value=conn.token) as random_alphanum:
+            self.assertRaises(IntegrityError,
+                              UserConnection.objects.get_or_create,
+                              created_user=self.user,
+                              with_user=create_user())
+
+        self.assertEqual(random_alphanum.call_count,
+                         UserConnection.objects.get_or_create_attempts)
+
+    def test_get_or_create_pre_save(self):
+        """Test pre_save is sent before the insert like save() does so the
+        changes receivers make are saved.
+        """
+        user_2 = create_user()
+
+        def receiver(instance, **kwargs):
+            self.assertTrue(instance.low_user_id)
+            instance.activity_count = 7
+
+        receiver = mock.Mock(side_effect=receiver)
+        pre_save.connect(receiver, sender=UserConnection)
+
+        try:
+            conn, created = UserConnection.objects.get_or_create(
+                created_user=self.user,
+                with_user=user_2)
+            self.assertTrue(created)
+            self.assertEqual(receiver.call_count, 1)
+            self.assertEqual(
+                UserConnection.objects.get(id=conn.id).activity_count, 7)
+
+            # An ignored insert was still an attempted save.
+            UserConnection.objects.get_or_create(created_user=user_2,
+                                                 with_user=self.user)
+            self.assertEqual(receiver.call_count, 2)
+        finally:
+            pre_save.disconnect(receiver, sender=UserConnection)
+
+    def test_get_or_create_save_override(self):
+        """Test a model that overrides save() is created with save()."""
+        user_2 = create_user()
+        save = UserConnection.save
+
+        def save_override(conn, *args, **kwargs):
+            conn.activity_count = 3
+            save(conn, *args, **kwargs)
+
+        with mock.patch.object(UserConnection, 'save', save_override):
+            conn, created = UserConnection.objects.get_or_create(
+                created_user=self.user,
+                with_user=user_2)
+            self.assertTrue(created)
+            self.assertEqual(
+                UserConnection.objects.get(id=conn.id).activity_count, 3)
+
+            conn_2, created = UserConnection.objects.get_or_create(
+                created_user=user_2,
+                with_user=self.user)
+            self.assertFalse(created)
+            self.assertEqual(conn_2, conn)
+
+    def test_save_existing_token(self):
+        """Test saving a connection that has a token doesn't query for
+        available tokens.
+        """
+        conn = UserConnection(created_user=self.user, with_user=create_user())
+        conn.save()
+        self.assertTrue(conn.token)
+
+        with mock.patch.object(UserConnection.objects,
+                               'get_available_tokens') as get_tokens:
+            conn.save()
+            UserConnection(created_user=self.user,
+                           with_user=create_user(),
+                           token='b' * 15).save()
+
+        self.assertFalse(get_tokens.called)
+
+    def test_bulk_create_connections(self):
+        """Test bulk creating connections skips duplicate pairs, pairs with
+        the same user and connections that already exist.
+        """
+        user_2 = create_user()
+        users = [create_user() for i in range(5)]
+        UserConnection.objects.create(created_user=user_2, with_user=users[0])
+        pairs = [(user_2, user) for user in users]
+        pairs += [(users[1].id, user_2.id), (user_2, user_2)]
+
+        created, skipped = UserConnection.objects.bulk_create_connections(
+            pairs,
+            status=Status.ACCEPTED,
+            batch_size=2)
+
+        self.assertEqual(created, 4)
+        self.assertEqual(skipped, 3)
+        self.assertEqual(UserConnection.objects.get_by_user(user_2).count(), 5)
+
+        conn = UserConnection.objects.get_for_users(user_2, users[4])
+        self.assertEqual(conn.status, Status.ACCEPTED)
+        self.assertEqual(conn.created_user, user_2)
+        self.assertEqual(len(conn.token), UserConnection.token_length)
+
+    def test_bulk_create_connections_token_taken(self):
+        """Test a connection whose token was taken after the token check is
+        created with a new token instead of being skipped.
+        """
+        user_2 = create_user()
+        users = [create_user() for i in range(2)]
+        conn = UserConnection.objects.create(created_user=user_2,
+                                             with_user=users[0])
+
+        with mock.patch.object(UserConnection.objects,
+                               'get_available_tokens',
+                               return_value=[conn.token, 'a' * 15]):
+            created, skipped = UserConnection.objects.bulk_create_connections(
+                [(self.user, user) for user in users])
+
+        self.assertEqual(created, 2)
+        self.assertEqual(skipped, 0)
+
+        new_conn = UserConnection.objects.get_for_users(self.user, users[0])
+        self.assertNotEqual(new_conn.token, conn.token)
+        self.assertEqual(len(new_conn.token), UserConnection.token_length)
+        self.assertEqual(
+            UserConnection.objects.get_for_users(self.user, users[1]).token,
+            'a' * 15)
+
+    def test_with_users_select_related(self):
+        """Test loading the users of connections with a JOIN and only the
+        user fields that are needed.
+        """
+        user_2 = create_user()
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=user_2)
+
+        with self.assertNumQueries(1):
+            conn = UserConnection.objects.get_by_user(user_2).with_users(
+                user_fields=('username', 'first_name', 'last_name'))[0]
+            self.assertEqual(conn.get_connected_user(user_2).get_full_name(),
+                             self.user.get_full_name())
+
+        self.assertIn('email', conn.with_user.get_deferred_fields())
+
+    def test_with_users_prefetch_related(self):
+        """Test loading the users of connections with a prefetch."""
+        user_2 = create_user()
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=user_2)
+
+        with self.assertNumQueries(3):
+            conn = list(UserConnection.objects.get_by_user(user_2).with_users(
+                strategy='prefetch_related',
+                user_fields=('username',)))[0]
+            self.assertEqual(conn.created_user.username, self.user.username)
+
+    def test_get_page_by_user(self):
+        """Test paging through a user's connections with a cursor doesn't
+        skip or repeat connections with the same activity count.
+        """
+        user = create_user()
+        conns = [UserConnection.objects.create(created_user=user,
+                                               with_user=create_user(),
+                                               status=Status.ACCEPTED,
+                                               activity_count=count)
+                 for count in (1, 4, 4, 4, 2)]
+        expected = sorted(conns, key=lambda c: (-c.activity_count, -c.id))
+
+        # A connection with themself is only on a page once.
+        conns.append(UserConnection.objects.create(created_user=user,
+                                                   with_user=user,
+                                                   status=Status.ACCEPTED,
+                                                   activity_count=3))
+        conns.append(UserConnection.objects.create(created_user=create_user(),
+                                                   with_user=user,
+                                                   status=Status.ACCEPTED,
+                                                   activity_count=4))
+        expected = sorted(conns, key=lambda c: (-c.activity_count, -c.id))
+        paged_conns = []
+        cursor = None
+
+        while True:
+            # A query for each user column.
+            with self.assertNumQueries(2):
+                page, cursor = UserConnection.objects.get_page_by_user(
+                    user,
+                    after=cursor,
+                    page_size=2,
+                    status=Status.ACCEPTED
+                )
+
+            paged_conns += page
+
+            if cursor is None:
+                break
+
+        self.assertEqual(paged_conns, expected)
+
+        with self.assertNumQueries(1):
+            page, cursor = UserConnection.objects.filter(
+                created_user=user
+            ).page(page_size=2)
+
+        self.assertEqual(page, [conn for conn in expected
+                                if conn.created_user_id == user.id][:2])
+
+        # The users are prefetched once for the merged page.
+        with self.assertNumQueries(4):
+            page, cursor = UserConnection.objects.get_by_user_id(
+                user.id,
+                strategy='union'
+            ).with_users(strategy='prefetch_related').page(page_size=2)
+
+        with self.assertNumQueries(0):
+            self.assertEqual([(conn.created_user, conn.with_user)
+                              for conn in page],
+                             [(conn.created_user, conn.with_user)
+                              for conn in expected[:2]])
+
+        page, cursor = UserConnection.objects.get_page_by_user(user,
+                                                               after='bad',
+                                                               page_size=10)
+        self.assertEqual(page, expected)
+        self.assertIsNone(cursor)
+
+
+class ConnectionManagerUserIdsCacheTestCase(TestCase):
+
+    def setUp(self):
+        super(ConnectionManagerUserIdsCacheTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.user = create_user()
+
+    def test_cache_off_by_default(self):
+        """Test caching is off unless a cache alias is set."""
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=create_user())
+
+        with self.settings():
+            del settings.USER_CONNECTIONS_CACHE
+            self.assertIsNone(cache.get_cache())
+
+            for i in range(2):
+                with self.assertNumQueries(1):
+                    UserConnection.objects.get_record(token=conn.token)
+
+    def test_get_user_ids_cached(self):
+        """Test the connected user ids are only queried on the first call."""
+        user_2 = create_user()
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=user_2)
+
+        with self.assertNumQueries(1):
+            user_ids = UserConnection.objects.get_user_ids(self.user.id)
+
+        with self.assertNumQueries(0):
+            cached_user_ids = UserConnection.objects.get_user_ids(self.user.id)
+
+        self.assertEqual(user_ids, [user_2.id])
+        self.assertEqual(cached_user_ids, [user_2.id])
+
+    def test_get_user_ids_by_status_invalidated_on_accept(self):
+        """Test accepting a connection invalidates the cached user ids for
+        both users.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2,
+                                             status=Status.PENDING)
+
+        self.assertEqual(UserConnection.objects.get_user_ids(
+            self.user.id, status=Status.ACCEPTED), [])
+        self.assertEqual(UserConnection.objects.get_user_ids(
+            user_2.id, status=Status.ACCEPTED), [])
+
+        conn.accept()
+
+        self.assertEqual(UserConnection.objects.get_user_ids(
+            self.user.id, status=Status.ACCEPTED), [user_2.id])
+        self.assertEqual(UserConnection.objects.get_user_ids(
+            user_2.id, status=Status.ACCEPTED), [self.user.id])
+
+    def test_get_user_ids_invalidated_on_delete(self):
+        """Test deleting a connection invalidates the cached user ids."""
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+
+        self.assertEqual(UserConnection.objects.get_user_ids(self.user.id),
+                         [user_2.id])
+        conn.delete()
+        self.assertEqual(UserConnection.objects.get_user_ids(self.user.id),
+                         [])
+
+    def test_get_record_token_invalidated_on_delete(self):
+        """Test deleting a connection invalidates its cached token."""
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=create_user())
+
+        self.assertEqual(
+            UserConnection.objects.get_record(token=conn.token).id, conn.id)
+        self.assertEqual(cache.get_connection_id_for_token(conn.token),
+                         conn.id)
+        conn.delete()
+        self.assertIsNone(cache.get_connection_id_for_token(conn.token))
+        self.assertIsNone(UserConnection.objects.get_record(token=conn.token))
+
+    def test_get_user_ids_invalidated_on_bulk_create(self):
+        """Test bulk creating connections invalidates the cached user ids."""
+        user_2 = create_user()
+
+        self.assertEqual(UserConnection.objects.get_user_ids(self.user.id), [])
+        UserConnection.objects.bulk_create_connections([(self.user, user_2)])
+        self.assertEqual(UserConnection.objects.get_user_ids(self.user.id),
+                         [user_2.id])
+
+
+@skipUnless(hasattr(transaction, 'on_commit'),
+            'Deleting on commit requires django 1.9+.')
+class ConnectionManagerCacheOnCommitTestCase(TransactionTestCase):
+
+    def setUp(self):
+        super(ConnectionManagerCacheOnCommitTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.user = create_user()
+
+    def test_invalidated_on_commit(self):
+        """Test values cached while the transaction that changed the
+        connection is open are invalidated once it commits.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+
+        with transaction.atomic():
+            conn.accept()
+            self.assertIsNone(cache.get_user_ids(self.user.id))
+            # Another request caching the data from before the commit.
+            cache.set_user_ids(self.user.id, [], status=Status.ACCEPTED)
+
+        self.assertIsNone(cache.get_user_ids(self.user.id,
+                                             status=Status.ACCEPTED))
+        self.assertEqual(UserConnection.objects.get_user_ids(
+            self.user.id, status=Status.ACCEPTED), [user_2.id])
+
+
+class ConnectionManagerMutualConnectionsTestCase(TestCase):
+
+    def setUp(self):
+        super(ConnectionManagerMutualConnectionsTestCase, self).setUp()
+        self.user_a = create_user()
+        self.user_b = create_user()
+        self.user_c = create_user()
+        self.user_d = create_user()
+        self.user_e = create_user()
+        self.user_f = create_user()
+
+        # a and b are both connected with c and d, a has a pending connection
+        # with e and f is only connected with c.
+        for user_1, user_2, status in (
+                (self.user_a, self.user_c, Status.ACCEPTED),
+                (self.user_d, self.user_a, Status.ACCEPTED),
+                (self.user_b, self.user_c, Status.ACCEPTED),
+                (self.user_b, self.user_d, Status.ACCEPTED),
+                (self.user_a, self.user_e, Status.PENDING),
+                (self.user_e, self.user_c, Status.ACCEPTED),
+                (self.user_f, self.user_c, Status.ACCEPTED)):
+            UserConnection.objects.create(created_user=user_1,
+                                          with_user=user_2,
+                                          status=status)
+
+    def test_mutual_connection_ids(self):
+        """Test getting the mutual connections of two users is one query."""
+        with self.assertNumQueries(1):
+            user_ids = UserConnection.objects.mutual_connection_ids(
+                self.user_a, self.user_b.id)
+
+        self.assertEqual(user_ids, sorted([self.user_c.id, self.user_d.id]))
+
+        user_ids = UserConnection.objects.mutual_connection_ids(
+            self.user_a, self.user_c, status=None)
+        self.assertEqual(user_ids, [self.user_e.id])
+
+    def test_mutual_counts(self):
+        """Test counting mutual connections for many users is one query."""
+        candidate_ids = [self.user_b.id, self.user_e.id, self.user_f.id,
+                         self.user_d.id]
+
+        with self.assertNumQueries(1):
+            counts = UserConnection.objects.mutual_counts(self.user_a,
+                                                          candidate_ids)
+
+        self.assertEqual(counts, {self.user_b.id: 2,
+                                  self.user_e.id: 1,
+                                  self.user_f.id: 1,
+                                  self.user_d.id: 0})
+
+    def test_second_degree_suggestions(self):
+        """Test suggestions exclude existing connections and are ranked by
+        mutual connection count.
+        """
+        with self.assertNumQueries(1):
+            suggestions = UserConnection.objects.second_degree_suggestions(
+                self.user_a)
+
+        self.assertEqual(suggestions, [(self.user_b.id, 2),
+                                       (self.user_f.id, 1)])
+
+        suggestions = UserConnection.objects.second_degree_suggestions(
+            self.user_a, limit=1)
+        self.assertEqual(suggestions, [(self.user_b.id, 2)])
+
+
+@override_settings(USER_CONNECTIONS_TRACK_DEGREES=True)
+class ConnectionManagerDegreesTestCase(TestCase):
+
+    def setUp(self):
+        super(ConnectionManagerDegreesTestCase, self).setUp()
+        self.user = create_user()
+        self.user_2 = create_user()
+        self.user_3 = create_user()
+        self.UserConnectionDegree = UserConnection.get_degree_model()
+
+    def assertCounts(self, user, **counts):
+        for status, count in counts.items():
+            self.assertEqual(
+                UserConnection.objects.get_connection_count(user,
+                                                            status=status),
+                count
+            )
+
+    def test_degrees_updated(self):
+        """Test the connection counts are updated on create, transition and
+        delete.
+        """
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=self.user_2)
+        UserConnection.objects.create(created_user=self.user_3,
+                                      with_user=self.user,
+                                      status=Status.ACCEPTED)
+        self.assertCounts(self.user, PENDING=1, ACCEPTED=1)
+        self.assertCounts(self.user_2, PENDING=1, ACCEPTED=0)
+
+        conn.accept()
+        self.assertCounts(self.user, PENDING=0, ACCEPTED=2)
+        self.assertCounts(self.user_2, PENDING=0, ACCEPTED=1)
+
+        UserConnection.objects.bulk_transition(ids=[conn.id],
+                                               new_status=Status.DECLINED)
+        self.assertCounts(self.user, ACCEPTED=1, DECLINED=1)
+
+        conn.status = Status.INACTIVE
+        conn.save()
+        self.assertCounts(self.user, DECLINED=0, INACTIVE=1)
+
+        conn.delete()
+        self.assertCounts(self.user, ACCEPTED=1, INACTIVE=0)
+        self.assertCounts(self.user_2, INACTIVE=0)
+        self.assertEqual(
+            self.UserConnectionDegree.objects.verify(UserConnection), {})
+
+    def test_degrees_bulk_create(self):
+        """Test the connection counts are updated by bulk creates."""
+        UserConnection.objects.bulk_create_connections(
+            [(self.user, self.user_2), (self.user_3, self.user)])
+        self.assertCounts(self.user, PENDING=2)
+        self.assertCounts(self.user_3, PENDING=1)
+
+    def test_degrees_self_connection(self):
+        """Test a connection of a user with themselves counts once."""
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=self.user)
+        self.assertCounts(self.user, PENDING=1)
+        self.assertEqual(
+            self.UserConnectionDegree.objects.verify(UserConnection), {})
+
+        conn.accept()
+        self.assertCounts(self.user, PENDING=0, ACCEPTED=1)
+
+        self.UserConnectionDegree.objects.rebuild(UserConnection)
+        self.assertCounts(self.user, ACCEPTED=1)
+
+        conn.delete()
+        self.assertCounts(self.user, ACCEPTED=0)
+
+    def test_get_connection_count_single_query(self):
+        """Test reading the connection count is one query."""
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=self.user_2)
+
+        with self.assertNumQueries(1):
+            self.assertCounts(self.user, PENDING=1)
+
+    def test_command(self):
+        """Test the management command rebuilds and verifies the counts."""
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=self.user_2)
+        self.UserConnectionDegree.objects.all().delete()
+        out = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command('user_connection_degrees', verify=True, stdout=out)
+
+        call_command('user_connection_degrees', stdout=out)
+        call_command('user_connection_degrees', verify=True, stdout=out)
+        self.assertCounts(self.user, PENDING=1)
+        self.assertCounts(self.user_2, PENDING=1)
@@ -1,5 +1,10 @@
 from __future__ import unicode_literals
 
+from django.contrib.auth.models import Group
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 from django_testing.testcases.users import SingleUserTestCase
 from django_testing.user_utils import create_user
 from user_connections import get_user_connection_model
@@ -35,6 +40,82 @@ class UserConnectionTestCase(SingleUserTestCase):
         conn.decline()
         self.assertEqual(conn.status, Status.DECLINED)
 
+    def test_accept_keeps_activity_count(self):
+        """Test accepting a connection only writes the status so a concurrent
+        activity count increment isn't overwritten.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2,
+                                             status=Status.PENDING)
+        UserConnection.increment_activity_count_by_users(self.user.id,
+                                                         user_2.id)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(conn.accept(user=user_2))
+
+        conn = UserConnection.objects.get(id=conn.id)
+        self.assertEqual(conn.status, Status.ACCEPTED)
+        self.assertEqual(conn.last_modified_user, user_2)
+        self.assertEqual(conn.activity_count, 2)
+
+    def test_transition_from_status(self):
+        """Test a transition only happens when the connection is in one of
+        the from status'.
+        """
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2,
+                                             status=Status.DECLINED)
+
+        self.assertFalse(conn.transition(Status.ACCEPTED,
+                                         from_status=Status.PENDING))
+        self.assertEqual(conn.status, Status.DECLINED)
+        self.assertTrue(conn.transition(
+            Status.PENDING,
+            from_status=[Status.DECLINED, Status.INACTIVE]))
+        self.assertEqual(UserConnection.objects.get(id=conn.id).status,
+                         Status.PENDING)
+
+    def test_transition_unsaved(self):
+        """Test transitioning a connection that hasn't been saved yet saves
+        it with the new status.
+        """
+        user_2 = create_user()
+        conn = UserConnection(created_user=self.user, with_user=user_2)
+
+        self.assertFalse(conn.transition(Status.ACCEPTED,
+                                         from_status=Status.DECLINED))
+        self.assertIsNone(conn.id)
+        self.assertTrue(conn.accept(user=user_2))
+        self.assertEqual(UserConnection.objects.get(id=conn.id).status,
+                         Status.ACCEPTED)
+
+    def test_bulk_transition(self):
+        """Test changing the status of many connections at once."""
+        conns = [UserConnection.objects.create(created_user=self.user,
+                                               with_user=create_user(),
+                                               status=Status.PENDING)
+                 for i in range(3)]
+        conns[0].decline()
+
+        # With caching on there's one more query to get the user ids to
+        # invalidate.
+        with self.settings(USER_CONNECTIONS_CACHE=None), \
+                self.assertNumQueries(1):
+            updated = UserConnection.objects.bulk_transition(
+                ids=[c.id for c in conns],
+                new_status=Status.INACTIVE,
+                user=self.user,
+                from_status=Status.PENDING)
+
+        self.assertEqual(updated, 2)
+        statuses = dict(UserConnection.objects.filter(
+            id__in=[c.id for c in conns]).values_list('id', 'status'))
+        self.assertEqual(statuses, {conns[0].id: Status.DECLINED,
+                                    conns[1].id: Status.INACTIVE,
+                                    conns[2].id: Status.INACTIVE})
+
     def test_incremement_activity_count(self):
         """Test for incrementing the total activity count for a connection."""
         user_2 = create_user()
@@ -75,6 +156,54 @@ class UserConnectionTestCase(SingleUserTestCase):
         connections = UserConnection.objects.get_by_user_id(user_id=user_2.id)
         self.assertEqual(len(connections), 10)
 
+    def test_get_by_user_id_union(self):
+        """Test the union strategy returns the same connections as the or
+        strategy with filtering, ordering and slicing in a single query.
+        """
+        user_2 = create_user()
+
+        for i in range(6):
+            user = create_user()
+            conn = UserConnection.objects.create(
+                created_user=user_2 if i % 2 else user,
+                with_user=user if i % 2 else user_2,
+                status=Status.ACCEPTED if i < 5 else Status.PENDING
+            )
+            conn.activity_count = i % 3
+            conn.save()
+
+        for kwargs in ({}, {'status': Status.ACCEPTED}):
+            expected = UserConnection.objects.get_by_user_id(
+                user_2.id,
+                strategy='or',
+                **kwargs
+            ).order_by('-activity_count', '-id')
+            queryset = UserConnection.objects.get_by_user_id(
+                user_2.id,
+                strategy='union',
+                **kwargs
+            ).order_by('-activity_count', '-id')
+
+            self.assertEqual(list(queryset), list(expected))
+            self.assertEqual(list(queryset[1:4]), list(expected[1:4]))
+            self.assertEqual(queryset[2], expected[2])
+            self.assertEqual(queryset.count(), expected.count())
+            self.assertTrue(queryset.exists())
+            self.assertEqual(list(queryset.values_list('id', flat=True)),
+                             list(expected.values_list('id', flat=True)))
+            self.assertEqual(list(queryset.values('id', 'status')[:3]),
+                             list(expected.values('id', 'status')[:3]))
+
+        with self.assertNumQueries(1) as context:
+            list(UserConnection.objects.get_by_user_id(user_2.id,
+                                                       strategy='union')[:2])
+
+        self.assertIn('UNION ALL', context.captured_queries[0]['sql'])
+
+        with self.settings(USER_CONNECTIONS_BY_USER_STRATEGY='union'):
+            connections = UserConnection.objects.get_by_user(user_2)
+            self.assertEqual(connections.count(), 6)
+
     def test_get_connection_by_user_ids(self):
         """Test for getting a connection between 2 users."""
         user_2 = create_user()
@@ -107,6 +236,14 @@ class UserConnectionTestCase(SingleUserTestCase):
         token = UserConnection.objects.get_next_token(length=20)
         self.assertEqual(len(token), 20)
 
+    def test_signal_receivers(self):
+        """Test the signal handlers are only connected to the user
+        connection model so other models keep django's fast deletes.
+        """
+        self.assertTrue(post_save.has_listeners(UserConnection))
+        self.assertTrue(post_delete.has_listeners(UserConnection))
+        self.assertFalse(post_delete.has_listeners(Group))
+
     def test_delete_connection(self):
         """Testing deleting a connection."""
         user_2 = create_user()
@@ -133,3 +270,84 @@ class UserConnectionTestCase(SingleUserTestCase):
 
         user_3 = create_user()
         self.assertIsNone(c.get_connected_user(user_3))
+
+    def test_user_pair(self):
+        """Test the canonical user pair is the same regardless of which user
+        created the connection.
+        """
+        user_2 = create_user()
+        user_3 = create_user()
+        c_1 = UserConnection.objects.create(created_user=self.user,
+                                            with_user=user_2)
+        c_2 = UserConnection.objects.create(created_user=user_3,
+                                            with_user=self.user)
+
+        self.assertEqual((c_1.low_user_id, c_1.high_user_id),
+                         (self.user.id, user_2.id))
+        self.assertEqual((c_2.low_user_id, c_2.high_user_id),
+                         (self.user.id, user_3.id))
+
+    def test_user_pair_unique(self):
+        """Test the database doesn't allow two connections between the same
+        two users.
+        """
+        user_2 = create_user()
+        UserConnection.objects.create(created_user=self.user,
+                                      with_user=user_2)
+        conn = UserConnection(created_user=user_2,
+                              with_user=self.user,
+                              last_modified_user=user_2)
+
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, conn.save)
+
+    def test_get_for_users_single_query(self):
+        """Test getting a connection by users or user ids is one query."""
+        user_2 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+
+        with self.assertNumQueries(1):
+            conn_db = UserConnection.objects.get_for_users(user_1=user_2.id,
+                                                           user_2=self.user.id)
+
+        self.assertEqual(conn, conn_db)
+
+    def test_get_connected_user_no_queries(self):
+        """Test getting the connected user doesn't query for the other user
+        when it's already loaded or the user isn't part of the connection.
+        """
+        user_2 = create_user()
+        user_3 = create_user()
+        conn = UserConnection.objects.create(created_user=self.user,
+                                             with_user=user_2)
+        conn = UserConnection.objects.with_users().get(id=conn.id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(conn.get_connected_user_id(self.user), user_2.id)
+            self.assertEqual(conn.get_connected_user_id(user_2.id),
+                             self.user.id)
+            self.assertEqual(conn.get_connected_user(self.user), user_2)
+            self.assertIsNone(conn.get_connected_user(user_3))
+
+    def test_connected_users_for(self):
+        """Test resolving the connected users for many connections is a
+        single query.
+        """
+        users = [create_user() for i in range(3)]
+        conn_ids = [UserConnection.objects.create(created_user=self.user,
+                                                  with_user=user).id
+                    for user in users[:2]]
+        conn_ids.append(UserConnection.objects.create(created_user=users[2],
+                                                      with_user=self.user).id)
+        conns = list(UserConnection.objects.filter(id__in=conn_ids))
+
+        with self.assertNumQueries(1):
+            connected_users = UserConnection.objects.connected_users_for(
+                self.user, conns)
+            for conn in conns:
+                self.assertEqual(conn.get_connected_user(self.user),
+                                 connected_users[conn.id])
+
+        self.assertEqual(sorted(u.id for u in connected_users.values()),
+                         sorted(u.id for u in users))
@@ -0,0 +1,229 @@
+from __future__ import unicode_literals
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django_testing.testcases.users import SingleUserTestCase
+from django_testing.user_utils import create_user
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+from user_connections.forms.fields import UserConnectionChoiceField
+from user_connections.forms.fields import UserConnectionSearchChoiceField
+from user_connections.forms.fields import \
+    UserConnectionsSearchMultipleChoiceField
+from user_connections.forms.fields import UserConnectionsMultipleChoiceField
+from user_connections.mixins.forms import UserConnectionsFormMixin
+
+
+UserConnection = get_user_connection_model()
+
+
+class UserConnectionsForm(UserConnectionsFormMixin, forms.Form):
+    to_user = UserConnectionChoiceField(required=False)
+    cc_users = UserConnectionsMultipleChoiceField(required=False)
+
+
+class PrefetchedUserConnectionChoiceField(UserConnectionChoiceField):
+    user_loading_strategy = 'prefetch_related'
+
+
+class MixedLoadingUserConnectionsForm(UserConnectionsForm):
+    bcc_user = PrefetchedUserConnectionChoiceField(required=False)
+
+
+class UserConnectionFieldTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionFieldTestCase, self).setUp()
+        self.users = [create_user() for i in range(3)]
+        self.conns = [UserConnection.objects.create(created_user=self.user,
+                                                    with_user=user,
+                                                    status=Status.ACCEPTED)
+                      for user in self.users]
+
+    def test_token_lookups(self):
+        """Test getting users by token and tokens by user id."""
+        field = UserConnectionChoiceField(user=self.user,
+                                          user_connections=self.conns)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(field.get_user_by_token(self.conns[1].token),
+                             self.users[1])
+            self.assertIsNone(field.get_user_by_token('not-a-token'))
+            self.assertEqual(field.get_token_by_user_id(self.users[2].id),
+                             self.conns[2].token)
+            self.assertEqual(field.get_token_by_user_id(self.user.id), 'self')
+            self.assertIsNone(field.get_token_by_user_id(-1))
+
+    def test_clean_multiple(self):
+        """Test cleaning selected tokens returns the connected users."""
+        field = UserConnectionsMultipleChoiceField(
+            user=self.user,
+            user_connections=UserConnection.objects.get_by_user(self.user))
+        tokens = [self.conns[2].token, self.conns[0].token,
+                  self.conns[2].token]
+
+        self.assertEqual(field.clean(tokens), [self.users[2], self.users[0]])
+
+    def test_indexes_reset(self):
+        """Test the token indexes are rebuilt when the connections change."""
+        field = UserConnectionChoiceField(user=self.user,
+                                          user_connections=self.conns[:1])
+
+        self.assertIsNone(field.get_user_by_token(self.conns[1].token))
+        field.user_connections = self.conns
+        self.assertEqual(field.get_user_by_token(self.conns[1].token),
+                         self.users[1])
+
+    def test_choices_lazy(self):
+        """Test choices aren't built until they're used and then only once."""
+        with self.assertNumQueries(0):
+            field = UserConnectionChoiceField(
+                user=self.user,
+                user_connections=UserConnection.objects.get_by_user(self.user),
+                required=False)
+
+        with self.assertNumQueries(1):
+            choices = list(field.choices)
+            self.assertEqual(list(field.widget.choices), choices)
+
+        self.assertEqual(len(choices), 4)
+        self.assertEqual(choices[0][0], '')
+
+    def test_choices_exclude_user_ids(self):
+        """Test changing the excluded user ids doesn't reload connections."""
+        field = UserConnectionChoiceField(
+            user=self.user,
+            user_connections=UserConnection.objects.get_by_user(self.user))
+        list(field.choices)
+
+        with self.assertNumQueries(0):
+            field.exclude_user_ids = [self.users[0].id]
+            tokens = [token for token, name in field.choices]
+
+        self.assertNotIn(self.conns[0].token, tokens)
+        self.assertIn(self.conns[1].token, tokens)
+
+    def get_form(self, **kwargs):
+        return UserConnectionsForm(
+            user=self.user,
+            user_connections=UserConnection.objects.get_by_user(self.user),
+            **kwargs)
+
+    def test_form_fields_share_connections(self):
+        """Test all connection fields on a form share the evaluated
+        connections.
+        """
+        form = self.get_form()
+
+        with self.assertNumQueries(1):
+            html = str(form)
+
+        for conn in self.conns:
+            self.assertEqual(html.count(conn.token), 2)
+
+    def test_form_fields_loading_options(self):
+        """Test fields only share the connections with fields that load
+        the connected users the same way.
+        """
+        form = MixedLoadingUserConnectionsForm(
+            user=self.user,
+            user_connections=UserConnection.objects.get_by_user(self.user))
+        to_user_choices = form.fields['to_user'].connection_choices
+        bcc_user_choices = form.fields['bcc_user'].connection_choices
+
+        self.assertIs(form.fields['cc_users'].connection_choices,
+                      to_user_choices)
+        self.assertIsNot(bcc_user_choices, to_user_choices)
+        self.assertTrue(to_user_choices.user_connections.query.select_related)
+        self.assertTrue(
+            bcc_user_choices.user_connections._prefetch_related_lookups)
+
+        # One query for the shared connections and three for the prefetched
+        # ones.
+        with self.assertNumQueries(4):
+            html = str(form)
+
+        for conn in self.conns:
+            self.assertEqual(html.count(conn.token), 3)
+
+    def test_form_validate_queries_tokens(self):
+        """Test validating a form only loads the submitted connections."""
+        form = self.get_form(data={
+            'to_user': self.conns[0].token,
+            'cc_users': [self.conns[1].token, self.conns[2].token]
+        })
+
+        with self.assertNumQueries(2):
+            # One token query per field.
+            self.assertTrue(form.is_valid())
+
+        self.assertEqual(form.cleaned_data['to_user'], self.users[0])
+        self.assertEqual(form.cleaned_data['cc_users'], self.users[1:])
+
+    def test_validate_excluded_user(self):
+        """Test a token for an excluded user isn't valid."""
+        field = UserConnectionChoiceField(
+            user=self.user,
+            user_connections=UserConnection.objects.get_by_user(self.user),
+            exclude_user_ids=[self.users[0].id])
+
+        self.assertTrue(field.valid_value(self.conns[1].token))
+        self.assertFalse(field.valid_value(self.conns[0].token))
+
+
+class UserConnectionSearchFieldTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionSearchFieldTestCase, self).setUp()
+        self.users = [create_user(first_name=first_name)
+                      for first_name in ('Ann', 'Bob', 'Cal')]
+        self.conns = [UserConnection.objects.create(created_user=self.user,
+                                                    with_user=user,
+                                                    status=Status.ACCEPTED)
+                      for user in self.users]
+
+    def test_clean_single_query(self):
+        """Test the submitted token is resolved with a single query."""
+        field = UserConnectionSearchChoiceField(user=self.user,
+                                                search_url='/search/')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(field.clean(self.conns[1].token), self.users[1])
+
+        self.assertRaises(ValidationError, field.validate, 'not-a-token')
+
+    def test_clean_multiple(self):
+        """Test the submitted tokens are resolved with a single query."""
+        field = UserConnectionsSearchMultipleChoiceField(user=self.user)
+        tokens = [self.conns[2].token, self.conns[0].token]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(field.clean(tokens),
+                             [self.users[2], self.users[0]])
+
+    def test_list_scope(self):
+        """Test tokens are only resolved from the connections in a list of
+        user connections, without a query.
+        """
+        field = UserConnectionsSearchMultipleChoiceField(
+            user=self.user,
+            user_connections=self.conns[:2])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(field.clean([self.conns[1].token]),
+                             [self.users[1]])
+            self.assertEqual(field.get_token_by_user_id(self.users[0].id),
+                             self.conns[0].token)
+            self.assertIsNone(field.get_token_by_user_id(self.users[2].id))
+
+        self.assertRaises(ValidationError, field.clean, [self.conns[2].token])
+
+    def test_render_selected_only(self):
+        """Test only the selected connection is rendered."""
+        field = UserConnectionSearchChoiceField(user=self.user,
+                                                search_url='/search/')
+        html = field.widget.render('to_user', self.conns[0].token)
+
+        self.assertIn('data-search-url="/search/"', html)
+        self.assertIn(self.conns[0].token, html)
+        self.assertNotIn(self.conns[1].token, html)
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+
+from array import array
+from unittest import skipUnless
+import os
+import random
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django_testing.user_utils import create_user
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+from user_connections import graph
+from user_connections.graph import ConnectionGraph
+from user_connections.graph import load_connection_graph
+
+
+UserConnection = get_user_connection_model()
+
+
+class ConnectionGraphTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ConnectionGraphTestCase, cls).setUpClass()
+        # 1 - 2 - 3 - 4 and 1 - 3 with a separate 5 - 6 component
+        cls.graph = ConnectionGraph.from_edges([(1, 2), (3, 2), (3, 4),
+                                                (1, 3), (6, 5)])
+
+    def test_degrees(self):
+        """Test the degree of users and the degree distribution."""
+        self.assertEqual(len(self.graph), 6)
+        self.assertEqual(self.graph.num_connections, 5)
+        self.assertEqual(self.graph.degree(3), 3)
+        self.assertEqual(self.graph.degree(100), 0)
+        self.assertEqual(self.graph.degree_distribution(), {1: 3, 2: 2, 3: 1})
+
+    def test_neighbors(self):
+        """Test getting the neighbors and common neighbors of users."""
+        self.assertEqual(self.graph.neighbor_ids(3), [1, 2, 4])
+        self.assertEqual(self.graph.common_neighbor_ids(1, 2), [3])
+        self.assertEqual(self.graph.common_neighbor_ids(1, 5), [])
+
+    def test_bfs(self):
+        """Test breadth first search and shortest paths."""
+        self.assertEqual(dict(self.graph.bfs(4)), {4: 0, 3: 1, 1: 2, 2: 2})
+        self.assertEqual(dict(self.graph.bfs(4, max_depth=1)), {4: 0, 3: 1})
+        self.assertEqual(self.graph.shortest_path(4, 1), [4, 3, 1])
+        self.assertIsNone(self.graph.shortest_path(4, 5))
+
+    def test_connected_components(self):
+        """Test getting the connected components."""
+        components = sorted(sorted(c)
+                            for c in self.graph.connected_components())
+        self.assertEqual(components, [[1, 2, 3, 4], [5, 6]])
+
+    @skipUnless(graph.numpy, 'NumPy is not installed.')
+    def test_build_csr_numpy(self):
+        """Test the NumPy and pure python builds of a graph are the same."""
+        rand = random.Random(0)
+        edges = [(rand.randint(1, 50), rand.randint(1, 50))
+                 for i in range(200)]
+        edges += [(1000, 7)]
+
+        for build_edges in ([], [(1, 2)], edges):
+            src = array('q', [user_id for user_id, _ in build_edges])
+            dst = array('q', [user_id for _, user_id in build_edges])
+            expected = graph._build_csr(array('q', src), array('q', dst))
+            built = graph._build_csr_numpy(src, dst)
+
+            self.assertEqual(built, expected)
+
+    def test_snapshot(self):
+        """Test saving and memory mapping a graph snapshot."""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'graph.bin')
+        self.graph.save(path)
+
+        for use_mmap in (True, False):
+            graph = ConnectionGraph.load(path, use_mmap=use_mmap)
+            self.assertEqual(list(graph.node_ids), [1, 2, 3, 4, 5, 6])
+            self.assertEqual(graph.neighbor_ids(3), [1, 2, 4])
+            self.assertEqual(graph.shortest_path(4, 1), [4, 3, 1])
+
+    def test_load_connection_graph(self):
+        """Test loading accepted connections from the database in chunks."""
+        users = [create_user() for i in range(4)]
+        UserConnection.objects.create(created_user=users[0],
+                                      with_user=users[1],
+                                      status=Status.ACCEPTED)
+        UserConnection.objects.create(created_user=users[2],
+                                      with_user=users[1],
+                                      status=Status.ACCEPTED)
+        UserConnection.objects.create(created_user=users[2],
+                                      with_user=users[3],
+                                      status=Status.PENDING)
+
+        # one query per chunk plus the final empty chunk
+        with self.assertNumQueries(3):
+            graph = load_connection_graph(chunk_size=1)
+
+        self.assertEqual(graph.num_connections, 2)
+        self.assertEqual(graph.neighbor_ids(users[1].id),
+                         sorted([users[0].id, users[2].id]))
+        self.assertEqual(graph.degree(users[3].id), 0)
@@ -0,0 +1,186 @@
+from __future__ import unicode_literals
+
+from ast import literal_eval
+from unittest import skipUnless
+import re
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django_testing.user_utils import create_user
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+
+
+UserConnection = get_user_connection_model()
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+            'Query plans are only checked on SQLite and PostgreSQL.')
+class ConnectionIndexesTestCase(TestCase):
+    """Checks the query plans of the manager methods use an index on the
+    connection table instead of scanning it.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ConnectionIndexesTestCase, cls).setUpClass()
+        cls.user = create_user()
+        cls.user_2 = create_user()
+        cls.conn = UserConnection.objects.create(created_user=cls.user,
+                                                 with_user=cls.user_2,
+                                                 status=Status.ACCEPTED)
+
+    def get_query_plan(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return [row[-1] for row in cursor.fetchall()]
+
+            # Tables in tests are tiny so the planner would otherwise prefer
+            # sequential scans.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_captured_query(self, query):
+        """Gets the sql and params of a query captured with
+        CaptureQueriesContext.
+        """
+        match = re.match(r"QUERY = (.*) - PARAMS = (.*)$", query['sql'],
+                         re.DOTALL)
+
+        if match:
+            # django < 1.9 on SQLite captures the sql and params separately.
+            return literal_eval(match.group(1)), literal_eval(match.group(2))
+
+        return query['sql'], []
+
+    def assertUsesIndex(self, sql, params, model=UserConnection):
+        table = model._meta.db_table
+        plan = self.get_query_plan(sql, params)
+        table_steps = [step for step in plan if table in step]
+
+        self.assertTrue(table_steps, plan)
+
+        for step in table_steps:
+            if connection.vendor == 'sqlite':
+                # SEARCH is an index or rowid lookup, SCAN reads the whole
+                # table or index.
+                self.assertTrue(step.startswith('SEARCH'), plan)
+                self.assertTrue('INDEX' in step or 'PRIMARY KEY' in step,
+                                plan)
+            else:
+                self.assertNotIn('Seq Scan', step, plan)
+
+    def assertQuerySetUsesIndex(self, queryset):
+        self.assertUsesIndex(*queryset.query.sql_with_params())
+
+    def test_get_by_user_id(self):
+        """Test getting connections by user with both strategies."""
+        for strategy in ('or', 'union'):
+            queryset = UserConnection.objects.get_by_user_id(
+                self.user.id,
+                strategy=strategy,
+                status=Status.ACCEPTED
+            ).order_by('-activity_count', '-id')[:25]
+
+            if strategy == 'union':
+                queryset = queryset._get_union_queryset()
+
+            self.assertQuerySetUsesIndex(queryset)
+
+    def test_get_by_user_id_union(self):
+        """Test the union strategy doesn't OR the user columns or sort the
+        connections in a temporary table.
+        """
+        queryset = UserConnection.objects.get_by_user_id(
+            self.user.id,
+            strategy='union',
+            status=Status.ACCEPTED
+        ).order_by('-activity_count', '-id')[:25]
+        sql, params = queryset._get_union_queryset().query.sql_with_params()
+        plan = self.get_query_plan(sql, params)
+
+        for step in plan:
+            self.assertNotIn('MULTI-INDEX OR', step, plan)
+            self.assertNotIn('BitmapOr', step, plan)
+
+        if connection.vendor == 'sqlite':
+            # The user column queries read their rows in index order, only
+            # the outer query sorts the (at most 2 pages of) connections.
+            for step in plan[:-1]:
+                self.assertNotIn('TEMP B-TREE', step, plan)
+
+    def test_page_by_user(self):
+        """Test the keyset page queries on both user columns are index range
+        scans in index order.
+        """
+        for after in (None, '5.{0}'.format(self.conn.id)):
+            with CaptureQueriesContext(connection) as context:
+                UserConnection.objects.get_page_by_user(self.user,
+                                                        after=after,
+                                                        status=Status.ACCEPTED)
+
+            self.assertEqual(len(context.captured_queries), 2)
+
+            for query in context.captured_queries:
+                sql, params = self.get_captured_query(query)
+                self.assertUsesIndex(sql, params)
+                plan = self.get_query_plan(sql, params)
+
+                for step in plan:
+                    self.assertNotIn('MULTI-INDEX OR', step, plan)
+                    self.assertNotIn('TEMP B-TREE', step, plan)
+                    self.assertNotIn('BitmapOr', step, plan)
+                    self.assertNotIn('Sort', step, plan)
+
+    def test_get_for_users(self):
+        """Test getting a connection by the canonical user pair."""
+        low_user_id, high_user_id = UserConnection.objects.get_user_pair_ids(
+            self.user, self.user_2)
+        self.assertQuerySetUsesIndex(UserConnection.objects.filter(
+            low_user_id=low_user_id, high_user_id=high_user_id))
+
+    def test_get_by_high_user(self):
+        """Test the connections deleted with a user are found by index on
+        both user pair columns.
+        """
+        self.assertQuerySetUsesIndex(
+            UserConnection.objects.filter(low_user_id=self.user.id))
+        self.assertQuerySetUsesIndex(
+            UserConnection.objects.filter(high_user_id=self.user.id))
+
+    def test_get_by_token(self):
+        """Test getting a connection by token."""
+        self.assertQuerySetUsesIndex(
+            UserConnection.objects.filter(token=self.conn.token))
+
+    def test_search_by_user(self):
+        """Test searching a user's connections."""
+        self.assertQuerySetUsesIndex(UserConnection.objects.search_by_user(
+            self.user, 'a', status=Status.ACCEPTED))
+
+    def test_mutual_connections(self):
+        """Test the connection rows used by the mutual connection queries."""
+        self.assertUsesIndex(
+            *UserConnection.objects._connected_user_ids_sql(
+                [self.user.id, self.user_2.id], status=Status.ACCEPTED)
+        )
+
+    def test_second_degree_suggestions(self):
+        """Test the second hop only reads the connections of the user's
+        connections.
+        """
+        with CaptureQueriesContext(connection) as context:
+            UserConnection.objects.second_degree_suggestions(self.user)
+
+        self.assertUsesIndex(
+            *self.get_captured_query(context.captured_queries[0]))
+
+    def test_get_connection_count(self):
+        """Test reading a tracked connection count."""
+        UserConnectionDegree = UserConnection.get_degree_model()
+        self.assertUsesIndex(*UserConnectionDegree.objects.filter(
+            user_id=self.user.id, status=Status.ACCEPTED
+        ).query.sql_with_params(), model=UserConnectionDegree)
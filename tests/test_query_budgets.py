@@ -0,0 +1,277 @@
+from __future__ import unicode_literals
+
+from django import forms
+from django.db import connection
+from django.db import reset_queries
+from django.test.client import RequestFactory
+from django.views.generic.base import View
+from django_testing.testcases.users import SingleUserTestCase
+from django_testing.user_utils import create_user
+from user_connections import cache
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+from user_connections.forms.fields import UserConnectionChoiceField
+from user_connections.forms.fields import UserConnectionsMultipleChoiceField
+from user_connections.mixins.forms import UserConnectionsFormMixin
+from user_connections.mixins.views import UserConnectionViewMixin
+from user_connections.mixins.views import UserConnectionsByUserViewMixin
+from user_connections.mixins.views import UserConnectionsViewMixin
+from user_connections.testing import QueryBudget
+from user_connections.testing import QueryBudgetExceeded
+
+
+UserConnection = get_user_connection_model()
+
+
+class ContextView(View):
+
+    def get(self, request, *args, **kwargs):
+        return self.get_context_data()
+
+    def get_context_data(self, **kwargs):
+        return kwargs
+
+
+class UserConnectionView(UserConnectionViewMixin, ContextView):
+    pass
+
+
+class UserConnectionsView(UserConnectionsViewMixin, ContextView):
+    pass
+
+
+class UserConnectionsByUserView(UserConnectionsByUserViewMixin, ContextView):
+    pass
+
+
+class UserConnectionsForm(UserConnectionsFormMixin, forms.Form):
+    to_user = UserConnectionChoiceField(required=False)
+    cc_users = UserConnectionsMultipleChoiceField(required=False)
+
+
+class QueryBudgetTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(QueryBudgetTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.users = [create_user() for i in range(3)]
+        self.conns = [UserConnection.objects.create(created_user=self.user,
+                                                    with_user=user,
+                                                    status=Status.ACCEPTED)
+                      for user in self.users]
+        self.conn = self.conns[0]
+        self.user_2 = self.users[0]
+        UserConnection.objects.create(created_user=self.users[1],
+                                      with_user=self.users[2],
+                                      status=Status.ACCEPTED)
+        # Start from fresh objects and a cold cache.
+        self.conn = UserConnection.objects.get(id=self.conn.id)
+        cache.get_cache().clear()
+
+    def test_budget_exceeded(self):
+        """Test a call that runs more queries than its budget fails with the
+        sql it ran.
+        """
+        budget = QueryBudget({'UserConnectionManager.get_for_users': 0})
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with budget:
+                UserConnection.objects.get_for_users(self.user, self.user_2)
+
+        self.assertIn('UserConnectionManager.get_for_users ran 1 queries',
+                      str(context.exception))
+        self.assertIn('SELECT', str(context.exception))
+        self.assertEqual(budget.get_counts(),
+                         {'UserConnectionManager.get_for_users': [1]})
+
+        # The methods are restored
+        self.assertFalse(hasattr(UserConnection.objects.get_for_users,
+                                 '__wrapped__'))
+
+    def test_exact_budget(self):
+        """Test exact budgets fail when a call runs fewer queries."""
+        with QueryBudget({'UserConnectionManager.get_for_users': 2}):
+            UserConnection.objects.get_for_users(self.user, self.user_2)
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with QueryBudget({'UserConnectionManager.get_for_users': 2},
+                             exact=True):
+                UserConnection.objects.get_for_users(self.user, self.user_2)
+
+        self.assertIn('the budget is 2 exactly', str(context.exception))
+
+    def test_full_queries_log(self):
+        """Test queries are still counted once the connection's bounded
+        queries log is full.
+        """
+        queries_log = connection.queries_log
+        queries_log.extend({'sql': '', 'time': '0.000'}
+                           for i in range(queries_log.maxlen))
+
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                with QueryBudget({'UserConnectionManager.get_for_users': 0}):
+                    UserConnection.objects.get_for_users(self.user,
+                                                         self.user_2)
+        finally:
+            reset_queries()
+
+        self.assertIs(connection.queries_log, queries_log)
+
+    def test_unknown_budget(self):
+        with self.assertRaises(ValueError):
+            with QueryBudget({'UserConnectionManager.not_a_method': 1}):
+                pass
+
+    def test_decorator(self):
+        @QueryBudget({'UserConnectionManager.get_for_users': 0})
+        def get_for_users():
+            return UserConnection.objects.get_for_users(self.user,
+                                                        self.user_2)
+
+        self.assertRaises(QueryBudgetExceeded, get_for_users)
+
+    def test_manager_reads(self):
+        """Test the query counts of the manager's read methods."""
+        with QueryBudget({
+            'UserConnectionManager.get_for_users': 1,
+            'UserConnectionManager.get_by_user': 0,
+            'UserConnectionManager.get_by_user_id': 0,
+            'UserConnectionManager.get_page_by_user': 2,
+            'UserConnectionManager.search_by_user': 0,
+            'UserConnectionManager.get_connection_count': 1,
+            'UserConnectionManager.connected_users_for': 1,
+            'UserConnectionManager.mutual_connection_ids': 1,
+            'UserConnectionManager.mutual_counts': 1,
+            'UserConnectionManager.second_degree_suggestions': 1,
+            'UserConnectionManager.get_for_user_and_username': 1,
+            'UserConnectionQuerySet.page': 2,
+        }, exact=True) as budget:
+            manager = UserConnection.objects
+            manager.get_for_users(self.user, self.user_2)
+            manager.get_by_user(self.user)
+            manager.get_by_user_id(self.user.id, status=Status.ACCEPTED)
+            manager.get_page_by_user(self.user, page_size=2)
+            manager.search_by_user(self.user, self.user_2.username[:3])
+            manager.get_connection_count(self.user)
+            manager.connected_users_for(self.user, list(manager.filter(
+                id__in=[conn.id for conn in self.conns])))
+            manager.mutual_connection_ids(self.user, self.users[1])
+            manager.mutual_counts(self.user, [user.id for user in self.users])
+            manager.second_degree_suggestions(self.users[1])
+            manager.get_for_user_and_username(self.user, self.user_2.username)
+
+        # Every budgeted method was called.
+        self.assertTrue(set(budget.budgets).issubset(budget.get_counts()))
+
+    def test_cached_reads(self):
+        """Test cached reads only query the first time."""
+        with QueryBudget() as budget:
+            for i in range(2):
+                UserConnection.objects.get_user_ids(self.user.id)
+                UserConnection.objects.get_record(connection_id=self.conn.id)
+                UserConnection.objects.get_record(token=self.conn.token)
+
+        counts = budget.get_counts()
+        self.assertEqual(counts['UserConnectionManager.get_user_ids'], [1, 0])
+        self.assertEqual(counts['UserConnectionManager.get_record'],
+                         [1, 1, 0, 0])
+
+    def test_connected_user(self):
+        """Test getting the connected user only loads that user."""
+        with QueryBudget() as budget:
+            self.conn.get_connected_user(self.user)
+            self.conn.get_connected_user(self.user)
+
+        self.assertEqual(
+            budget.get_counts()['AbstractUserConnection.get_connected_user'],
+            [1, 0])
+
+    def test_writes(self):
+        """Test the query counts of creating and changing connections."""
+        user_3 = create_user()
+        user_4 = create_user()
+
+        with QueryBudget({
+            'UserConnectionManager.create': 1,
+            # The token and existence checks, the insert and its savepoint.
+            'UserConnectionManager.bulk_create_connections': 5,
+            # The update and the user ids to invalidate the cache for.
+            'UserConnectionManager.bulk_transition': 2,
+            'AbstractUserConnection.transition': 1,
+        }, exact=True) as budget:
+            conn = UserConnection.objects.create(created_user=self.user,
+                                                 with_user=user_3)
+            UserConnection.objects.get_or_create(created_user=self.user,
+                                                 with_user=user_3)
+            UserConnection.objects.bulk_create_connections(
+                [(self.user, user_4)])
+            conn.transition(Status.ACCEPTED, user=self.user)
+            UserConnection.objects.bulk_transition(
+                ids=[conn.id], new_status=Status.DECLINED, user=self.user)
+
+        # create() is a get_or_create() that inserts. Getting an existing
+        # connection is the insert that's ignored and the lookup.
+        self.assertEqual(
+            budget.get_counts()['UserConnectionManager.get_or_create'],
+            [1, 2])
+        self.assertEqual(
+            budget.get_counts()['UserConnectionManager.get_for_users'], [1])
+
+    def test_views(self):
+        """Test the query counts of the view mixins on a cold cache."""
+        def get_context(view_class, **kwargs):
+            request = RequestFactory().get('/')
+            request.user = self.user
+            return view_class.as_view()(request, **kwargs)
+
+        with QueryBudget({
+            'UserConnectionViewMixin.dispatch': 1,
+            'UserConnectionViewMixin.get_context_data': 0,
+            'UserConnectionsViewMixin.dispatch': 1,
+            'UserConnectionsViewMixin.get_context_data': 0,
+            'UserConnectionsByUserViewMixin.dispatch': 1,
+            'UserConnectionsByUserViewMixin.get_context_data': 0,
+            'UserConnectionsByUserViewMixin.get_user_connections_by_user': 1,
+            'UserConnectionsPageViewMixin.get_user_connections_page': 1,
+        }, exact=True) as budget:
+            get_context(UserConnectionView, connection_token=self.conn.token)
+            cache.get_cache().clear()
+            get_context(UserConnectionsView)
+            cache.get_cache().clear()
+            context = get_context(UserConnectionsByUserView)
+            list(context['user_connections_by_user'])
+
+        counts = budget.get_counts()
+        self.assertEqual(counts['UserConnectionsByUserViewMixin.dispatch'],
+                         [1])
+        self.assertEqual(
+            counts['UserConnectionsPageViewMixin.get_user_connections_page'],
+            [1])
+
+    def test_form_fields(self):
+        """Test building a form doesn't query, the choices of all the fields
+        are a single query and submitted tokens are a single query.
+        """
+        with QueryBudget({
+            'BaseUserConnectionFieldMixin.__init__': 0,
+            'BaseUserConnectionChoiceField.__init__': 0,
+            'UserConnectionChoices.choices': 1,
+            'UserConnectionChoices.connections': 1,
+            'BaseUserConnectionFieldMixin.validate': 1,
+        }, exact=True) as budget:
+            form = UserConnectionsForm(
+                user=self.user,
+                user_connections=UserConnection.objects.get_by_user(
+                    self.user))
+            str(form)
+
+            form = UserConnectionsForm(
+                user=self.user,
+                user_connections=UserConnection.objects.get_by_user(
+                    self.user),
+                data={'to_user': self.conn.token,
+                      'cc_users': [conn.token for conn in self.conns]})
+            self.assertTrue(form.is_valid())
+
+        self.assertIn('UserConnectionChoices.choices', budget.get_counts())
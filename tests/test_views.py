@@ -0,0 +1,274 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.http.response import Http404
+from django.test.client import RequestFactory
+from django.views.generic.base import View
+from django_testing.testcases.users import SingleUserTestCase
+from django_testing.user_utils import create_user
+from user_connections import cache
+from user_connections import get_user_connection_model
+from user_connections.constants import Status
+from user_connections.mixins.views import UserConnectionViewMixin
+from user_connections.mixins.views import UserConnectionsByUserViewMixin
+from user_connections.mixins.views import UserConnectionsPageViewMixin
+from user_connections.mixins.views import UserConnectionsViewMixin
+from user_connections.views import UserConnectionSearchView
+
+
+UserConnection = get_user_connection_model()
+
+
+class ContextView(View):
+
+    def get(self, request, *args, **kwargs):
+        return self.get_context_data()
+
+    def get_context_data(self, **kwargs):
+        return kwargs
+
+
+class UserConnectionView(UserConnectionViewMixin, ContextView):
+    pass
+
+
+class UserConnectionsView(UserConnectionsViewMixin, ContextView):
+    pass
+
+
+class PartitionedUserConnectionsView(UserConnectionsViewMixin, ContextView):
+    partition_user_connections = True
+
+
+class UserConnectionsByUserView(UserConnectionsByUserViewMixin, ContextView):
+    connections_page_size = 2
+
+
+class PartitionedUserConnectionsByUserView(UserConnectionsByUserView):
+    partition_user_connections = True
+
+
+class UserConnectionsPageView(UserConnectionsPageViewMixin, ContextView):
+    connections_page_size = 2
+
+
+class UserConnectionViewMixinTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionViewMixinTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.user_2 = create_user()
+        self.conn = UserConnection.objects.create(created_user=self.user,
+                                                  with_user=self.user_2,
+                                                  status=Status.ACCEPTED)
+
+    def get_context(self, user=None, **kwargs):
+        request = RequestFactory().get('/')
+        request.user = user or self.user
+        return UserConnectionView.as_view()(request, **kwargs)
+
+    def test_get_by_token_and_id(self):
+        """Test the connection record is cached so the ownership check
+        doesn't query the database and the connection is only loaded when
+        it's used.
+        """
+        for kwargs in ({'connection_token': self.conn.token},
+                       {'connection_id': str(self.conn.id)}):
+            self.get_context(**kwargs)
+
+            with self.assertNumQueries(0):
+                context = self.get_context(**kwargs)
+
+            with self.assertNumQueries(1):
+                self.assertEqual(context['user_connection'], self.conn)
+                self.assertEqual(context['connection_user'], self.user_2)
+
+    def test_get_by_username(self):
+        """Test getting the connection by the connected user's username is a
+        single query that also loads the connected user.
+        """
+        with self.assertNumQueries(1):
+            context = self.get_context(connection_id=self.user_2.username)
+            self.assertEqual(context['user_connection'], self.conn)
+            self.assertEqual(context['connection_user'], self.user_2)
+
+        user_3 = create_user()
+        self.assertRaises(Http404, self.get_context,
+                          connection_id=user_3.username)
+        self.assertRaises(Http404, self.get_context,
+                          connection_id='not-a-user')
+
+    def test_not_owner(self):
+        """Test users who aren't part of the connection get a 404."""
+        user_3 = create_user()
+        self.get_context(connection_token=self.conn.token)
+
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, self.get_context, user=user_3,
+                              connection_token=self.conn.token)
+
+    def test_record_invalidated(self):
+        """Test the cached record is invalidated on status changes and
+        deletes.
+        """
+        kwargs = {'connection_id': str(self.conn.id)}
+        self.get_context(**kwargs)
+        self.conn.decline()
+
+        self.assertEqual(UserConnection.objects.get_record(
+            connection_id=self.conn.id).status, Status.DECLINED)
+
+        UserConnection.objects.bulk_transition(ids=[self.conn.id],
+                                               new_status=Status.INACTIVE)
+        self.assertEqual(UserConnection.objects.get_record(
+            connection_id=self.conn.id).status, Status.INACTIVE)
+
+        self.conn.delete()
+        self.assertRaises(Http404, self.get_context, **kwargs)
+        self.assertRaises(Http404, self.get_context,
+                          connection_token=self.conn.token)
+
+
+class UserConnectionsViewMixinTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionsViewMixinTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+        for status in (Status.ACCEPTED, Status.ACCEPTED, Status.PENDING,
+                       Status.DECLINED):
+            UserConnection.objects.create(created_user=self.user,
+                                          with_user=create_user(),
+                                          status=status)
+
+        # Prime the connection user ids cache
+        UserConnection.objects.get_user_ids(user_id=self.user.id)
+
+    def test_partitioned_user_connections(self):
+        """Test all status lists are loaded with a single query."""
+        view = PartitionedUserConnectionsView.as_view()
+
+        with self.assertNumQueries(1):
+            context = view(self.request)
+            self.assertEqual(len(context['user_connections_accepted']), 2)
+            self.assertEqual(len(context['user_connections_pending']), 1)
+            self.assertEqual(len(context['user_connections_declined']), 1)
+            self.assertEqual(len(context['user_connections_inactivated']), 0)
+            counts = context['user_connection_counts']
+            self.assertEqual(counts[Status.ACCEPTED], 2)
+
+    def test_user_connection_counts(self):
+        """Test the connection counts by status are a single query."""
+        view = UserConnectionsView.as_view()
+
+        with self.assertNumQueries(1):
+            context = view(self.request)
+            counts = context['user_connection_counts']
+            self.assertEqual(counts[Status.ACCEPTED], 2)
+            self.assertEqual(counts[Status.PENDING], 1)
+            self.assertEqual(counts[Status.DECLINED], 1)
+            self.assertEqual(counts[Status.INACTIVE], 0)
+
+
+class UserConnectionsByUserViewMixinTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionsByUserViewMixinTestCase, self).setUp()
+        cache.get_cache().clear()
+        self.conns = [
+            UserConnection.objects.create(created_user=self.user,
+                                          with_user=create_user(),
+                                          status=Status.ACCEPTED,
+                                          activity_count=activity_count)
+            for activity_count in (5, 3, 3)
+        ]
+        UserConnection.objects.create(created_user=create_user(),
+                                      with_user=self.user,
+                                      status=Status.PENDING,
+                                      activity_count=10)
+        UserConnection.objects.get_user_ids(user_id=self.user.id)
+
+    def get_context(self, view_class, cursor=None):
+        request = RequestFactory().get(
+            '/', {'connections_after': cursor} if cursor else {})
+        request.user = self.user
+        return view_class.as_view()(request)
+
+    def assert_pages(self, view_class):
+        context = self.get_context(view_class)
+        self.assertEqual(list(context['user_connections_page']),
+                         [self.conns[0], self.conns[2]])
+        self.assertEqual(list(context['user_connections_by_user']),
+                         [self.conns[0].with_user_id,
+                          self.conns[2].with_user_id])
+
+        cursor = context['connections_next_cursor']()
+        self.assertEqual(cursor, '3.{0}'.format(self.conns[2].id))
+
+        context = self.get_context(view_class, cursor=cursor)
+        self.assertEqual(list(context['user_connections_page']),
+                         [self.conns[1]])
+        self.assertIsNone(context['connections_next_cursor']())
+
+    def test_pages(self):
+        """Test paging through the accepted connections by activity count."""
+        self.assert_pages(UserConnectionsByUserView)
+
+    def test_pages_partitioned(self):
+        """Test paging through connections that were already loaded."""
+        self.assert_pages(PartitionedUserConnectionsByUserView)
+
+    def test_page_loaded_once(self):
+        """Test the page is loaded with a single connections query no matter
+        how many times it's used.
+        """
+        with self.assertNumQueries(1):
+            context = self.get_context(UserConnectionsByUserView)
+            self.assertEqual(len(context['user_connections_page']), 2)
+            self.assertEqual(len(context['user_connections_by_user']), 2)
+            self.assertIsNotNone(context['connections_next_cursor']())
+
+    def test_page_view_mixin(self):
+        """Test paging through connections with the page view mixin."""
+        context = self.get_context(UserConnectionsPageView)
+        self.assertEqual(list(context['user_connections_page']),
+                         [self.conns[0], self.conns[2]])
+
+        context = self.get_context(UserConnectionsPageView,
+                                   cursor=context['connections_next_cursor']())
+        self.assertEqual(list(context['user_connections_page']),
+                         [self.conns[1]])
+        self.assertIsNone(context['connections_next_cursor']())
+
+
+class UserConnectionSearchViewTestCase(SingleUserTestCase):
+
+    def setUp(self):
+        super(UserConnectionSearchViewTestCase, self).setUp()
+        self.users = [create_user(first_name=first_name)
+                      for first_name in ('Anna', 'Andy', 'Anton', 'Bob')]
+        self.conns = [UserConnection.objects.create(created_user=user,
+                                                    with_user=self.user,
+                                                    status=Status.ACCEPTED)
+                      for user in self.users]
+
+    def search(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        view = UserConnectionSearchView.as_view(limit=2)
+        return json.loads(view(request).content.decode('utf-8'))
+
+    def test_search(self):
+        """Test searching connections by a name prefix a page at a time."""
+        response = self.search(q='an')
+        self.assertEqual([r['id'] for r in response['results']],
+                         [self.conns[2].token, self.conns[1].token])
+        self.assertEqual(response['results'][0]['user_id'], self.users[2].id)
+
+        response = self.search(q='an', cursor=response['next_cursor'])
+        self.assertEqual([r['id'] for r in response['results']],
+                         [self.conns[0].token])
+        self.assertIsNone(response['next_cursor'])
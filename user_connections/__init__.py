@@ -2,6 +2,9 @@ from django.apps import apps
 from django.core.exceptions import ImproperlyConfigured
 
 
+default_app_config = 'user_connections.apps.UserConnectionsConfig'
+
+
 def get_user_connection_model():
     """Return the UserConnection model that is active in this project.
 
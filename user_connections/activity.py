@@ -0,0 +1,297 @@
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import datetime
+from threading import Lock
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import IntegerField
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
+from django.dispatch import receiver
+
+
+_buffers = {}
+_buffers_lock = Lock()
+
+
+class ActivityCountBuffer(object):
+    """Collects activity count increments in process and writes them to the
+    database in batches.
+
+    Increments are coalesced per connection so any number of increments for
+    the same connection between flushes is a single row update, and all rows
+    are updated with one ``UPDATE ... SET activity_count = activity_count +
+    CASE ... END`` statement per batch.
+
+    The buffer is flushed when it holds ``max_size`` connections, when
+    ``flush_interval`` seconds have passed since the last flush (checked on
+    increment and at the end of each request) or when ``flush()`` is called.
+    In synchronous mode every increment is written immediately.
+
+    :param model: the user connection model class.
+    :param synchronous: boolean indicating if increments are written
+        immediately instead of being buffered.
+    :param flush_interval: the max number of seconds between flushes.
+    :param max_size: the max number of connections to buffer before flushing.
+    :param batch_size: the max number of connections updated per statement.
+    """
+
+    def __init__(self, model, synchronous=False, flush_interval=10,
+                 max_size=1000, batch_size=500):
+        self.model = model
+        self.synchronous = synchronous
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._counts_by_id = defaultdict(int)
+        self._counts_by_user_pair = defaultdict(int)
+        self._lock = Lock()
+        self._last_flush = time.time()
+        self.stats = {
+            'flushes': 0,
+            'flushed_increments': 0,
+            'flushed_rows': 0,
+            'last_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+            'total_flush_seconds': 0.0,
+        }
+
+    def __len__(self):
+        return len(self._counts_by_id) + len(self._counts_by_user_pair)
+
+    def increment(self, connection_id, count=1):
+        """Increments the activity count for a connection by id.
+
+        :return: False if the buffer is synchronous and no connection was
+            found. Otherwise, True.
+        """
+        if self.synchronous:
+            return self._increment_now(count, id=connection_id)
+
+        with self._lock:
+            self._counts_by_id[connection_id] += count
+
+        self.flush_if_due()
+        return True
+
+    def increment_by_users(self, user_id_1, user_id_2, count=1):
+        """Increments the activity count for the connection between two users.
+
+        :return: False if the buffer is synchronous and no connection was
+            found. Otherwise, True.
+        """
+        low_user_id, high_user_id = self.model.objects.get_user_pair_ids(
+            user_id_1, user_id_2)
+
+        if self.synchronous:
+            return self._increment_now(count, low_user_id=low_user_id,
+                                       high_user_id=high_user_id)
+
+        with self._lock:
+            self._counts_by_user_pair[(low_user_id, high_user_id)] += count
+
+        self.flush_if_due()
+        return True
+
+    def _increment_now(self, count, **kwargs):
+        """Increments the activity count of a connection with a single
+        UPDATE statement.
+
+        :param kwargs: the filter for the connection.
+        :return: boolean indicating if a connection was updated.
+        """
+        return self.model.objects.filter(**kwargs).update(
+            activity_count=F('activity_count') + count,
+            last_modified_dttm=datetime.utcnow()
+        ) > 0
+
+    def is_flush_due(self):
+        """Boolean indicating if the buffer should be flushed."""
+        if not len(self):
+            return False
+
+        return (len(self) >= self.max_size or
+                time.time() - self._last_flush >= self.flush_interval)
+
+    def flush_if_due(self):
+        """Flushes the buffer if it's full or the flush interval has passed.
+
+        :return: the number of connections updated.
+        """
+        if not self.is_flush_due():
+            return 0
+
+        return self.flush()
+
+    def flush(self):
+        """Writes all buffered increments to the database.
+
+        :return: the number of connections updated.
+        """
+        with self._lock:
+            counts_by_id = self._counts_by_id
+            counts_by_user_pair = self._counts_by_user_pair
+            self._counts_by_id = defaultdict(int)
+            self._counts_by_user_pair = defaultdict(int)
+            self._last_flush = time.time()
+
+        if not counts_by_id and not counts_by_user_pair:
+            return 0
+
+        start = time.time()
+        increments = (sum(counts_by_id.values()) +
+                      sum(counts_by_user_pair.values()))
+        connection_ids = list(counts_by_id)
+        updated = 0
+        # The index of the first connection that hasn't been written.
+        i = 0
+
+        try:
+            if counts_by_user_pair:
+                counts_by_id = self._merge_user_pair_counts(
+                    counts_by_id, counts_by_user_pair)
+                counts_by_user_pair = {}
+                connection_ids = list(counts_by_id)
+
+            for i in range(0, len(connection_ids), self.batch_size):
+                updated += self._update_counts(
+                    {conn_id: counts_by_id[conn_id]
+                     for conn_id in connection_ids[i:i + self.batch_size]}
+                )
+        except Exception:
+            # Put the counts that weren't written back in the buffer so
+            # they're written by the next flush instead of being lost.
+            with self._lock:
+                for conn_id in connection_ids[i:]:
+                    self._counts_by_id[conn_id] += counts_by_id[conn_id]
+
+                for user_pair, count in counts_by_user_pair.items():
+                    self._counts_by_user_pair[user_pair] += count
+
+            raise
+
+        seconds = time.time() - start
+
+        with self._lock:
+            self.stats['flushes'] += 1
+            self.stats['flushed_increments'] += increments
+            self.stats['flushed_rows'] += updated
+            self.stats['last_flush_seconds'] = seconds
+            self.stats['total_flush_seconds'] += seconds
+            self.stats['max_flush_seconds'] = max(
+                self.stats['max_flush_seconds'], seconds)
+
+        return updated
+
+    def _merge_user_pair_counts(self, counts_by_id, counts_by_user_pair):
+        """Resolves the user pair keyed counts to connection ids and merges
+        them with the connection id keyed counts into a new dict.
+        """
+        counts_by_id = defaultdict(int, counts_by_id)
+        user_pairs = list(counts_by_user_pair)
+
+        for i in range(0, len(user_pairs), self.batch_size):
+            q = Q()
+            for low_user_id, high_user_id in user_pairs[i:i + self.batch_size]:
+                q |= Q(low_user_id=low_user_id, high_user_id=high_user_id)
+
+            conns = self.model.objects.filter(q).values_list('id',
+                                                             'low_user_id',
+                                                             'high_user_id')
+            for conn_id, low_user_id, high_user_id in conns:
+                counts_by_id[conn_id] += counts_by_user_pair[(low_user_id,
+                                                              high_user_id)]
+
+        return counts_by_id
+
+    def _update_counts(self, counts_by_id):
+        """Adds the counts to the connections in a single UPDATE statement.
+        The last modified datetime is set to when the counts are written.
+
+        :param counts_by_id: dict of connection ids to the count to add.
+        :return: the number of connections updated.
+        """
+        ids_by_count = defaultdict(list)
+        for conn_id, count in counts_by_id.items():
+            ids_by_count[count].append(conn_id)
+
+        increment = Case(*[When(id__in=ids, then=Value(count))
+                           for count, ids in ids_by_count.items()],
+                         output_field=IntegerField())
+        return self.model.objects.filter(id__in=list(counts_by_id)).update(
+            activity_count=F('activity_count') + increment,
+            last_modified_dttm=datetime.utcnow()
+        )
+
+
+def get_activity_count_buffer(model):
+    """Gets the activity count buffer for a user connection model. The buffer
+    is configured with the following settings:
+
+    * USER_CONNECTIONS_ACTIVITY_BUFFER: boolean indicating if activity counts
+        are buffered. Default is False which writes every increment
+        immediately.
+    * USER_CONNECTIONS_ACTIVITY_FLUSH_INTERVAL: the max number of seconds
+        between flushes. Default is 10.
+    * USER_CONNECTIONS_ACTIVITY_MAX_SIZE: the max number of connections to
+        buffer before flushing. Default is 1000.
+
+    The settings are read on every call. When they change, the model's buffer
+    is replaced and the increments of the old buffer are written.
+    """
+    options = {
+        'synchronous': not getattr(settings,
+                                   'USER_CONNECTIONS_ACTIVITY_BUFFER',
+                                   False),
+        'flush_interval': getattr(settings,
+                                  'USER_CONNECTIONS_ACTIVITY_FLUSH_INTERVAL',
+                                  10),
+        'max_size': getattr(settings,
+                            'USER_CONNECTIONS_ACTIVITY_MAX_SIZE',
+                            1000),
+    }
+
+    with _buffers_lock:
+        old_buffer = _buffers.get(model)
+
+        if old_buffer is not None and all(
+                getattr(old_buffer, name) == value
+                for name, value in options.items()):
+            return old_buffer
+
+        buffer = _buffers[model] = ActivityCountBuffer(model=model, **options)
+
+    if old_buffer is not None:
+        old_buffer.flush()
+
+    return buffer
+
+
+def flush_activity_counts():
+    """Flushes all activity count buffers. Call this before the process exits
+    or from a periodic task to make sure no increments are lost.
+
+    :return: the number of connections updated.
+    """
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+
+    return sum(buffer.flush() for buffer in buffers)
+
+
+@receiver(request_finished)
+def flush_activity_counts_if_due(**kwargs):
+    """Flushes any activity count buffers that are due at the end of a
+    request.
+    """
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+
+    for buffer in buffers:
+        buffer.flush_if_due()
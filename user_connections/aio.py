@@ -0,0 +1,277 @@
+"""Async API for user connections.
+
+Django's ORM is synchronous so every database call has to run in a thread
+outside of the event loop. ``run_sync`` runs it with asgiref's thread
+sensitive ``sync_to_async`` when asgiref is installed or otherwise in a single
+dedicated thread so database connections are reused the same way. Like a
+request, each call in the dedicated thread closes the thread's database
+connections that are unusable or older than ``CONN_MAX_AGE`` before and after
+it runs.
+
+Each thread hop is expensive so ``UserConnectionLoader`` batches the
+``aget_for_users`` and ``aget_user_ids`` calls made during the same event
+loop tick into a single ``IN`` query and a single thread hop.
+
+This module requires python 3.5+.
+"""
+from __future__ import unicode_literals
+
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import weakref
+
+from django.db import close_old_connections
+from django.db.models.query_utils import Q
+
+from . import cache
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # pragma: no cover
+    sync_to_async = None
+
+
+_executor = None
+_loaders = weakref.WeakKeyDictionary()
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        # A single thread so every call uses the same database connection,
+        # like asgiref's thread sensitive mode.
+        _executor = ThreadPoolExecutor(max_workers=1)
+
+    return _executor
+
+
+def _call_with_connection_checks(func, *args, **kwargs):
+    """Calls a function in the executor thread the same way a request
+    handler does, so the thread's connections are closed when they're broken
+    or past their max age instead of being held forever.
+    """
+    close_old_connections()
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args, **kwargs):
+    """Runs a synchronous function, like an ORM call, outside of the event
+    loop and returns its result.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(func)(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _get_executor(),
+        partial(_call_with_connection_checks, func, *args, **kwargs)
+    )
+
+
+class UserConnectionLoader(object):
+    """DataLoader style batcher for user connection lookups.
+
+    Calls made before the event loop gets to run the scheduled batch, which is
+    all the calls made in the same tick (for example the coroutines of an
+    ``asyncio.gather``), are resolved together with one query per lookup type
+    in a single thread hop.
+
+    :param model: the user connection model class.
+    :param cache_results: boolean indicating if results are memoized by the
+        loader so loading the same key again doesn't query again. Only use
+        this for short lived loaders, like one per request.
+    """
+
+    def __init__(self, model, cache_results=False):
+        self.model = model
+        self.cache_results = cache_results
+        self._pending_for_users = {}
+        self._pending_user_ids = {}
+        self._results = {}
+        self._is_scheduled = False
+
+    def clear(self):
+        """Clears the memoized results."""
+        self._results = {}
+
+    async def load_for_users(self, user_1, user_2):
+        """Gets the connection between two users or None if they aren't
+        connected. See UserConnectionManager.get_for_users.
+        """
+        user_pair = self.model.objects.get_user_pair_ids(user_1, user_2)
+        return await self._load(self._pending_for_users,
+                                ('for_users', user_pair))
+
+    async def load_user_ids(self, user_id, status=None):
+        """Gets the ids of the users a user has connections with. See
+        UserConnectionManager.get_user_ids.
+        """
+        return await self._load(self._pending_user_ids,
+                                ('user_ids', (user_id, status)))
+
+    async def _load(self, pending, key):
+        if key in self._results:
+            return self._results[key]
+
+        if key not in pending:
+            pending[key] = asyncio.get_event_loop().create_future()
+            self._schedule()
+
+        result = await pending[key]
+
+        if self.cache_results:
+            self._results[key] = result
+
+        return result
+
+    def _schedule(self):
+        if self._is_scheduled:
+            return
+
+        self._is_scheduled = True
+        loop = asyncio.get_event_loop()
+        loop.call_soon(lambda: loop.create_task(self._dispatch()))
+
+    async def _dispatch(self):
+        self._is_scheduled = False
+        pending_for_users = self._pending_for_users
+        pending_user_ids = self._pending_user_ids
+        self._pending_for_users = {}
+        self._pending_user_ids = {}
+        pending = dict(pending_for_users)
+        pending.update(pending_user_ids)
+
+        try:
+            results = await run_sync(self._load_batch,
+                                     [key[1] for key in pending_for_users],
+                                     [key[1] for key in pending_user_ids])
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+    def _load_batch(self, user_pairs, user_id_keys):
+        """Runs the batch queries. This runs in a thread outside of the event
+        loop.
+
+        :return: dict of loader key to result.
+        """
+        results = {}
+
+        if user_pairs:
+            conns = self.model.objects.filter(
+                low_user_id__in=set(pair[0] for pair in user_pairs),
+                high_user_id__in=set(pair[1] for pair in user_pairs)
+            )
+            conns_by_pair = dict(((conn.low_user_id, conn.high_user_id), conn)
+                                 for conn in conns)
+
+            for user_pair in user_pairs:
+                results[('for_users', user_pair)] = conns_by_pair.get(
+                    user_pair)
+
+        user_ids_by_status = defaultdict(list)
+
+        for user_id, status in user_id_keys:
+            conn_user_ids = cache.get_user_ids(user_id, status=status)
+
+            if conn_user_ids is None:
+                user_ids_by_status[status].append(user_id)
+            else:
+                results[('user_ids', (user_id, status))] = conn_user_ids
+
+        for status, user_ids in user_ids_by_status.items():
+            queryset = self.model.objects.filter(
+                Q(created_user_id__in=user_ids) | Q(with_user_id__in=user_ids))
+
+            if status:
+                queryset = queryset.filter(status=status)
+
+            conn_user_ids = dict((user_id, set()) for user_id in user_ids)
+
+            for created_user_id, with_user_id in queryset.values_list(
+                    'created_user_id', 'with_user_id'):
+                if created_user_id in conn_user_ids:
+                    conn_user_ids[created_user_id].add(with_user_id)
+
+                if with_user_id in conn_user_ids:
+                    conn_user_ids[with_user_id].add(created_user_id)
+
+            for user_id, user_id_set in conn_user_ids.items():
+                user_id_set.discard(user_id)
+                user_id_list = list(user_id_set)
+                cache.set_user_ids(user_id, user_id_list, status=status)
+                results[('user_ids', (user_id, status))] = user_id_list
+
+        return results
+
+
+def get_loader(model):
+    """Gets the loader used by the async manager methods for the current
+    event loop. The loader batches calls but doesn't memoize results.
+    """
+    loop = asyncio.get_event_loop()
+    loaders = _loaders.setdefault(loop, {})
+
+    if model not in loaders:
+        loaders[model] = UserConnectionLoader(model)
+
+    return loaders[model]
+
+
+class AsyncUserConnectionManagerMixin(object):
+    """Async counterparts of the UserConnectionManager methods."""
+
+    async def aget_for_users(self, user_1, user_2):
+        """See UserConnectionManager.get_for_users. Concurrent calls are
+        batched into a single query.
+        """
+        return await get_loader(self.model).load_for_users(user_1, user_2)
+
+    async def aget_user_ids(self, user_id, **kwargs):
+        """See UserConnectionManager.get_user_ids. Concurrent calls filtered
+        by at most ``status`` are batched into a single query.
+        """
+        if not set(kwargs).issubset(('status',)):
+            return await run_sync(self.get_user_ids, user_id, **kwargs)
+
+        return await get_loader(self.model).load_user_ids(
+            user_id, status=kwargs.get('status'))
+
+    async def aget_by_user_id(self, user_id, **kwargs):
+        """Gets the list of connections for a user. See
+        UserConnectionManager.get_by_user_id.
+        """
+        return await run_sync(
+            lambda: list(self.get_by_user_id(user_id, **kwargs)))
+
+    async def aget_or_create(self, created_user, with_user, **kwargs):
+        """See UserConnectionManager.get_or_create."""
+        return await run_sync(self.get_or_create, created_user, with_user,
+                              **kwargs)
+
+    async def atransition(self, connection, status, user=None,
+                          from_status=None):
+        """Changes the status of a connection. See
+        AbstractUserConnection.transition.
+        """
+        return await run_sync(connection.transition, status, user=user,
+                              from_status=from_status)
+
+    async def abulk_transition(self, ids, new_status, user=None,
+                               from_status=None):
+        """See UserConnectionQuerySet.bulk_transition."""
+        return await run_sync(self.bulk_transition, ids, new_status,
+                              user=user, from_status=from_status)
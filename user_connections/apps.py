@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+
+class UserConnectionsConfig(AppConfig):
+    name = 'user_connections'
+    verbose_name = 'User Connections'
+
+    def ready(self):
+        """Connects the signal handlers to the user connection model only so
+        saves and deletes of other models don't call them. A post_delete
+        receiver for every model would also turn off django's fast deletes.
+        """
+        from . import get_user_connection_model
+        from .models import user_connection_post_delete
+        from .models import user_connection_post_save
+
+        model = get_user_connection_model()
+        post_save.connect(user_connection_post_save, sender=model,
+                          dispatch_uid='user_connection_post_save')
+        post_delete.connect(user_connection_post_delete, sender=model,
+                            dispatch_uid='user_connection_post_delete')
@@ -0,0 +1,215 @@
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .constants import Status
+
+
+class ConnectionRecord(namedtuple('ConnectionRecord',
+                                  'id created_user_id with_user_id status')):
+    """Compact, cacheable record of a connection with just enough to decide if
+    a user is part of the connection.
+    """
+    __slots__ = ()
+
+    @property
+    def user_ids(self):
+        """Gets the user ids of the two users connected."""
+        return [self.created_user_id, self.with_user_id]
+
+
+def get_cache():
+    """Gets the cache backend used for user connection data or None if
+    caching has been disabled.
+
+    The backend is the cache alias set by the ``USER_CONNECTIONS_CACHE``
+    setting. Defaults to None which turns caching off. Invalidation only
+    clears the configured cache so it has to be shared by all processes, like
+    memcached or redis, not the per process local memory cache.
+    """
+    alias = getattr(settings, 'USER_CONNECTIONS_CACHE', None)
+
+    if alias is None:
+        return None
+
+    return caches[alias]
+
+
+def get_cache_timeout():
+    """Gets the number of seconds cached values live for. Cached values are
+    invalidated when connections change so this can be fairly long.
+    """
+    return getattr(settings, 'USER_CONNECTIONS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def get_key_prefix():
+    """Gets the prefix for all cache keys. Set with the
+    USER_CONNECTIONS_CACHE_KEY_PREFIX setting.
+    """
+    return getattr(settings, 'USER_CONNECTIONS_CACHE_KEY_PREFIX',
+                   'user_connections')
+
+
+def delete_many(keys, using=None):
+    """Deletes cache keys right away and, inside a transaction, again once
+    the transaction commits. Deleting right away keeps reads later in the
+    transaction from getting stale values and deleting on commit removes the
+    values other requests cached from the data before the commit. The delete
+    on commit needs django 1.9+, older versions only delete right away.
+
+    :param keys: the cache keys to delete.
+    :param using: the alias of the database whose transaction the change was
+        made in. Defaults to the default database.
+    """
+    cache = get_cache()
+
+    if cache is None or not keys:
+        return
+
+    cache.delete_many(keys)
+
+    if (hasattr(transaction, 'on_commit') and
+            transaction.get_connection(using).in_atomic_block):
+        transaction.on_commit(partial(cache.delete_many, keys), using=using)
+
+
+def get_user_ids_cache_key(user_id, status=None):
+    """Gets the cache key for the connected user ids of a user.
+
+    :param user_id: the id of the user the connections are for.
+    :param status: the connection status the user ids are filtered by. None
+        means all status'.
+    """
+    return '{0}:user_ids:{1}:{2}'.format(get_key_prefix(), user_id,
+                                         status or 'all')
+
+
+def get_user_ids_cache_keys(user_id):
+    """Gets all the user id cache keys (one per status variant) for a user."""
+    keys = [get_user_ids_cache_key(user_id)]
+    keys += [get_user_ids_cache_key(user_id, status=status)
+             for status, label in Status.CHOICES]
+    return keys
+
+
+def get_user_ids(user_id, status=None):
+    """Gets the cached connected user ids for a user or None if they haven't
+    been cached yet.
+    """
+    cache = get_cache()
+
+    if cache is None:
+        return None
+
+    return cache.get(get_user_ids_cache_key(user_id, status=status))
+
+
+def set_user_ids(user_id, user_ids, status=None):
+    """Caches the connected user ids for a user."""
+    cache = get_cache()
+
+    if cache is None:
+        return
+
+    cache.set(get_user_ids_cache_key(user_id, status=status),
+              user_ids,
+              get_cache_timeout())
+
+
+def invalidate_user_ids(*user_ids, **kwargs):
+    """Removes all cached connected user ids for the users. See delete_many.
+
+    :param user_ids: the ids of the users to invalidate the cache for.
+    :param using: the alias of the database the connections changed in.
+    """
+    keys = []
+    for user_id in set(user_ids):
+        keys += get_user_ids_cache_keys(user_id)
+
+    delete_many(keys, using=kwargs.get('using'))
+
+
+def get_connection_record_cache_key(connection_id):
+    """Gets the cache key for the record of a connection."""
+    return '{0}:connection:{1}'.format(get_key_prefix(), connection_id)
+
+
+def get_connection_token_cache_key(token):
+    """Gets the cache key for the connection id of a connection token."""
+    return '{0}:connection_token:{1}'.format(get_key_prefix(), token)
+
+
+def get_connection_record(connection_id):
+    """Gets the cached ConnectionRecord for a connection id or None if it
+    hasn't been cached.
+    """
+    cache = get_cache()
+
+    if cache is None:
+        return None
+
+    record = cache.get(get_connection_record_cache_key(connection_id))
+    return ConnectionRecord(*record) if record is not None else None
+
+
+def set_connection_record(record):
+    """Caches a ConnectionRecord."""
+    cache = get_cache()
+
+    if cache is None:
+        return
+
+    cache.set(get_connection_record_cache_key(record.id),
+              tuple(record),
+              get_cache_timeout())
+
+
+def invalidate_connection_records(*connection_ids, **kwargs):
+    """Removes the cached records for the connections. See delete_many.
+
+    :param using: the alias of the database the connections changed in.
+    """
+    delete_many([get_connection_record_cache_key(connection_id)
+                 for connection_id in set(connection_ids)],
+                using=kwargs.get('using'))
+
+
+def get_connection_id_for_token(token):
+    """Gets the cached connection id for a token or None if it hasn't been
+    cached.
+    """
+    cache = get_cache()
+
+    if cache is None:
+        return None
+
+    return cache.get(get_connection_token_cache_key(token))
+
+
+def set_connection_id_for_token(token, connection_id):
+    """Caches the connection id for a token. Tokens never change so this is
+    only invalidated when the connection is deleted.
+    """
+    cache = get_cache()
+
+    if cache is None:
+        return
+
+    cache.set(get_connection_token_cache_key(token),
+              connection_id,
+              get_cache_timeout())
+
+
+def invalidate_connection_tokens(*tokens, **kwargs):
+    """Removes the cached connection ids for the tokens. See delete_many.
+
+    :param using: the alias of the database the connections were deleted in.
+    """
+    delete_many([get_connection_token_cache_key(token)
+                 for token in set(tokens)],
+                using=kwargs.get('using'))
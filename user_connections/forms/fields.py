@@ -1,15 +1,129 @@
+from collections import OrderedDict
+
 from django.core.exceptions import ValidationError
+from django.db.models.query import QuerySet
 from django.forms.fields import ChoiceField
 from django.forms.fields import MultipleChoiceField
 from django.forms.widgets import CheckboxSelectMultiple
+from django.utils.encoding import force_text
+from django.utils.functional import cached_property
 from django.utils.six import string_types
 from django.utils.translation import ugettext as _
 
+from .. import get_user_connection_model
+from ..constants import Status
+from .widgets import UserConnectionSearchSelect
+from .widgets import UserConnectionSearchSelectMultiple
+
+
+class UserConnectionChoices(object):
+    """The evaluated user connections and the sorted choices for them. This
+    is built lazily and only once, so it can be shared by all the user
+    connection fields on a form.
+
+    :param user: this is the user the connections are for.
+    :param user_connections: iterable of user connections.
+    :param user_loading_strategy: how the connected users are loaded when
+        user_connections is a queryset that doesn't already load them. See
+        UserConnectionQuerySet.with_users.
+    :param user_fields: the user fields to load. See
+        UserConnectionQuerySet.with_users.
+    """
+
+    def __init__(self, user, user_connections, user_loading_strategy=None,
+                 user_fields=None):
+        if (hasattr(user_connections, 'with_users') and
+                user_connections._result_cache is None and
+                not user_connections.query.select_related and
+                not user_connections._prefetch_related_lookups):
+            # The connected user is needed for every connection.
+            user_connections = user_connections.with_users(
+                strategy=user_loading_strategy,
+                user_fields=user_fields)
+
+        self.user = user
+        self.user_connections = user_connections
+
+    @property
+    def is_evaluated(self):
+        """Boolean indicating if the user connections have been loaded."""
+        return ('connections' in self.__dict__ or
+                isinstance(self.user_connections, (list, tuple)) or
+                getattr(self.user_connections, '_result_cache', None)
+                is not None)
+
+    @cached_property
+    def connections(self):
+        """The list of user connections."""
+        if self.user_connections is None:
+            return []
+
+        return list(self.user_connections)
+
+    @cached_property
+    def choices(self):
+        """List of (connection token, connected user's full name, connected
+        user id) tuples sorted by the user's full name.
+        """
+        choices = []
+        UserConnection = get_user_connection_model()
+        connected_users = UserConnection.objects.connected_users_for(
+            self.user, self.connections)
+
+        for conn in self.connections:
+            conn_user = connected_users[conn.id]
+            choices.append((conn.token, conn_user.get_full_name(),
+                            conn_user.id))
+
+        choices.sort(key=lambda k: k[1])
+        return choices
+
+    def _build_connection_indexes(self):
+        """Builds the token to connection and user id to token indexes for the
+        user connections in a single pass so lookups don't have to iterate all
+        the connections.
+        """
+        connections_by_token = {}
+        tokens_by_user_id = {}
+
+        for connection in self.connections:
+            connections_by_token.setdefault(connection.token, connection)
+
+            for user_id in connection.user_ids:
+                tokens_by_user_id.setdefault(user_id, connection.token)
+
+        self.__dict__['connections_by_token'] = connections_by_token
+        self.__dict__['tokens_by_user_id'] = tokens_by_user_id
+
+    @cached_property
+    def connections_by_token(self):
+        """Dict of connection token to connection."""
+        self._build_connection_indexes()
+        return self.__dict__['connections_by_token']
+
+    @cached_property
+    def tokens_by_user_id(self):
+        """Dict of user id to the token of the connection with that user."""
+        self._build_connection_indexes()
+        return self.__dict__['tokens_by_user_id']
+
 
 class BaseUserConnectionFieldMixin(object):
     """Does all the leg work for figuring out which user connection choices
     to display when the field is rendered.
+
+    The choices are only built when they're first used (rendering or
+    validation) and are memoized until the user, user connections or excluded
+    user ids change.
+
+    * user_loading_strategy: how the connected users are loaded when
+        user_connections is a queryset that doesn't already load them. See
+        UserConnectionQuerySet.with_users.
+    * user_fields: the user fields to load. See
+        UserConnectionQuerySet.with_users.
     """
+    user_loading_strategy = None
+    user_fields = None
 
     def __init__(self, user_connections=None, user=None,
                  exclude_user_ids=None, include_user_choice=False,
@@ -27,13 +141,21 @@ class BaseUserConnectionFieldMixin(object):
         self.exclude_user_ids = exclude_user_ids
         self.user = user
         self.user_connections = user_connections
+        self.choices = self._get_lazy_choices
+
+    def __deepcopy__(self, memo):
+        result = super(BaseUserConnectionFieldMixin, self).__deepcopy__(memo)
+        result._reset_choices()
+        # Point the copied field and widget choices at the copied field.
+        result.choices = result._get_lazy_choices
+        return result
 
     def _get_user_connections(self):
         return getattr(self, '_user_connections', None)
 
     def _set_user_connections(self, value):
         self._user_connections = value
-        self._update_choices()
+        self._reset_choices()
 
     user_connections = property(_get_user_connections, _set_user_connections)
 
@@ -42,7 +164,7 @@ class BaseUserConnectionFieldMixin(object):
 
     def _set_exclude_user_ids(self, value):
         self._exclude_user_ids = value
-        self._update_choices()
+        self._reset_choices(keep_connection_choices=True)
 
     exclude_user_ids = property(_get_exclude_user_ids, _set_exclude_user_ids)
 
@@ -51,18 +173,113 @@ class BaseUserConnectionFieldMixin(object):
 
     def _set_user(self, value):
         self._user = value
-        self._update_choices()
+        self._reset_choices()
 
     user = property(_get_user, _set_user)
 
-    def _update_choices(self):
-        if self.user and self._user_connections:
-            self.choices = self.get_user_connection_choices()
-        else:
-            self.choices = ()
+    def get_connection_choices_key(self):
+        """Gets the key of the options the connection choices are built with.
+        Fields with the same key can share a UserConnectionChoices object.
+        """
+        return (self.user_loading_strategy,
+                tuple(self.user_fields) if self.user_fields is not None
+                else None)
+
+    def _get_connection_choices(self):
+        if getattr(self, '_connection_choices', None) is None:
+            self._connection_choices = UserConnectionChoices(
+                user=self.user,
+                user_connections=self.user_connections,
+                user_loading_strategy=self.user_loading_strategy,
+                user_fields=self.user_fields)
+
+        return self._connection_choices
+
+    def _set_connection_choices(self, value):
+        """Sets the user, user connections and the evaluated connections and
+        choices from a UserConnectionChoices object that can be shared with
+        other fields that have the same connection choices key.
+        """
+        self._user = value.user
+        self._user_connections = value.user_connections
+        self._reset_choices()
+        self._connection_choices = value
+
+    connection_choices = property(_get_connection_choices,
+                                  _set_connection_choices)
+
+    def _reset_choices(self, keep_connection_choices=False):
+        if not keep_connection_choices:
+            self._connection_choices = None
+
+        self._choices_cache = None
+        self._choice_values = None
+        self._resolved_connections = {}
+
+    def _get_lazy_choices(self):
+        if getattr(self, '_choices_cache', None) is None:
+            self._choices_cache = self._build_choices()
+            self._choice_values = set(force_text(value)
+                                      for value, label in self._choices_cache)
+
+        return self._choices_cache
 
+    def _build_choices(self):
+        choices = self.get_extra_choices()
+
+        if self.user and self.user_connections is not None:
+            choices += self.get_user_connection_choices()
+
+        return choices
+
+    def get_extra_choices(self):
+        """Gets the choices that aren't user connections."""
         if self.include_user_choice:
-            self.choices.insert(0, ('self', _('Me')))
+            return [('self', _('Me'))]
+
+        return []
+
+    def validate(self, value):
+        if self.should_query_tokens():
+            # Resolve all the submitted tokens with one query before they're
+            # validated one at a time.
+            tokens = value if isinstance(value, (list, tuple)) else [value]
+            self.get_connections_for_tokens(force_text(token)
+                                            for token in tokens if token)
+
+        super(BaseUserConnectionFieldMixin, self).validate(value)
+
+    def valid_value(self, value):
+        """Checks to see if the value is a valid choice without iterating all
+        the choices.
+        """
+        value = force_text(value)
+
+        if not self.should_query_tokens():
+            self._get_lazy_choices()
+            return value in self._choice_values
+
+        return self.is_valid_token(value)
+
+    def is_valid_token(self, value):
+        """Checks if the value is an extra choice or the token of one of the
+        user connections that isn't excluded by resolving the token.
+        """
+        if value in set(force_text(choice_value) for choice_value, label
+                        in self.get_extra_choices()):
+            return True
+
+        connection = self.get_connections_for_tokens([value]).get(value)
+
+        if connection is None:
+            return False
+
+        if connection.created_user_id == self.user.id:
+            conn_user_id = connection.with_user_id
+        else:
+            conn_user_id = connection.created_user_id
+
+        return conn_user_id not in (self.exclude_user_ids or ())
 
     def get_user_connection_choices(self):
         """
@@ -81,21 +298,77 @@ class BaseUserConnectionFieldMixin(object):
 
         """
         if self.exclude_user_ids is None:
-            exclude_user_ids = []
+            exclude_user_ids = set()
         else:
-            exclude_user_ids = self.exclude_user_ids
+            exclude_user_ids = set(self.exclude_user_ids)
 
-        connections = []
+        return [(token, full_name)
+                for token, full_name, user_id
+                in self.connection_choices.choices
+                if user_id not in exclude_user_ids]
 
-        for conn in self.user_connections:
-            conn_user = conn.get_connected_user(self.user)
-            if conn_user.id in exclude_user_ids:
-                continue
+    def get_connections_by_token(self):
+        """Gets a dict of connection token to connection."""
+        return self.connection_choices.connections_by_token
 
-            connections.append((conn.token, conn_user.get_full_name()))
+    def get_tokens_by_user_id(self):
+        """Gets a dict of user id to the token of the connection with that
+        user.
+        """
+        return self.connection_choices.tokens_by_user_id
 
-        connections.sort(key=lambda k: k[1])
-        return connections
+    def get_token_queryset(self):
+        """Gets the queryset connection tokens are resolved from or None if
+        they should be resolved from the user connections in memory.
+        """
+        if isinstance(self.user_connections, QuerySet):
+            return self.user_connections
+
+        return None
+
+    def should_query_tokens(self):
+        """Boolean indicating if connection tokens are resolved with a query
+        instead of from the user connections in memory. Once the user
+        connections have been loaded (for example to render the choices),
+        they're always resolved in memory.
+        """
+        return (self.user is not None and
+                self.get_token_queryset() is not None and
+                not self.connection_choices.is_evaluated)
+
+    def get_connections_for_tokens(self, tokens):
+        """Gets the connections for connection tokens.
+
+        When user_connections is a queryset that hasn't been loaded, only the
+        connections for the tokens are loaded with a single ``token__in``
+        query using the unique token index. The resolved connections are
+        memoized until the field's inputs change. Otherwise, the connections
+        are looked up in memory.
+
+        :param tokens: iterable of connection tokens.
+        :return: dict of token to connection for the tokens that were found.
+        """
+        tokens = set(tokens)
+
+        if not self.should_query_tokens():
+            connections_by_token = self.get_connections_by_token()
+            return dict((token, connections_by_token[token])
+                        for token in tokens if token in connections_by_token)
+
+        resolved_connections = self._resolved_connections
+        missing_tokens = tokens.difference(resolved_connections)
+
+        if missing_tokens:
+            connections = (self.get_token_queryset()
+                               .filter(token__in=missing_tokens)
+                               .order_by()
+                               .with_users(strategy=self.user_loading_strategy,
+                                           user_fields=self.user_fields))
+            resolved_connections.update((conn.token, conn)
+                                        for conn in connections)
+
+        return dict((token, resolved_connections[token])
+                    for token in tokens if token in resolved_connections)
 
     def user_connection_tokens_to_users(self, selected_tokens):
         """Takes the selected user tokens and returns the users associated with the
@@ -106,38 +379,37 @@ class BaseUserConnectionFieldMixin(object):
         :params user_connections: the list of user connections to pull the users
             from.
         """
-        if not selected_tokens or not self.user_connections:
+        if not selected_tokens:
             return []
 
-        return [c.get_connected_user(self.user) for c in self.user_connections
-                if c.token in selected_tokens]
+        selected_tokens = list(OrderedDict.fromkeys(selected_tokens))
+        connections = self.get_connections_for_tokens(selected_tokens)
+        return [connections[token].get_connected_user(self.user)
+                for token in selected_tokens if token in connections]
 
     def get_user_by_token(self, token):
         """Gets the user from the user_connections by token."""
-        if not token or not self.user_connections:
+        if not token:
             return None
 
-        for connection in self.user_connections:
-            if connection.token == token:
-                return connection.get_connected_user(self.user)
+        connection = self.get_connections_for_tokens([token]).get(token)
 
-        return None
+        if connection is None:
+            return None
+
+        return connection.get_connected_user(self.user)
 
     def get_token_by_user_id(self, user_id):
         """Gets a connection token by a user's id. If the user_id == self.user
         then this returns 'self' as the initial.
         """
-        if not user_id or not self.user_connections:
+        if not user_id or self.user_connections is None:
             return None
 
         if self.user and self.user.id == user_id:
             return 'self'
 
-        for connection in self.user_connections:
-            if user_id in connection.user_ids:
-                return connection.token
-
-        return None
+        return self.get_tokens_by_user_id().get(user_id)
 
     def get_token_by_user(self, user):
         """Gets a conenction token for a user."""
@@ -155,11 +427,14 @@ class BaseUserConnectionChoiceField(BaseUserConnectionFieldMixin):
 
         super(BaseUserConnectionChoiceField, self).__init__(*args, **kwargs)
 
-    def _update_choices(self):
-        super(BaseUserConnectionChoiceField, self)._update_choices()
+    def get_extra_choices(self):
+        choices = super(BaseUserConnectionChoiceField,
+                        self).get_extra_choices()
 
         if not self.required and self.empty_label is not None:
-            self.choices.insert(0, ('', self.empty_label))
+            choices.insert(0, ('', self.empty_label))
+
+        return choices
 
 
 class UserConnectionChoiceField(BaseUserConnectionChoiceField, ChoiceField):
@@ -238,3 +513,106 @@ class UserConnectionsMultipleChoiceField(BaseUserConnectionChoiceField,
                             self).clean(value)
         return self.user_connection_tokens_to_users(
                                                 selected_tokens=user_tokens)
+
+
+class BaseUserConnectionSearchFieldMixin(object):
+    """Field mixin for user connection fields that don't render all the
+    connections as choices. Instead the widget searches the connections with
+    a JSON endpoint (see user_connections.views.UserConnectionSearchView) and
+    only the selected connections are loaded.
+
+    Submitted tokens are resolved with a single indexed query against the
+    user's connections. If user_connections is a queryset, it's used to scope
+    the connections. If it's a list, tokens are only resolved from the
+    connections in the list, in memory. Otherwise, the user's accepted
+    connections are used.
+    """
+
+    def __init__(self, search_url=None, *args, **kwargs):
+        """
+        :param search_url: the url of the connection search endpoint.
+        """
+        super(BaseUserConnectionSearchFieldMixin, self).__init__(*args,
+                                                                 **kwargs)
+        self.widget.search_url = search_url
+        self.widget.get_selected_choices = self.get_selected_choices
+
+    def __deepcopy__(self, memo):
+        result = super(BaseUserConnectionSearchFieldMixin,
+                       self).__deepcopy__(memo)
+        result.widget.get_selected_choices = result.get_selected_choices
+        return result
+
+    def get_user_connection_choices(self):
+        # Connections are searched by the widget instead.
+        return []
+
+    def get_token_queryset(self):
+        """Gets the queryset of connections the tokens are resolved from or
+        None if user_connections is a list the tokens are resolved from in
+        memory.
+        """
+        if isinstance(self.user_connections, QuerySet):
+            return self.user_connections
+
+        if self.user_connections is not None:
+            return None
+
+        UserConnection = get_user_connection_model()
+        return UserConnection.objects.get_by_user(user=self.user,
+                                                  status=Status.ACCEPTED)
+
+    def should_query_tokens(self):
+        return self.user is not None and self.get_token_queryset() is not None
+
+    def valid_value(self, value):
+        # The connections aren't choices so tokens are always checked against
+        # the connections they're resolved from.
+        return self.user is not None and self.is_valid_token(force_text(value))
+
+    def get_token_by_user_id(self, user_id):
+        """Gets a connection token by a user's id with a single query."""
+        if self.get_token_queryset() is None:
+            return super(BaseUserConnectionSearchFieldMixin,
+                         self).get_token_by_user_id(user_id)
+
+        if not user_id or not self.user:
+            return None
+
+        if self.user.id == user_id:
+            return 'self'
+
+        UserConnection = get_user_connection_model()
+        low_user_id, high_user_id = UserConnection.objects.get_user_pair_ids(
+            self.user.id, user_id)
+        return (self.get_token_queryset()
+                    .filter(low_user_id=low_user_id, high_user_id=high_user_id)
+                    .values_list('token', flat=True)
+                    .first())
+
+    def get_selected_choices(self, tokens):
+        """Gets the (token, full name) choices for the selected tokens so
+        the widget can render them.
+        """
+        connections = self.get_connections_for_tokens(
+            token for token in tokens if token)
+        return [(token, connections[token].get_connected_user(
+                 self.user).get_full_name())
+                for token in tokens if token in connections]
+
+
+class UserConnectionSearchChoiceField(BaseUserConnectionSearchFieldMixin,
+                                      UserConnectionChoiceField):
+    """Choice field for a user connection that's searched for with a JSON
+    endpoint instead of rendering every connection as an option.
+    """
+    widget = UserConnectionSearchSelect
+
+
+class UserConnectionsSearchMultipleChoiceField(
+        BaseUserConnectionSearchFieldMixin,
+        UserConnectionsMultipleChoiceField):
+    """Multiple choice field for user connections that are searched for with a
+    JSON endpoint instead of rendering every connection as a choice.
+    """
+    widget = UserConnectionSearchSelectMultiple
@@ -0,0 +1,60 @@
+from __future__ import unicode_literals
+
+from itertools import chain
+
+from django.forms.widgets import Select
+from django.forms.widgets import SelectMultiple
+from django.utils.encoding import force_text
+
+
+class UserConnectionSearchSelectMixin(object):
+    """Select widget mixin that only renders the selected user connections.
+    The rest of the connections are searched for client side with the JSON
+    endpoint at `search_url` which is rendered as the ``data-search-url``
+    attribute.
+
+    * search_url: the url of the connection search endpoint.
+    * get_selected_choices: callable that takes a list of selected tokens and
+        returns the (token, label) choices for them. This is set by the field.
+    """
+    search_url = None
+    get_selected_choices = None
+
+    def render(self, name, value, attrs=None, choices=()):
+        attrs = dict(attrs or {})
+
+        if self.search_url:
+            attrs['data-search-url'] = self.search_url
+
+        if self.get_selected_choices is not None:
+            selected_tokens = self.get_selected_tokens(value)
+            rendered_values = set(force_text(option_value)
+                                  for option_value, option_label
+                                  in chain(self.choices, choices))
+            choices = list(choices) + self.get_selected_choices(
+                [token for token in selected_tokens
+                 if token not in rendered_values])
+
+        return super(UserConnectionSearchSelectMixin, self).render(
+            name, value, attrs=attrs, choices=choices)
+
+    def get_selected_tokens(self, value):
+        if not value:
+            return []
+
+        return [force_text(value)]
+
+
+class UserConnectionSearchSelect(UserConnectionSearchSelectMixin, Select):
+    """Select widget for a single user connection that's searched for."""
+
+
+class UserConnectionSearchSelectMultiple(UserConnectionSearchSelectMixin,
+                                         SelectMultiple):
+    """Select widget for many user connections that are searched for."""
+
+    def get_selected_tokens(self, value):
+        if not value:
+            return []
+
+        return [force_text(v) for v in value]
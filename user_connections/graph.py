@@ -0,0 +1,417 @@
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+import mmap
+import struct
+
+from . import get_user_connection_model
+from .constants import Status
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+SNAPSHOT_MAGIC = b'UCGRAPH1'
+_HEADER = struct.Struct('=8sqq')
+_TYPECODE = 'q'
+_ITEMSIZE = array(_TYPECODE).itemsize
+
+
+class ConnectionGraph(object):
+    """Compact, read only adjacency index of user connections stored in
+    compressed sparse row (CSR) form.
+
+    Users are stored as dense indexes into the sorted ``node_ids`` array. The
+    neighbors of the user at index ``i`` are the (sorted) indexes in
+    ``neighbors[offsets[i]:offsets[i + 1]]``. Every connection is stored in
+    both directions. All three are flat arrays of 64 bit ints so the whole
+    graph takes ``8 * (2 * users + 2 * connections)`` bytes and can be shared
+    between processes with a memory mapped snapshot (see ``save`` and
+    ``load``).
+
+    Since the arrays support the buffer protocol they can also be wrapped
+    without copying by NumPy (``numpy.frombuffer``) when vectorized analytics
+    are needed.
+
+    :param node_ids: sorted sequence of user ids.
+    :param offsets: sequence of len(node_ids) + 1 offsets into neighbors.
+    :param neighbors: sequence of neighbor node indexes.
+    """
+
+    def __init__(self, node_ids, offsets, neighbors):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, user_id):
+        return self._get_index(user_id) is not None
+
+    @property
+    def num_connections(self):
+        """The number of connections (undirected edges) in the graph."""
+        return len(self.neighbors) // 2
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Builds the graph from an iterable of (user_id, user_id) tuples.
+
+        Edges are consumed once into two flat arrays so memory use stays close
+        to the final size of the graph regardless of how many edges there are.
+        The CSR arrays are built with NumPy when it's installed and in pure
+        python otherwise.
+        """
+        src = array(_TYPECODE)
+        dst = array(_TYPECODE)
+
+        for user_id_1, user_id_2 in edges:
+            src.append(user_id_1)
+            dst.append(user_id_2)
+
+        if numpy is not None:
+            return cls(*_build_csr_numpy(src, dst))
+
+        return cls(*_build_csr(src, dst))
+
+    def _get_index(self, user_id):
+        """Gets the node index for a user id or None if the user has no
+        connections in the graph.
+        """
+        i = bisect_left(self.node_ids, user_id)
+
+        if i < len(self.node_ids) and self.node_ids[i] == user_id:
+            return i
+
+        return None
+
+    def _neighbor_indexes(self, i):
+        return self.neighbors[self.offsets[i]:self.offsets[i + 1]]
+
+    def degree(self, user_id):
+        """Gets the number of connections a user has."""
+        i = self._get_index(user_id)
+
+        if i is None:
+            return 0
+
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def degrees(self):
+        """Generator of (user id, degree) tuples for every user."""
+        for i, user_id in enumerate(self.node_ids):
+            yield user_id, self.offsets[i + 1] - self.offsets[i]
+
+    def degree_distribution(self):
+        """Gets a dict of degree to the number of users with that degree."""
+        distribution = {}
+
+        for user_id, degree in self.degrees():
+            distribution[degree] = distribution.get(degree, 0) + 1
+
+        return distribution
+
+    def neighbor_ids(self, user_id):
+        """Gets the sorted list of user ids a user is connected with."""
+        i = self._get_index(user_id)
+
+        if i is None:
+            return []
+
+        return [self.node_ids[j] for j in self._neighbor_indexes(i)]
+
+    def common_neighbor_ids(self, user_id_1, user_id_2):
+        """Gets the sorted list of user ids both users are connected with."""
+        i_1 = self._get_index(user_id_1)
+        i_2 = self._get_index(user_id_2)
+
+        if i_1 is None or i_2 is None:
+            return []
+
+        neighbors_1 = self._neighbor_indexes(i_1)
+        neighbors_2 = self._neighbor_indexes(i_2)
+        common = []
+        a = b = 0
+
+        while a < len(neighbors_1) and b < len(neighbors_2):
+            if neighbors_1[a] == neighbors_2[b]:
+                common.append(self.node_ids[neighbors_1[a]])
+                a += 1
+                b += 1
+            elif neighbors_1[a] < neighbors_2[b]:
+                a += 1
+            else:
+                b += 1
+
+        return common
+
+    def bfs(self, user_id, max_depth=None):
+        """Breadth first search from a user.
+
+        :param user_id: the user id to start from.
+        :param max_depth: the max number of hops to follow. None follows all.
+        :return: generator of (user id, depth) tuples in the order the users
+            are reached, starting with (user_id, 0).
+        """
+        i = self._get_index(user_id)
+
+        if i is None:
+            return
+
+        visited = bytearray(len(self.node_ids))
+        visited[i] = 1
+        queue = deque([(i, 0)])
+
+        while queue:
+            i, depth = queue.popleft()
+            yield self.node_ids[i], depth
+
+            if max_depth is not None and depth >= max_depth:
+                continue
+
+            for j in self._neighbor_indexes(i):
+                if not visited[j]:
+                    visited[j] = 1
+                    queue.append((j, depth + 1))
+
+    def shortest_path(self, user_id_1, user_id_2):
+        """Gets the shortest path of user ids between two users including both
+        users or None if they aren't connected.
+        """
+        source = self._get_index(user_id_1)
+        target = self._get_index(user_id_2)
+
+        if source is None or target is None:
+            return None
+
+        parents = array(_TYPECODE, [-1]) * len(self.node_ids)
+        parents[source] = source
+        queue = deque([source])
+
+        while queue:
+            i = queue.popleft()
+
+            if i == target:
+                path = [self.node_ids[i]]
+
+                while i != source:
+                    i = parents[i]
+                    path.append(self.node_ids[i])
+
+                path.reverse()
+                return path
+
+            for j in self._neighbor_indexes(i):
+                if parents[j] == -1:
+                    parents[j] = i
+                    queue.append(j)
+
+        return None
+
+    def connected_components(self):
+        """Generator of lists of user ids, one per connected component."""
+        visited = bytearray(len(self.node_ids))
+
+        for start in range(len(self.node_ids)):
+            if visited[start]:
+                continue
+
+            visited[start] = 1
+            component = []
+            queue = deque([start])
+
+            while queue:
+                i = queue.popleft()
+                component.append(self.node_ids[i])
+
+                for j in self._neighbor_indexes(i):
+                    if not visited[j]:
+                        visited[j] = 1
+                        queue.append(j)
+
+            yield component
+
+    def save(self, path):
+        """Writes a snapshot of the graph to a file that can be memory mapped
+        with ``load``. Snapshots use the native byte order so they should be
+        loaded on the same architecture they were written on.
+        """
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, len(self.node_ids),
+                                 len(self.neighbors)))
+            for values in (self.node_ids, self.offsets, self.neighbors):
+                f.write(memoryview(values).tobytes())
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        """Loads a graph snapshot written by ``save``.
+
+        :param path: the path of the snapshot file.
+        :param use_mmap: boolean indicating if the file is memory mapped
+            instead of read into memory. Memory mapped graphs are read only
+            and share the same physical memory between all processes that
+            load the same snapshot.
+        """
+        with open(path, 'rb') as f:
+            magic, num_nodes, num_neighbors = _HEADER.unpack(
+                f.read(_HEADER.size))
+
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('{0} is not a connection graph '
+                                 'snapshot.'.format(path))
+
+            sizes = (num_nodes, num_nodes + 1, num_neighbors)
+
+            if not use_mmap or not hasattr(memoryview, 'cast'):
+                arrays = []
+
+                for size in sizes:
+                    values = array(_TYPECODE)
+                    values.fromfile(f, size)
+                    arrays.append(values)
+
+                return cls(*arrays)
+
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        arrays = []
+        start = _HEADER.size
+
+        for size in sizes:
+            end = start + size * _ITEMSIZE
+            arrays.append(view[start:end].cast(_TYPECODE))
+            start = end
+
+        graph = cls(*arrays)
+        graph._mmap = mapped
+        return graph
+
+
+def _build_csr_numpy(src, dst):
+    """Builds the (node_ids, offsets, neighbors) arrays of a graph from the
+    arrays of the two user ids of each edge with NumPy.
+    """
+    num_edges = len(src)
+    dtype = numpy.dtype(_TYPECODE)
+    ends = numpy.concatenate((numpy.frombuffer(src, dtype=dtype),
+                              numpy.frombuffer(dst, dtype=dtype)))
+
+    # Every edge is stored in both directions, so the first half of the ends
+    # are the sources of the edges and the second half the targets and then
+    # the other way around.
+    node_ids, sources = numpy.unique(ends, return_inverse=True)
+    del ends
+    targets = numpy.concatenate((sources[num_edges:], sources[:num_edges]))
+
+    # Sort the edges by source, then target so the neighbors of each user
+    # are sorted. Sorting a single (source, target) key is much faster than
+    # sorting by both columns.
+    num_nodes = len(node_ids)
+    neighbors = sources.astype(dtype) * num_nodes
+    neighbors += targets
+    del targets
+    neighbors.sort()
+    neighbors %= max(num_nodes, 1)
+
+    offsets = numpy.zeros(num_nodes + 1, dtype=dtype)
+    numpy.cumsum(numpy.bincount(sources, minlength=num_nodes),
+                 out=offsets[1:])
+
+    return tuple(array(_TYPECODE, values.astype(dtype).tobytes())
+                 for values in (node_ids, offsets, neighbors))
+
+
+def _build_csr(src, dst):
+    """Builds the (node_ids, offsets, neighbors) arrays of a graph from the
+    arrays of the two user ids of each edge in pure python.
+    """
+    node_ids = set(src)
+    node_ids.update(dst)
+    node_ids = array(_TYPECODE, sorted(node_ids))
+    num_nodes = len(node_ids)
+
+    for i in range(len(src)):
+        src[i] = bisect_left(node_ids, src[i])
+        dst[i] = bisect_left(node_ids, dst[i])
+
+    offsets = array(_TYPECODE, [0]) * (num_nodes + 1)
+
+    for i in range(len(src)):
+        offsets[src[i] + 1] += 1
+        offsets[dst[i] + 1] += 1
+
+    for i in range(num_nodes):
+        offsets[i + 1] += offsets[i]
+
+    neighbors = array(_TYPECODE, [0]) * (2 * len(src))
+    positions = offsets[:-1]
+
+    for i in range(len(src)):
+        neighbors[positions[src[i]]] = dst[i]
+        positions[src[i]] += 1
+        neighbors[positions[dst[i]]] = src[i]
+        positions[dst[i]] += 1
+
+    del positions
+
+    for i in range(num_nodes):
+        start, end = offsets[i], offsets[i + 1]
+
+        if end - start > 1:
+            neighbors[start:end] = array(_TYPECODE,
+                                         sorted(neighbors[start:end]))
+
+    return node_ids, offsets, neighbors
+
+
+def load_connection_graph(queryset=None, status=Status.ACCEPTED,
+                          chunk_size=10000):
+    """Builds a ``ConnectionGraph`` from the user connection table.
+
+    The (created_user_id, with_user_id) values are streamed in primary key
+    ordered chunks so only ``chunk_size`` rows are held in memory at a time
+    on every database backend.
+
+    :param queryset: the user connections to build the graph from. Defaults
+        to all user connections.
+    :param status: only include connections with this status. None includes
+        all status'.
+    :param chunk_size: the number of rows fetched per query.
+    """
+    if queryset is None:
+        queryset = get_user_connection_model().objects.all()
+
+    if status is not None:
+        queryset = queryset.filter(status=status)
+
+    queryset = queryset.order_by('id').values_list('id',
+                                                   'created_user_id',
+                                                   'with_user_id')
+
+    def stream_edges():
+        last_id = None
+
+        while True:
+            chunk_queryset = queryset
+
+            if last_id is not None:
+                chunk_queryset = chunk_queryset.filter(id__gt=last_id)
+
+            rows = list(chunk_queryset[:chunk_size])
+
+            for conn_id, created_user_id, with_user_id in rows:
+                yield created_user_id, with_user_id
+
+            if len(rows) < chunk_size:
+                return
+
+            last_id = rows[-1][0]
+
+    return ConnectionGraph.from_edges(stream_edges())
@@ -0,0 +1,42 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from user_connections import get_user_connection_model
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the denormalized connection counts per user and status '
+            'from the user connection table or, with --verify, reports the '
+            'counts that are wrong.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify',
+                            action='store_true',
+                            dest='verify',
+                            default=False,
+                            help='Only check the counts instead of '
+                                 'rebuilding them. Exits with an error if '
+                                 'any count is wrong.')
+
+    def handle(self, *args, **options):
+        UserConnection = get_user_connection_model()
+        UserConnectionDegree = UserConnection.get_degree_model()
+
+        if not options['verify']:
+            count = UserConnectionDegree.objects.rebuild(UserConnection)
+            self.stdout.write('Rebuilt {0} connection counts.'.format(count))
+            return
+
+        mismatches = UserConnectionDegree.objects.verify(UserConnection)
+
+        for (user_id, status), (expected, actual) in sorted(
+                mismatches.items()):
+            self.stdout.write('user {0} {1}: expected {2}, found {3}'.format(
+                user_id, status, expected, actual))
+
+        if mismatches:
+            raise CommandError('{0} connection counts are '
+                               'wrong.'.format(len(mismatches)))
+
+        self.stdout.write('All connection counts are correct.')
@@ -1,10 +1,489 @@
+from collections import defaultdict
+from datetime import datetime
+import copy
+import sys
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError
+from django.db import connections
+from django.db import models
+from django.db import router
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Manager
+from django.db.models import signals
+from django.db.models import Prefetch
+from django.db.models import query as models_query
+from django.db.models import sql
+from django.db.models.query import QuerySet
 from django.db.models.query_utils import Q
 from django_core.db.models import CommonManager
 from django_core.db.models import TokenManager
+from django_core.utils.list_utils import make_obj_list
+from django_core.utils.random_utils import random_alphanum
+
+from . import cache
+from .constants import Status
+
+if sys.version_info >= (3, 5):
+    from .aio import AsyncUserConnectionManagerMixin
+else:
+    AsyncUserConnectionManagerMixin = object
+
+
+def get_cached_related(instance, field_name):
+    """Gets the related object of a foreign key that has already been loaded
+    on an instance without querying for it. Returns None if it hasn't been
+    loaded.
+    """
+    field = instance._meta.get_field(field_name)
+
+    if hasattr(field, 'is_cached'):
+        # Django 2.0+
+        if field.is_cached(instance):
+            return field.get_cached_value(instance)
+
+        return None
+
+    return getattr(instance, field.get_cache_name(), None)
+
+
+def prefetch_related_objects(instances, *lookups):
+    """Prefetches the related objects for a list of instances that have
+    already been loaded.
+    """
+    if hasattr(models, 'prefetch_related_objects'):
+        # Django 1.10+
+        models.prefetch_related_objects(instances, *lookups)
+    else:
+        models_query.prefetch_related_objects(instances, lookups)
+
+
+def get_connection_cursor(connection):
+    """Gets the pagination cursor for a connection. The cursor encodes the
+    (activity_count, id) of the connection as "<activity_count>.<id>".
+    """
+    return '{0}.{1}'.format(connection.activity_count, connection.id)
+
+
+def parse_connection_cursor(cursor):
+    """Gets the (activity_count, id) tuple from a pagination cursor or None if
+    the cursor is empty or invalid.
+    """
+    if not cursor:
+        return None
+
+    try:
+        activity_count, conn_id = cursor.split('.')
+        return int(activity_count), int(conn_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class UserConnectionQuerySet(QuerySet):
+    """User Connection queryset."""
+
+    def __init__(self, *args, **kwargs):
+        super(UserConnectionQuerySet, self).__init__(*args, **kwargs)
+        self._union_user_id = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(UserConnectionQuerySet, self)._clone(*args, **kwargs)
+        clone._union_user_id = self._union_user_id
+        return clone
+
+    def _fetch_all(self):
+        if self._union_user_id is not None and self._result_cache is None:
+            self._result_cache = list(
+                self._get_union_queryset().iterator())
+
+        super(UserConnectionQuerySet, self)._fetch_all()
+
+    def iterator(self):
+        if self._union_user_id is None:
+            return super(UserConnectionQuerySet, self).iterator()
+
+        return self._get_union_queryset().iterator()
+
+    def count(self):
+        if self._union_user_id is None or self._result_cache is not None:
+            return super(UserConnectionQuerySet, self).count()
+
+        return self._get_union_queryset().count()
+
+    def exists(self):
+        if self._union_user_id is None or self._result_cache is not None:
+            return super(UserConnectionQuerySet, self).exists()
+
+        return self._get_union_queryset().exists()
+
+    def get_for_user_and_username(self, user, username):
+        """Gets the connection between a user and the user with a username
+        along with the connected user in a single query that joins the user
+        table on both sides of the connection. The users are always loaded
+        from the join, even if the queryset prefetches them.
+
+        :param user: a user object or user id.
+        :param username: the username of the connected user.
+        :return: tuple of the connection and the connected user or
+            (None, None) if the users aren't connected.
+        """
+        user_id = getattr(user, 'pk', user)
+        username_field = get_user_model().USERNAME_FIELD
+        conn = self.filter(
+            Q(created_user_id=user_id, **{
+                'with_user__{0}'.format(username_field): username
+            }) |
+            Q(with_user_id=user_id, **{
+                'created_user__{0}'.format(username_field): username
+            })
+        ).prefetch_related(None).select_related('created_user',
+                                                'with_user').first()
+
+        if conn is None:
+            return None, None
+
+        return conn, conn.get_connected_user(user_id)
+
+    def page(self, after=None, page_size=25):
+        """Gets a page of connections ordered by activity count using keyset
+        pagination. Rows are located by the (activity_count, id) of the last
+        connection on the previous page instead of an OFFSET so every page is
+        a bounded index range scan no matter how deep it is, and rows are
+        never skipped or repeated when connections are added between pages.
+
+        When the queryset is limited to a user's connections with
+        ``for_user_union``, a page is read with one query on created_user and
+        one on with_user, each limited to the page size, and the two are
+        merged in python. This way each query is an ordered range scan of its
+        own (user, status, activity_count, id) index instead of an OR over
+        both columns that has to sort all of the user's connections.
+
+        :param after: the cursor of the last connection on the previous page
+            (see ``get_connection_cursor``). None or an invalid cursor gets
+            the first page.
+        :param page_size: the max number of connections on the page.
+        :return: tuple of the list of connections on the page and the cursor
+            for the next page or None if this is the last page.
+        """
+        cursor = parse_connection_cursor(after)
+
+        if self._union_user_id is None:
+            # Get one extra connection to know if there's a next page.
+            conns = self._get_page_rows(self, cursor, page_size + 1)
+        else:
+            conns = self._get_union_page_rows(cursor, page_size + 1)
+
+        next_cursor = None
+
+        if len(conns) > page_size:
+            conns = conns[:page_size]
+            next_cursor = get_connection_cursor(conns[-1])
+
+        return conns, next_cursor
+
+    def _get_page_rows(self, queryset, cursor, limit):
+        """Gets up to ``limit`` connections of the queryset that come after
+        the cursor ordered by activity count and id.
+        """
+        queryset = queryset.order_by('-activity_count', '-id')
+
+        if cursor:
+            activity_count, conn_id = cursor
+            queryset = queryset.filter(
+                Q(activity_count__lt=activity_count) |
+                Q(activity_count=activity_count, id__lt=conn_id))
+
+        return list(queryset[:limit])
+
+    def _get_union_page_rows(self, cursor, limit):
+        """Gets up to ``limit`` of the user's connections that come after the
+        cursor with a query on each user column.
+        """
+        queryset = self._clone()
+        queryset._union_user_id = None
+        prefetch_lookups = queryset._prefetch_related_lookups
+        queryset = queryset.prefetch_related(None)
+        conns_by_id = {}
+
+        for field_name in ('created_user_id', 'with_user_id'):
+            branch = queryset.filter(**{field_name: self._union_user_id})
+
+            # A connection the user has with themself is in both.
+            for conn in self._get_page_rows(branch, cursor, limit):
+                conns_by_id[conn.id] = conn
+
+        conns = sorted(conns_by_id.values(),
+                       key=lambda conn: (conn.activity_count, conn.id),
+                       reverse=True)[:limit]
+
+        if prefetch_lookups:
+            # Only prefetch for the merged page instead of for each query.
+            prefetch_related_objects(conns, *prefetch_lookups)
+
+        return conns
+
+    def for_user_union(self, user_id):
+        """Limits the connections to the ones for a user the same way
+        ``get_by_user_id`` does but, when the queryset is evaluated, the
+        connection ids are found with two index driven queries, one on
+        created_user and one on with_user, combined with UNION ALL instead of
+        an OR over both columns. The ordering and LIMIT of the queryset are
+        applied to each of the two queries as well so neither has to read
+        more than a page of rows.
+
+        Filtering, ordering and slicing work the same as any other queryset.
+
+        :param user_id: the id of the user the connections are for.
+        """
+        queryset = self.filter(Q(created_user_id=user_id) |
+                               Q(with_user_id=user_id))
+        queryset._union_user_id = user_id
+        return queryset
+
+    def _get_union_queryset(self):
+        """Gets a queryset of the connections with the ids found by the UNION
+        ALL of the created_user and with_user queries. The outer query only
+        filters on those ids and carries over the values, ordering, related
+        loading, deferred fields and slice of this queryset so it doesn't
+        repeat the OR over both user columns.
+        """
+        queryset = self._clone()
+        queryset._union_user_id = None
+        low_mark = queryset.query.low_mark
+        high_mark = queryset.query.high_mark
+        queryset.query.clear_limits()
+
+        connection = connections[queryset.db]
+        pk_column = connection.ops.quote_name(self.model._meta.pk.column)
+        selects = []
+        params = []
+
+        for i, field_name in enumerate(('created_user_id', 'with_user_id')):
+            branch = queryset.filter(**{field_name: self._union_user_id})
+            branch = branch.values_list('pk')
+
+            if high_mark is None:
+                branch.query.clear_ordering(force_empty=True)
+            else:
+                branch.query.set_limits(high=high_mark)
+
+            compiler = branch.query.get_compiler(using=queryset.db)
+            branch_sql, branch_params = compiler.as_sql()
+            selects.append(
+                'SELECT {0} FROM ({1}) u{2}'.format(pk_column, branch_sql, i))
+            params.extend(branch_params)
+
+        # extra instead of pk__in=RawSQL(...) since the In lookup wraps the
+        # subquery in a second set of parentheses which makes it a scalar.
+        union_queryset = self.model._default_manager.using(
+            queryset.db
+        ).extra(
+            where=['{0}.{1} IN ({2})'.format(
+                connection.ops.quote_name(self.model._meta.db_table),
+                pk_column,
+                ' UNION ALL '.join(selects)
+            )],
+            params=params
+        )
+        fields = getattr(queryset, '_fields', None)
+
+        if fields is not None:
+            if hasattr(queryset, '_iterable_class'):
+                # django 1.9+
+                union_queryset = union_queryset._values(*fields)
+                union_queryset._iterable_class = queryset._iterable_class
+            else:
+                union_queryset = union_queryset._clone(
+                    klass=type(queryset),
+                    setup=True,
+                    _fields=fields,
+                    flat=getattr(queryset, 'flat', False)
+                )
+
+        query = union_queryset.query
+        query.order_by = list(queryset.query.order_by)
+        query.extra_order_by = queryset.query.extra_order_by
+        query.default_ordering = queryset.query.default_ordering
+        query.standard_ordering = queryset.query.standard_ordering
+
+        if fields is None:
+            query.select_related = copy.deepcopy(
+                queryset.query.select_related)
+            query.deferred_loading = (
+                set(queryset.query.deferred_loading[0]),
+                queryset.query.deferred_loading[1]
+            )
+
+        query.set_limits(low=low_mark, high=high_mark)
+        union_queryset._prefetch_related_lookups = list(
+            queryset._prefetch_related_lookups)
+        return union_queryset
+
+    def with_users(self, strategy=None, user_fields=None):
+        """Loads the created_user and with_user for the connections.
+
+        :param strategy: how the users are loaded. Either 'select_related' to
+            JOIN the users in the same query or 'prefetch_related' to load them
+            with a query per user field. Defaults to the
+            USER_CONNECTIONS_USER_LOADING setting or 'select_related'.
+        :param user_fields: the names of the user fields to load. All other
+            user fields are deferred. This is useful for wide user models when
+            only the name of the user is displayed. Defaults to the
+            USER_CONNECTIONS_USER_FIELDS setting or None which loads all
+            fields.
+        """
+        if strategy is None:
+            strategy = getattr(settings, 'USER_CONNECTIONS_USER_LOADING',
+                               'select_related')
 
+        if user_fields is None:
+            user_fields = getattr(settings, 'USER_CONNECTIONS_USER_FIELDS',
+                                  None)
 
-class UserConnectionManager(TokenManager, CommonManager):
-    """User Connection manager."""
+        user_field_names = ('created_user', 'with_user')
+
+        if strategy == 'prefetch_related':
+            if not user_fields:
+                return self.prefetch_related(*user_field_names)
+
+            user_queryset = get_user_model().objects.only(*user_fields)
+            return self.prefetch_related(*[
+                Prefetch(field_name, queryset=user_queryset)
+                for field_name in user_field_names
+            ])
+
+        if strategy != 'select_related':
+            raise ImproperlyConfigured('Unknown user loading strategy '
+                                       '"{0}".'.format(strategy))
+
+        queryset = self.select_related(*user_field_names)
+
+        if not user_fields:
+            return queryset
+
+        deferred_fields = [f.name
+                           for f in get_user_model()._meta.concrete_fields
+                           if f.name not in user_fields and not f.primary_key]
+        return queryset.defer(*['{0}__{1}'.format(field_name, user_field)
+                                for field_name in user_field_names
+                                for user_field in deferred_fields])
+
+    def bulk_transition(self, ids, new_status, user=None, from_status=None):
+        """Changes the status of many connections with a single conditional
+        UPDATE. Only the status and last modified columns are written.
+
+        Example for accepting only connections that are still pending:
+
+        >> UserConnection.objects.bulk_transition(ids=[1, 2, 3],
+        ..                                        new_status=Status.ACCEPTED,
+        ..                                        user=request.user,
+        ..                                        from_status=Status.PENDING)
+
+        :param ids: the ids of the connections to change.
+        :param new_status: the status to change the connections to.
+        :param user: the user making the change. This will be the last modified
+            user for the connections.
+        :param from_status: a status or list of status' the connections must
+            currently be in to be changed.
+        :return: the number of connections changed.
+        """
+        ids = list(ids)
+        queryset = self.filter(id__in=ids)
+
+        if from_status:
+            queryset = queryset.filter(status__in=make_obj_list(from_status))
+
+        update_fields = {
+            'status': new_status,
+            'last_modified_dttm': datetime.utcnow()
+        }
+
+        if user is not None:
+            update_fields['last_modified_user'] = user
+
+        if not self.model.tracks_degrees():
+            updated = queryset.update(**update_fields)
+
+            if updated and cache.get_cache() is not None:
+                # update doesn't send post_save signals.
+                user_ids = self.filter(id__in=ids).values_list(
+                    'created_user_id',
+                    'with_user_id'
+                )
+                cache.invalidate_user_ids(*[user_id for pair in user_ids
+                                            for user_id in pair],
+                                          using=queryset.db)
+                cache.invalidate_connection_records(*ids, using=queryset.db)
+
+            return updated
+
+        using = self._db or router.db_for_write(self.model)
+
+        with transaction.atomic(using=using):
+            rows = list(queryset.using(using).select_for_update().values_list(
+                'id',
+                'created_user_id',
+                'with_user_id',
+                'status'
+            ))
+
+            if not rows:
+                return 0
+
+            updated = self.using(using).filter(
+                id__in=[row[0] for row in rows]
+            ).update(**update_fields)
+            changed_rows = [row[1:] for row in rows if row[3] != new_status]
+            self.model.update_degrees(
+                added=[(user_id_1, user_id_2, new_status)
+                       for user_id_1, user_id_2, status in changed_rows],
+                removed=changed_rows,
+                using=using
+            )
+
+        # update doesn't send post_save signals.
+        cache.invalidate_user_ids(*[user_id for row in rows
+                                    for user_id in row[1:3]],
+                                  using=using)
+        cache.invalidate_connection_records(*[row[0] for row in rows],
+                                            using=using)
+        return updated
+
+
+class UserConnectionManager(AsyncUserConnectionManagerMixin, TokenManager,
+                            CommonManager):
+    """User Connection manager.
+
+    On python 3.5+ the manager also has async counterparts of its methods
+    (see user_connections.aio.AsyncUserConnectionManagerMixin).
+    """
+    #: The number of times get_or_create tries the insert and lookup before
+    #: giving up.
+    get_or_create_attempts = 3
+
+    def get_queryset(self):
+        return UserConnectionQuerySet(self.model, using=self._db)
+
+    def with_users(self, strategy=None, user_fields=None):
+        """See UserConnectionQuerySet.with_users."""
+        return self.get_queryset().with_users(strategy=strategy,
+                                              user_fields=user_fields)
+
+    def get_for_user_and_username(self, user, username):
+        """See UserConnectionQuerySet.get_for_user_and_username."""
+        return self.get_queryset().get_for_user_and_username(user=user,
+                                                             username=username)
+
+    def bulk_transition(self, ids, new_status, user=None, from_status=None):
+        """See UserConnectionQuerySet.bulk_transition."""
+        return self.get_queryset().bulk_transition(ids=ids,
+                                                   new_status=new_status,
+                                                   user=user,
+                                                   from_status=from_status)
 
     def create(self, created_user, with_user, **kwargs):
         """Creates a Connection. This works like get_or_create because we don't
@@ -16,80 +495,826 @@ class UserConnectionManager(TokenManager, CommonManager):
         :param status: the status of the connection. Default is 'pending'.
 
         """
-        # First need to make sure the connection doesn't already exist.
-        conn = self.get_for_users(user_1=created_user, user_2=with_user)
+        return self.get_or_create(created_user=created_user,
+                                  with_user=with_user,
+                                  **kwargs)[0]
+
+    def get_or_create(self, created_user, with_user, **kwargs):
+        """Gets or creates a connection.
 
-        if conn:
-            return conn
+        This tries the insert first and relies on the unique user pair to
+        detect an existing connection, so creating a new connection is a
+        single round trip and concurrent calls for the same users never create
+        duplicate connections.
 
+        :param created: the user creating the connection.
+        :param with_user: the user to get or create the connection with.
+        :return: tuple of the connection and a boolean indicating if the
+            connection was created.
+        :raises IntegrityError: if the connection could neither be inserted
+            nor found after ``get_or_create_attempts`` tries.
+        """
         if 'last_modified_user' not in kwargs:
             kwargs['last_modified_user'] = created_user
 
-        return super(UserConnectionManager, self).create(
-            created_user=created_user,
-            with_user=with_user,
-            **kwargs
+        for attempt in range(self.get_or_create_attempts):
+            conn = self.model(created_user=created_user,
+                              with_user=with_user,
+                              **kwargs)
+
+            if self._insert_or_ignore(conn):
+                return conn, True
+
+            existing_conn = self.get_for_users(user_1=created_user,
+                                               user_2=with_user)
+
+            if existing_conn is not None:
+                return existing_conn, False
+
+            # The insert conflicted on the token or the connection was
+            # deleted between the insert and the lookup so try again.
+
+        raise IntegrityError(
+            'Unable to get or create the connection between users {0} and '
+            '{1} after {2} attempts.'.format(getattr(created_user, 'pk',
+                                                     created_user),
+                                             getattr(with_user, 'pk',
+                                                     with_user),
+                                             self.get_or_create_attempts))
+
+    def _insert_or_ignore(self, conn):
+        """Inserts a connection unless a connection already exists for the
+        two users or another connection already has its token.
+
+        On PostgreSQL and SQLite (3.35+) this is a single
+        ``INSERT ... ON CONFLICT DO NOTHING RETURNING`` statement. The
+        connection is prepped and ``pre_save`` is sent before the insert, the
+        same as ``save()`` does, so it's also sent when the insert is ignored.
+        ``post_save`` is only sent once the row is inserted. Since this
+        doesn't call ``save()``, models that override ``save()`` and other
+        databases save the connection inside a savepoint instead and treat an
+        IntegrityError on the user pair or the token as a conflict.
+
+        :param conn: the unsaved connection to insert.
+        :return: boolean indicating if the connection was inserted.
+        """
+        from .models import AbstractUserConnection
+
+        using = self._db_for_write()
+        connection = connections[using]
+
+        if not conn.token:
+            # The token is unique so a collision ignores or fails the insert
+            # and get_or_create tries again with a new token. That makes the
+            # token availability query save_prep runs unnecessary.
+            conn.token = random_alphanum(length=self.model.token_length)
+
+        if (not self._supports_on_conflict(connection) or
+                type(conn).save is not AbstractUserConnection.save):
+            try:
+                with transaction.atomic(using=using):
+                    conn.save(force_insert=True, using=using)
+            except IntegrityError:
+                if (self.get_for_users(conn.created_user_id,
+                                       conn.with_user_id) is None and
+                        not self.filter(token=conn.token).exists()):
+                    raise
+
+                return False
+
+            return True
+
+        meta = self.model._meta
+        qn = connection.ops.quote_name
+        self.model.save_prep(conn)
+        signals.pre_save.send(sender=self.model, instance=conn, raw=False,
+                              using=using, update_fields=None)
+
+        fields = [f for f in meta.local_concrete_fields
+                  if f is not meta.auto_field]
+        query = sql.InsertQuery(self.model)
+        query.insert_values(fields, [conn])
+        insert_sql, params = query.get_compiler(using=using).as_sql()[0]
+        insert_sql += ' ON CONFLICT DO NOTHING RETURNING {0}'.format(
+            qn(meta.pk.column)
         )
 
-    def get_or_create(self, created_user, with_user, **kwargs):
-        """Gets or creates a connection.
+        with transaction.atomic(using=using, savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute(insert_sql, params)
+                row = cursor.fetchone()
 
-        :param created: the user creating the connection.
-        :param with_user: the user to get or create the connection with.
+            if row is None:
+                return False
+
+            self.model.update_degrees(added=[conn.get_degree_row()],
+                                      using=using)
+
+        conn.pk = row[0]
+        conn._state.adding = False
+        conn._state.db = using
+        signals.post_save.send(sender=self.model, instance=conn, created=True,
+                               update_fields=None, raw=False, using=using)
+        return True
+
+    def _insert_or_skip(self, conn):
+        """Inserts a connection unless a connection already exists for the
+        two users. A connection whose token is taken is inserted with a new
+        token.
+
+        :param conn: the unsaved connection to insert.
+        :return: boolean indicating if the connection was inserted.
+        :raises IntegrityError: if the connection could neither be inserted
+            nor found after ``get_or_create_attempts`` tries.
+        """
+        for attempt in range(self.get_or_create_attempts):
+            conn.pk = None
+
+            if self._insert_or_ignore(conn):
+                return True
+
+            if self.filter(low_user_id=conn.low_user_id,
+                           high_user_id=conn.high_user_id).exists():
+                return False
+
+            # The insert conflicted on the token so try again with a new one.
+            conn.token = ''
+
+        raise IntegrityError(
+            'Unable to create the connection between users {0} and {1} after '
+            '{2} attempts.'.format(conn.created_user_id, conn.with_user_id,
+                                   self.get_or_create_attempts))
+
+    def bulk_create_connections(self, pairs, status=Status.PENDING,
+                                batch_size=1000):
+        """Creates many connections at once. This is meant for imports and
+        syncing contacts where thousands of connections get created at a time.
+
+        Pairs are deduped in memory regardless of which user is first, pairs
+        of a user with themselves are skipped and each batch does a single
+        query to skip connections that already exist.
+
+        :param pairs: iterable of (created_user, with_user) tuples. The users
+            can either be user objects or user ids.
+        :param status: the status of the created connections. Default is
+            'pending'.
+        :param batch_size: the number of connections to insert per query.
+        :return: tuple of the number of connections created and the number of
+            pairs skipped.
+        """
+        user_pairs = set()
+        new_pairs = []
+        skipped = 0
+
+        for created_user, with_user in pairs:
+            created_user_id = getattr(created_user, 'pk', created_user)
+            with_user_id = getattr(with_user, 'pk', with_user)
+            user_pair = self.get_user_pair_ids(created_user_id, with_user_id)
+
+            if created_user_id == with_user_id or user_pair in user_pairs:
+                skipped += 1
+                continue
 
+            user_pairs.add(user_pair)
+            new_pairs.append((created_user_id, with_user_id))
+
+        created = 0
+
+        for i in range(0, len(new_pairs), batch_size):
+            batch = new_pairs[i:i + batch_size]
+            batch_created = self._bulk_create_batch(batch, status=status)
+            created += batch_created
+            skipped += len(batch) - batch_created
+
+        return created, skipped
+
+    def _bulk_create_batch(self, pairs, status):
+        """Inserts a batch of connections skipping the ones that already
+        exist.
+
+        :param pairs: list of unique (created_user_id, with_user_id) tuples.
+        :param status: the status of the created connections.
+        :return: the number of connections created.
+        """
+        user_pairs = [self.get_user_pair_ids(*pair) for pair in pairs]
+        existing_user_pairs = set(self.filter(
+            low_user_id__in=set(pair[0] for pair in user_pairs),
+            high_user_id__in=set(pair[1] for pair in user_pairs)
+        ).values_list('low_user_id', 'high_user_id'))
+
+        pairs = [(pair, user_pair)
+                 for pair, user_pair in zip(pairs, user_pairs)
+                 if user_pair not in existing_user_pairs]
+
+        if not pairs:
+            return 0
+
+        # Same bulk token generation AbstractTokenModel.save_prep does, done
+        # here so save_prep doesn't load the created user for each instance.
+        tokens = self.get_available_tokens(
+            count=len(pairs),
+            token_length=self.model.token_length
+        )
+        utc_now = datetime.utcnow()
+        conns = [self.model(created_user_id=created_user_id,
+                            with_user_id=with_user_id,
+                            last_modified_user_id=created_user_id,
+                            low_user_id=low_user_id,
+                            high_user_id=high_user_id,
+                            status=status,
+                            token=token,
+                            created_dttm=utc_now,
+                            last_modified_dttm=utc_now)
+                 for ((created_user_id, with_user_id),
+                      (low_user_id, high_user_id)), token
+                 in zip(pairs, tokens)]
+
+        try:
+            using = self._db_for_write()
+
+            with transaction.atomic(using=using):
+                self.get_queryset().bulk_create(conns)
+                self.model.update_degrees(
+                    added=[conn.get_degree_row() for conn in conns],
+                    using=using
+                )
+        except IntegrityError:
+            # Some of the connections or tokens were created after the checks
+            # so fall back to inserting one at a time.
+            return sum(self._insert_or_skip(conn) for conn in conns)
+
+        # bulk_create doesn't send post_save signals.
+        cache.invalidate_user_ids(*[user_id
+                                    for pair, user_pair in pairs
+                                    for user_id in user_pair],
+                                  using=using)
+        return len(conns)
+
+    def _db_for_write(self):
+        """Gets the database alias to write connections to."""
+        return self._db or router.db_for_write(self.model)
+
+    def _supports_on_conflict(self, connection):
+        """Boolean indicating if the database supports
+        ``INSERT ... ON CONFLICT DO NOTHING RETURNING``.
         """
-        conn = self.get_for_users(user_1=created_user, user_2=with_user)
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90500
 
-        if conn:
-            return conn, False
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 35, 0)
 
-        return self.create(created_user=created_user,
-                           with_user=with_user,
-                           **kwargs), True
+        return False
 
     def get_for_users(self, user_1, user_2):
-        """Gets a connection between two users.
+        """Gets a connection between two users using the canonical user pair
+        so this is a single unique index lookup.
 
+        :param user_1: a user object or user id.
+        :param user_2: a user object or user id.
         :returns: single connection object between the two users.
         """
+        low_user_id, high_user_id = self.get_user_pair_ids(user_1, user_2)
+
         try:
-            return self.get((Q(created_user=user_1) & Q(with_user=user_2)) |
-                            (Q(created_user=user_2) & Q(with_user=user_1)))
+            return self.get(low_user_id=low_user_id, high_user_id=high_user_id)
         except self.model.DoesNotExist:
             return None
 
-    def get_by_user(self, user, **kwargs):
+    def get_record(self, connection_id=None, token=None):
+        """Gets the ConnectionRecord (id, user ids and status) of a connection
+        by id or token. Records are cached and invalidated whenever the
+        connection is saved, changes status or is deleted so checking if a
+        user is part of a connection usually doesn't query the database.
+
+        :param connection_id: the id of the connection.
+        :param token: the token of the connection.
+        :return: the ConnectionRecord or None if the connection doesn't exist.
+        """
+        if token is not None:
+            connection_id = cache.get_connection_id_for_token(token)
+
+        if connection_id is not None:
+            record = cache.get_connection_record(connection_id)
+
+            if record is not None:
+                return record
+
+            queryset = self.filter(id=connection_id)
+        else:
+            queryset = self.filter(token=token)
+
+        row = queryset.values_list('id',
+                                   'created_user_id',
+                                   'with_user_id',
+                                   'status').first()
+
+        if row is None:
+            return None
+
+        record = cache.ConnectionRecord(*row)
+        cache.set_connection_record(record)
+
+        if token is not None:
+            cache.set_connection_id_for_token(token, record.id)
+
+        return record
+
+    def connected_users_for(self, user, connections):
+        """Resolves the connected user (the user who isn't `user`) for many
+        connections at once. Users that aren't already loaded on the
+        connections are loaded with a single ``in_bulk`` query and each user
+        is only ever loaded once. The users are set on the connections so
+        ``get_connected_user`` won't run any queries afterwards.
+
+        :param user: the user the connections are for.
+        :param connections: iterable of connections.
+        :return: dict of connection id to the connected user.
+        """
+        connections = list(connections)
+        users_by_id = {}
+
+        if hasattr(user, 'pk'):
+            users_by_id[user.pk] = user
+
+        for conn in connections:
+            for field_name in ('created_user', 'with_user'):
+                cached_user = get_cached_related(conn, field_name)
+
+                if cached_user is not None:
+                    users_by_id.setdefault(cached_user.pk, cached_user)
+
+        missing_user_ids = set(user_id for conn in connections
+                               for user_id in conn.user_ids
+                               if user_id not in users_by_id)
+
+        if missing_user_ids:
+            users_by_id.update(
+                get_user_model().objects.in_bulk(list(missing_user_ids)))
+
+        connected_users = {}
+
+        for conn in connections:
+            for field_name in ('created_user', 'with_user'):
+                conn_user = users_by_id.get(
+                    getattr(conn, '{0}_id'.format(field_name)))
+
+                if conn_user is not None:
+                    setattr(conn, field_name, conn_user)
+
+            connected_users[conn.id] = users_by_id.get(
+                conn.get_connected_user_id(user))
+
+        return connected_users
+
+    def get_connection_count(self, user, status=Status.ACCEPTED):
+        """Gets the number of connections a user has with a status. When
+        degrees are tracked (see the USER_CONNECTIONS_TRACK_DEGREES setting)
+        this is a single row lookup instead of counting the connections.
+
+        :param user: a user object or user id.
+        :param status: the status of the connections to count.
+        """
+        user_id = getattr(user, 'pk', user)
+
+        if self.model.tracks_degrees():
+            return self.model.get_degree_model().objects.get_count(
+                user_id,
+                status=status
+            )
+
+        return self.get_by_user_id(user_id, status=status).count()
+
+    def get_user_pair_ids(self, user_1, user_2):
+        """Gets the canonical (low_user_id, high_user_id) pair for two users.
+
+        :param user_1: a user object or user id.
+        :param user_2: a user object or user id.
+        """
+        return tuple(sorted([getattr(user_1, 'pk', user_1),
+                             getattr(user_2, 'pk', user_2)]))
+
+    def get_by_user(self, user, strategy=None, **kwargs):
         """Gets all connections for a user for both connections this
         user created as well as connections that were created by other with
         this user.
 
         """
-        return self.get_by_user_id(user_id=user.id, **kwargs)
+        return self.get_by_user_id(user_id=user.id, strategy=strategy,
+                                   **kwargs)
 
-    def get_by_user_id(self, user_id, **kwargs):
+    def get_by_user_id(self, user_id, strategy=None, **kwargs):
         """Gets all connections for a user by a user id for both connections
         this user created as well as connections that were created by other
         with this user.
+
+        :param user_id: the id of the user the connections are for.
+        :param strategy: how the connections are queried. Either 'or' for a
+            single query with an OR over the created_user and with_user
+            columns or 'union' for the UNION ALL of a query on each column
+            (see UserConnectionQuerySet.for_user_union). The union is usually
+            faster for large tables since each query can use its own index.
+            Defaults to the USER_CONNECTIONS_BY_USER_STRATEGY setting or
+            'or'.
+        :param kwargs: additional filter criteria for the connections.
         """
+        if strategy is None:
+            strategy = getattr(settings, 'USER_CONNECTIONS_BY_USER_STRATEGY',
+                               'or')
+
+        if strategy == 'union':
+            return self.get_queryset().for_user_union(user_id).filter(**kwargs)
+
+        if strategy != 'or':
+            raise ImproperlyConfigured('Unknown connections by user strategy '
+                                       '"{0}".'.format(strategy))
+
         return self.filter(Q(created_user__id=user_id) |
                            Q(with_user__id=user_id)).filter(**kwargs)
 
+    def get_page_by_user(self, user, after=None, page_size=25, **kwargs):
+        """Gets a page of a user's connections ordered by activity count with
+        keyset pagination. See UserConnectionQuerySet.page.
+
+        The page is read with a query on each user column which is backed by
+        the (created_user, status, activity_count, id) and (with_user, status,
+        activity_count, id) indexes when filtering by status.
+
+        :param user: a user object or user id.
+        :param after: the cursor of the last connection on the previous page.
+        :param page_size: the max number of connections on the page.
+        :param kwargs: additional filter criteria for the connections.
+        :return: tuple of the list of connections on the page and the cursor
+            for the next page or None if this is the last page.
+        """
+        return self.get_queryset().for_user_union(
+            getattr(user, 'pk', user)
+        ).filter(**kwargs).page(after=after, page_size=page_size)
+
+    def search_by_user(self, user, term, after=None, **kwargs):
+        """Searches a user's connections by a prefix of the connected user's
+        name. The connections are ordered newest first so they can be paged
+        with the ``after`` cursor.
+
+        The user fields searched can be set with the
+        USER_CONNECTIONS_SEARCH_FIELDS setting. Defaults to username, first
+        name and last name.
+
+        :param user: the user the connections are for.
+        :param term: the prefix of the connected user's name to search for.
+        :param after: the id of the last connection on the previous page.
+        :param kwargs: additional filter criteria for the connections.
+        """
+        search_fields = getattr(settings, 'USER_CONNECTIONS_SEARCH_FIELDS',
+                                ('username', 'first_name', 'last_name'))
+        q_created_user = Q()
+        q_with_user = Q()
+
+        for search_field in search_fields:
+            q_created_user |= Q(**{
+                'created_user__{0}__istartswith'.format(search_field): term
+            })
+            q_with_user |= Q(**{
+                'with_user__{0}__istartswith'.format(search_field): term
+            })
+
+        queryset = self.filter((Q(created_user_id=user.id) & q_with_user) |
+                               (Q(with_user_id=user.id) & q_created_user))
+
+        if after is not None:
+            queryset = queryset.filter(id__lt=after)
+
+        return queryset.filter(**kwargs).order_by('-id')
+
     def get_user_ids(self, user_id, **kwargs):
-        """Gets a set of all the user ids this user has connections with."""
-        # TODO: This should be cached since it's not something that will change
-        #       very often.
+        """Gets a list of all the user ids this user has connections with.
+
+        When no filters other than ``status`` are passed, the result is cached
+        per user and status and invalidated whenever one of the user's
+        connections is saved or deleted.
+        """
+        is_cacheable = set(kwargs).issubset(('status',))
+        status = kwargs.get('status')
+
+        if is_cacheable:
+            conn_user_ids = cache.get_user_ids(user_id, status=status)
+
+            if conn_user_ids is not None:
+                return conn_user_ids
+
         user_ids = self.get_by_user_id(user_id, **kwargs).values_list(
             'created_user',
             'with_user'
         )
 
-        if not user_ids:
-            return []
-
-        conn_user_ids = []
+        conn_user_ids = set()
         for users in user_ids:
-            for usr_id in users:
-                if usr_id != user_id:
-                    conn_user_ids.append(usr_id)
+            conn_user_ids.update(users)
+
+        conn_user_ids.discard(user_id)
+        conn_user_ids = list(conn_user_ids)
+
+        if is_cacheable:
+            cache.set_user_ids(user_id, conn_user_ids, status=status)
+
+        return conn_user_ids
+
+    def mutual_connection_ids(self, user_a, user_b, status=Status.ACCEPTED):
+        """Gets the ids of the users both users are connected with in a single
+        query.
+
+        :param user_a: a user object or user id.
+        :param user_b: a user object or user id.
+        :param status: the status of the connections to follow. None follows
+            connections of any status.
+        :return: list of user ids.
+        """
+        a_sql, a_params = self._connected_user_ids_sql(
+            [getattr(user_a, 'pk', user_a)], status=status)
+        b_sql, b_params = self._connected_user_ids_sql(
+            [getattr(user_b, 'pk', user_b)], status=status)
+        query = ('SELECT a.other_id FROM ({0}) a '
+                 'INNER JOIN ({1}) b ON a.other_id = b.other_id '
+                 'ORDER BY a.other_id').format(a_sql, b_sql)
+
+        return [row[0] for row in self._fetchall(query, a_params + b_params)]
+
+    def mutual_counts(self, user, candidate_ids, status=Status.ACCEPTED):
+        """Gets the number of mutual connections between a user and each of
+        the candidate users in a single query.
+
+        :param user: a user object or user id.
+        :param candidate_ids: the ids of the users to count the mutual
+            connections with.
+        :param status: the status of the connections to follow. None follows
+            connections of any status.
+        :return: dict of candidate user id to mutual connection count.
+            Candidates with no mutual connections have a count of 0.
+        """
+        candidate_ids = list(set(candidate_ids))
+        counts = dict((candidate_id, 0) for candidate_id in candidate_ids)
+
+        if not candidate_ids:
+            return counts
+
+        user_sql, user_params = self._connected_user_ids_sql(
+            [getattr(user, 'pk', user)], status=status)
+        cand_sql, cand_params = self._connected_user_ids_sql(candidate_ids,
+                                                             status=status)
+        query = ('SELECT c.user_id, COUNT(*) FROM ({0}) c '
+                 'INNER JOIN ({1}) u ON c.other_id = u.other_id '
+                 'GROUP BY c.user_id').format(cand_sql, user_sql)
+
+        counts.update(self._fetchall(query, cand_params + user_params))
+        return counts
+
+    def second_degree_suggestions(self, user, limit=10,
+                                  status=Status.ACCEPTED):
+        """Gets the users connected with the user's connections ("people you
+        may know") in a single query. Users the user already has a connection
+        with (of any status) aren't included.
+
+        Suggestions are ranked by the number of mutual connections and then by
+        the combined activity count of the connections through the mutual
+        connections.
+
+        :param user: a user object or user id.
+        :param limit: the max number of suggestions to return.
+        :param status: the status of the connections to follow. None follows
+            connections of any status.
+        :return: list of (user id, mutual connection count) tuples.
+        """
+        user_id = getattr(user, 'pk', user)
+        first_sql, first_params = self._connected_user_ids_sql([user_id],
+                                                               status=status)
+        # Only the rows of the user's connections are read for the second
+        # hop instead of every connection.
+        second_sql, second_params = self._connected_user_ids_sql(
+            None, status=status, user_ids_query=(
+                'SELECT c.other_id FROM ({0}) c'.format(first_sql),
+                first_params))
+        existing_sql, existing_params = self._connected_user_ids_sql(
+            [user_id], status=None)
+        query = (
+            'SELECT s.other_id, COUNT(*) AS mutual_count, '
+            'SUM(f.activity_count + s.activity_count) AS activity '
+            'FROM ({0}) f '
+            'INNER JOIN ({1}) s ON s.user_id = f.other_id '
+            'WHERE s.other_id <> %s '
+            'AND s.other_id NOT IN (SELECT e.other_id FROM ({2}) e) '
+            'GROUP BY s.other_id '
+            'ORDER BY mutual_count DESC, activity DESC, s.other_id '
+            'LIMIT %s'
+        ).format(first_sql, second_sql, existing_sql)
+        params = (first_params + second_params + [user_id] +
+                  existing_params + [limit])
+
+        return [(row[0], row[1]) for row in self._fetchall(query, params)]
+
+    def _connected_user_ids_sql(self, user_ids, status=None,
+                                user_ids_query=None):
+        """Gets the sql and params for a derived table of (user_id, other_id,
+        activity_count) rows with one row per direction of each connection
+        (a UNION ALL over the ``created_user`` and ``with_user`` columns) so
+        each side can use its own user index.
+
+        :param user_ids: only include rows for these user ids. None includes
+            all users.
+        :param status: only include connections with this status. None
+            includes all status'.
+        :param user_ids_query: (sql, params) of a subquery selecting the user
+            ids to include rows for. Used instead of ``user_ids``.
+        """
+        opts = self.model._meta
+        qn = connections[self.db].ops.quote_name
+        created_user = qn(opts.get_field('created_user').column)
+        with_user = qn(opts.get_field('with_user').column)
+        activity_count = qn(opts.get_field('activity_count').column)
+        status_col = qn(opts.get_field('status').column)
+        table = qn(opts.db_table)
+
+        selects = []
+        params = []
+
+        for user_col, other_col in ((created_user, with_user),
+                                    (with_user, created_user)):
+            where = []
+
+            if user_ids_query is not None:
+                where.append('{0} IN ({1})'.format(user_col,
+                                                   user_ids_query[0]))
+                params += list(user_ids_query[1])
+            elif user_ids is not None:
+                where.append('{0} IN ({1})'.format(
+                    user_col, ', '.join(['%s'] * len(user_ids))))
+                params += list(user_ids)
+
+            if status is not None:
+                where.append('{0} = %s'.format(status_col))
+                params.append(status)
+
+            selects.append(
+                'SELECT {0} AS user_id, {1} AS other_id, '
+                '{2} AS activity_count FROM {3}{4}'.format(
+                    user_col, other_col, activity_count, table,
+                    ' WHERE ' + ' AND '.join(where) if where else ''
+                )
+            )
+
+        return ' UNION ALL '.join(selects), params
+
+    def _fetchall(self, query, params):
+        cursor = connections[self.db].cursor()
+
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+class UserConnectionDegreeManager(Manager):
+    """Manager for the denormalized connection counts per user and status."""
+
+    def get_count(self, user, status=Status.ACCEPTED):
+        """Gets the number of connections a user has with a status.
+
+        :param user: a user object or user id.
+        :param status: the status of the connections.
+        """
+        count = self.filter(user_id=getattr(user, 'pk', user),
+                            status=status).values_list('count',
+                                                       flat=True).first()
+        return count or 0
+
+    def adjust(self, changes, using=None):
+        """Adds to the connection counts. Rows that don't exist yet are
+        created. This should be called in the same transaction as the change
+        to the connections.
+
+        :param changes: dict of (user id, status) tuples to the number to add
+            to the count. Can be negative.
+        :param using: the database alias to write to.
+        """
+        changes = dict((key, delta) for key, delta in changes.items() if delta)
+
+        if not changes:
+            return
+
+        using = using or self._db or router.db_for_write(self.model)
+        queryset = self.db_manager(using).get_queryset()
+        existing_keys = set(queryset.filter(self._get_keys_q(changes))
+                                    .values_list('user_id', 'status'))
+        new_degrees = [self.model(user_id=user_id, status=status, count=delta)
+                       for (user_id, status), delta in changes.items()
+                       if (user_id, status) not in existing_keys]
+
+        if new_degrees:
+            try:
+                with transaction.atomic(using=using):
+                    queryset.bulk_create(new_degrees)
+            except IntegrityError:
+                # Created concurrently so fall back to one key at a time.
+                for (user_id, status), delta in changes.items():
+                    if (user_id, status) not in existing_keys:
+                        self._adjust_one(queryset, user_id, status, delta)
+
+        keys_by_delta = defaultdict(list)
+
+        for key, delta in changes.items():
+            if key in existing_keys:
+                keys_by_delta[delta].append(key)
+
+        for delta, keys in keys_by_delta.items():
+            queryset.filter(self._get_keys_q(keys)).update(
+                count=F('count') + delta
+            )
+
+    def _adjust_one(self, queryset, user_id, status, delta):
+        keys_q = self._get_keys_q([(user_id, status)])
+
+        if queryset.filter(keys_q).update(count=F('count') + delta):
+            return
+
+        try:
+            with transaction.atomic(using=queryset.db):
+                queryset.create(user_id=user_id, status=status, count=delta)
+        except IntegrityError:
+            queryset.filter(keys_q).update(count=F('count') + delta)
+
+    def _get_keys_q(self, keys):
+        keys_q = Q()
+
+        for user_id, status in keys:
+            keys_q |= Q(user_id=user_id, status=status)
+
+        return keys_q
+
+    def get_expected_counts(self, connection_model):
+        """Counts the connections per user and status from the connection
+        table. A connection of a user with themselves counts once.
+
+        :param connection_model: the user connection model class.
+        :return: dict of (user id, status) tuples to the number of connections.
+        """
+        counts = defaultdict(int)
+        queryset = connection_model.objects.order_by()
+
+        for field_name, field_queryset in (
+                ('created_user_id', queryset),
+                ('with_user_id',
+                 queryset.exclude(with_user_id=F('created_user_id')))):
+            rows = field_queryset.values_list(field_name, 'status').annotate(
+                count=Count('id')
+            )
+
+            for user_id, status, count in rows:
+                counts[(user_id, status)] += count
+
+        return dict(counts)
+
+    def rebuild(self, connection_model):
+        """Replaces all connection counts with the counts from the connection
+        table.
+
+        :param connection_model: the user connection model class.
+        :return: the number of rows written.
+        """
+        counts = self.get_expected_counts(connection_model)
+        using = self._db or router.db_for_write(self.model)
+
+        with transaction.atomic(using=using):
+            self.db_manager(using).all().delete()
+            self.db_manager(using).bulk_create(
+                [self.model(user_id=user_id, status=status, count=count)
+                 for (user_id, status), count in counts.items()],
+                batch_size=1000
+            )
+
+        return len(counts)
+
+    def verify(self, connection_model):
+        """Compares the connection counts to the counts from the connection
+        table.
+
+        :param connection_model: the user connection model class.
+        :return: dict of (user id, status) tuples to (expected count, actual
+            count) tuples for every count that's wrong.
+        """
+        expected_counts = self.get_expected_counts(connection_model)
+        actual_counts = dict(
+            ((user_id, status), count)
+            for user_id, status, count in self.values_list('user_id',
+                                                           'status',
+                                                           'count')
+        )
+        mismatches = {}
+
+        for key in set(expected_counts).union(actual_counts):
+            expected = expected_counts.get(key, 0)
+            actual = actual_counts.get(key, 0)
+
+            if expected != actual:
+                mismatches[key] = (expected, actual)
 
-        return list(set(conn_user_ids))
+        return mismatches
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserConnection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(db_index=True, max_length=100, unique=True)),
+                ('created_dttm', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('last_modified_dttm', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('status', models.CharField(choices=[('ACCEPTED', 'Accepted'), ('DECLINED', 'Declined'), ('PENDING', 'Pending'), ('INACTIVE', 'Inactive')], default='PENDING', max_length=25)),
+                ('activity_count', models.IntegerField(default=1)),
+                ('created_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_connections_userconnection_created_user+', to=settings.AUTH_USER_MODEL)),
+                ('last_modified_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_connections_userconnection_last_modified_user+', to=settings.AUTH_USER_MODEL)),
+                ('with_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='connections', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-id',),
+                'abstract': False,
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='userconnection',
+            index_together=set([('created_user', 'with_user')]),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models import F
+
+from user_connections.constants import Status
+
+
+def fill_user_pairs(apps, schema_editor):
+    """Sets the canonical (low_user, high_user) pair of the existing
+    connections and merges the connections that are duplicates of the same
+    pair of users so the pair can be made unique.
+
+    Of the duplicates the accepted connection, or else the oldest one, is kept
+    and the activity counts of the others are added to it.
+    """
+    UserConnection = apps.get_model('user_connections', 'UserConnection')
+    connections = UserConnection.objects.using(schema_editor.connection.alias)
+
+    connections.filter(created_user_id__lte=F('with_user_id')).update(
+        low_user=F('created_user'),
+        high_user=F('with_user')
+    )
+    connections.filter(created_user_id__gt=F('with_user_id')).update(
+        low_user=F('with_user'),
+        high_user=F('created_user')
+    )
+
+    # The default ordering would otherwise be added to the GROUP BY.
+    duplicate_pairs = list(connections.order_by().values(
+        'low_user_id',
+        'high_user_id'
+    ).annotate(count=Count('id')).filter(count__gt=1).values_list(
+        'low_user_id',
+        'high_user_id'
+    ))
+
+    for low_user_id, high_user_id in duplicate_pairs:
+        pair_connections = connections.filter(low_user_id=low_user_id,
+                                              high_user_id=high_user_id)
+        rows = list(pair_connections.values_list('id', 'status',
+                                                 'activity_count'))
+        keep_id = min(rows, key=lambda row: (row[1] != Status.ACCEPTED,
+                                             row[0]))[0]
+        activity_count = sum(row[2] for row in rows if row[0] != keep_id)
+
+        pair_connections.filter(id=keep_id).update(
+            activity_count=F('activity_count') + activity_count)
+        pair_connections.exclude(id=keep_id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_connections', '0002_userconnection_user_pair'),
+    ]
+
+    # Merged duplicates can't be restored so reversing only leaves the pair
+    # columns to be dropped by 0002.
+    operations = [
+        migrations.RunPython(fill_user_pairs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('user_connections', '0004_unique_user_pair'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserConnectionDegree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('ACCEPTED', 'Accepted'), ('DECLINED', 'Declined'), ('PENDING', 'Pending'), ('INACTIVE', 'Inactive')], max_length=25)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='userconnectiondegree',
+            unique_together=set([('user', 'status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userconnection',
+            index_together=set([('created_user', 'status', 'activity_count', 'id'), ('with_user', 'status', 'activity_count', 'id'), ('created_user', 'with_user')]),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from user_connections.constants import Status
+
+
+# Partial indexes for the accepted connections of a user ordered by activity
+# count. These are much smaller than the full (user, status, activity_count,
+# id) indexes since most connections are typically accepted but most rows
+# aren't read per request. Django doesn't support partial indexes so they're
+# created with sql on the databases that support them.
+ACCEPTED_INDEXES = (
+    ('user_connections_created_user_accepted', 'created_user_id'),
+    ('user_connections_with_user_accepted', 'with_user_id'),
+)
+
+
+def supports_partial_indexes(schema_editor):
+    return schema_editor.connection.vendor in ('postgresql', 'sqlite')
+
+
+def create_accepted_indexes(apps, schema_editor):
+    if not supports_partial_indexes(schema_editor):
+        return
+
+    UserConnection = apps.get_model('user_connections', 'UserConnection')
+    qn = schema_editor.quote_name
+
+    for index_name, column in ACCEPTED_INDEXES:
+        # SQLite doesn't allow parameters in an index so the status is a
+        # literal.
+        schema_editor.execute(
+            'CREATE INDEX {0} ON {1} ({2}, {3} DESC, {4} DESC) '
+            "WHERE {5} = '{6}'".format(qn(index_name),
+                                       qn(UserConnection._meta.db_table),
+                                       qn(column),
+                                       qn('activity_count'),
+                                       qn('id'),
+                                       qn('status'),
+                                       Status.ACCEPTED)
+        )
+
+
+def drop_accepted_indexes(apps, schema_editor):
+    if not supports_partial_indexes(schema_editor):
+        return
+
+    for index_name, column in ACCEPTED_INDEXES:
+        schema_editor.execute('DROP INDEX {0}'.format(
+            schema_editor.quote_name(index_name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_connections', '0005_connection_degrees_and_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_accepted_indexes, drop_accepted_indexes),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_connections', '0006_accepted_connection_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userconnection',
+            index_together=set([('created_user', 'with_user'), ('created_user', 'status', 'activity_count', 'id'), ('high_user', 'low_user'), ('with_user', 'status', 'activity_count', 'id')]),
+        ),
+    ]
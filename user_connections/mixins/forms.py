@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 from django_core.forms.mixins.users import UserFormMixin
 
 from ..forms.fields import BaseUserConnectionFieldMixin
+from ..forms.fields import UserConnectionChoices
 
 
 class UserConnectionsFormMixin(UserFormMixin):
@@ -21,14 +22,31 @@ class UserConnectionsFormMixin(UserFormMixin):
         super(UserConnectionsFormMixin, self).__init__(*args, **kwargs)
 
         # Updates any BaseUserConnectionFieldMixin fields with the user and
-        # user_connections
+        # user_connections. The connections are only evaluated and sorted once
+        # and shared by all the fields that load them the same way.
+        choices_by_key = {}
+
         for key, field in self.fields.items():
             if isinstance(field, BaseUserConnectionFieldMixin):
-                if self.user:
-                    field.user = self.user
-
-                if self.user_connections:
-                    field.user_connections = self.user_connections
+                if self.user and self.user_connections is not None:
+                    choices_key = field.get_connection_choices_key()
+                    connection_choices = choices_by_key.get(choices_key)
+
+                    if connection_choices is None:
+                        connection_choices = UserConnectionChoices(
+                            user=self.user,
+                            user_connections=self.user_connections,
+                            user_loading_strategy=field.user_loading_strategy,
+                            user_fields=field.user_fields)
+                        choices_by_key[choices_key] = connection_choices
+
+                    field.connection_choices = connection_choices
+                else:
+                    if self.user:
+                        field.user = self.user
+
+                    if self.user_connections:
+                        field.user_connections = self.user_connections
 
                 if self.exclude_user_ids:
                     field.exclude_user_ids = self.exclude_user_ids
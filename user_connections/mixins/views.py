@@ -1,16 +1,31 @@
 from __future__ import unicode_literals
 
-from django.contrib.auth import get_user_model
+from collections import OrderedDict
+
+from django.db.models import Count
+from django.db.models.query import QuerySet
 from django.http.response import Http404
+from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
+from django.utils.functional import SimpleLazyObject
+from django.utils.functional import new_method_proxy
 
 from .. import get_user_connection_model
 from ..constants import Status
+from ..managers import get_connection_cursor
+from ..managers import parse_connection_cursor
 
 
 UserConnection = get_user_connection_model()
 
 
+class LazyIterable(SimpleLazyObject):
+    """SimpleLazyObject that can also be iterated. Django < 1.9 doesn't proxy
+    ``__iter__`` so iterating a lazy dict looks items up by index instead.
+    """
+    __iter__ = new_method_proxy(iter)
+
+
 class UserConnectionViewMixin(object):
     """Gets a user connection by the user connection_id from the url.  The
     user connection can be retrieved in one of three ways via url args.
@@ -30,7 +45,15 @@ class UserConnectionViewMixin(object):
         an all digit value that it's referring to a connection id.  If the
         value is not a digit, it will try to get the connection by username.
     * user_connection: the UserConnection object for the users connected.
+        When the connection is found by id or token, whether the
+        authenticated user is part of the connection is checked with the
+        cached connection record (see UserConnectionManager.get_record) and
+        the connection is only loaded when it's used.
     * connection_user: the user the authenticated user is connected with.
+    * user_loading_strategy: how the connected users are loaded. See
+        UserConnectionQuerySet.with_users.
+    * user_fields: the user fields to load. See
+        UserConnectionQuerySet.with_users.
     """
     pk_url_kwarg = 'connection_id'
     connection_id_pk_url_kwarg = 'connection_id'
@@ -38,47 +61,62 @@ class UserConnectionViewMixin(object):
     connection_user = None
     model = UserConnection
     context_object_name = 'user_connection'
+    user_loading_strategy = None
+    user_fields = None
 
     def dispatch(self, *args, **kwargs):
         connection_key = kwargs.get(self.connection_id_pk_url_kwarg)
+        user_connection_record = None
 
         if 'connection_token' in kwargs:
             # Attempting to get the user connection by the connection token.
-            self.user_connection = UserConnection.objects.get_by_token_or_404(
+            user_connection_record = UserConnection.objects.get_record(
                 token=kwargs.get('connection_token'))
         elif connection_key.isdigit():
             # It's the connection primary key object (integer).
-            self.user_connection = UserConnection.objects.get_by_id_or_404(
-                id=kwargs.get(self.connection_id_pk_url_kwarg),
-                prefetch_related=('with_user',))
-
+            user_connection_record = UserConnection.objects.get_record(
+                connection_id=int(connection_key))
         else:
             # The connection key is a username (string)
-            if self.request.user.username == connection_key:
+            if self.request.user.get_username() == connection_key:
                 return redirect('/')
 
-            User = get_user_model()
-
-            try:
-                connection_user = User.objects.get(username=connection_key)
-            except:
-                raise Http404
+            (self.user_connection,
+             self.connection_user) = self.get_user_connection_queryset(
+            ).get_for_user_and_username(user=self.request.user,
+                                        username=connection_key)
+            user_connection_record = self.user_connection
 
-            self.user_connection = UserConnection.objects.get_for_users(
-                user_1=self.request.user,
-                user_2=connection_user)
+        if (user_connection_record is None or
+                self.request.user.id not in user_connection_record.user_ids):
+            # The connection doesn't exist or doesn't belong to the
+            # authenticated user
+            raise Http404
 
-            if not self.user_connection:
-                raise Http404
+        if self.user_connection is None:
+            # The ownership check was done with the cached connection record
+            # so only load the connection if it's used.
+            self.user_connection = SimpleLazyObject(
+                lambda: self.get_user_connection(user_connection_record.id))
 
-        if self.request.user.id not in self.user_connection.user_ids:
-            # This connection doesn't belong to the authenticated user
-            raise Http404
+        if self.connection_user is None:
+            self.connection_user = SimpleLazyObject(
+                lambda: self.user_connection.get_connected_user(
+                    user=self.request.user))
 
-        self.connection_user = self.user_connection.get_connected_user(
-            user=self.request.user)
         return super(UserConnectionViewMixin, self).dispatch(*args, **kwargs)
 
+    def get_user_connection(self, connection_id):
+        """Gets the user connection for the view by id."""
+        return get_object_or_404(self.get_user_connection_queryset(),
+                                 id=connection_id)
+
+    def get_user_connection_queryset(self):
+        """Gets the queryset the user connection is retrieved from."""
+        return UserConnection.objects.with_users(
+            strategy=self.user_loading_strategy,
+            user_fields=self.user_fields)
+
     def get_context_data(self, **kwargs):
         context = super(UserConnectionViewMixin,
                         self).get_context_data(**kwargs)
@@ -94,8 +132,16 @@ class UserConnectionSingleObjectViewMixin(UserConnectionViewMixin):
 
 
 class BaseUserConnectionsViewMixin(object):
-    """Base user connection mixin."""
+    """Base user connection mixin.
+
+    * user_loading_strategy: how the connected users are loaded. See
+        UserConnectionQuerySet.with_users.
+    * user_fields: the user fields to load. See
+        UserConnectionQuerySet.with_users.
+    """
     user_connections = None
+    user_loading_strategy = None
+    user_fields = None
 
     def get_user_connections(self, **kwargs):
         if self.user_connections:
@@ -103,9 +149,9 @@ class BaseUserConnectionsViewMixin(object):
 
         return (UserConnection.objects.get_by_user(user=self.request.user,
                                                    **kwargs)
-                              .order_by('-activity_count')
-                              .prefetch_related('created_user',
-                                                'with_user'))
+                              .order_by('-activity_count', '-id')
+                              .with_users(strategy=self.user_loading_strategy,
+                                          user_fields=self.user_fields))
 
 
 class UserConnectionsViewMixin(BaseUserConnectionsViewMixin):
@@ -117,12 +163,23 @@ class UserConnectionsViewMixin(BaseUserConnectionsViewMixin):
     * user_connections_inactivated: queryset of inactivated user connections
     * connection_user_ids: a list of user ids the authenticated user is
         connected with.
+    * user_connection_counts: dict of status to the number of connections the
+        authenticated user has with that status. This is loaded lazily with a
+        single query.
+    * partition_user_connections: boolean indicating if all the user's
+        connections should be loaded with a single query and split by status
+        in python instead of running a query per status. The status
+        attributes are then lazily evaluated lists instead of querysets.
+        Default is False.
     """
     user_connections_accepted = None
     user_connections_declined = None
     user_connections_pending = None
     user_connections_inactivated = None
     connection_user_ids = None
+    partition_user_connections = False
+    _user_connections_by_status = None
+    _user_connection_counts = None
 
     def dispatch(self, *args, **kwargs):
         """Puts the querysets by type on the view.  The benefit to this the
@@ -130,14 +187,26 @@ class UserConnectionsViewMixin(BaseUserConnectionsViewMixin):
         if no pending connection are wanted, no queries are run for that type.
         """
         self.user_connections = self.get_user_connections()
-        self.user_connections_accepted = self.user_connections.filter(
-            status=Status.ACCEPTED)
-        self.user_connections_declined = self.user_connections.filter(
-            status=Status.DECLINED)
-        self.user_connections_pending = self.user_connections.filter(
-            status=Status.PENDING)
-        self.user_connections_inactivated = self.user_connections.filter(
-            status=Status.INACTIVE)
+
+        if self.partition_user_connections:
+            self.user_connections_accepted = self._get_lazy_user_connections(
+                status=Status.ACCEPTED)
+            self.user_connections_declined = self._get_lazy_user_connections(
+                status=Status.DECLINED)
+            self.user_connections_pending = self._get_lazy_user_connections(
+                status=Status.PENDING)
+            self.user_connections_inactivated = (
+                self._get_lazy_user_connections(status=Status.INACTIVE))
+        else:
+            self.user_connections_accepted = self.user_connections.filter(
+                status=Status.ACCEPTED)
+            self.user_connections_declined = self.user_connections.filter(
+                status=Status.DECLINED)
+            self.user_connections_pending = self.user_connections.filter(
+                status=Status.PENDING)
+            self.user_connections_inactivated = self.user_connections.filter(
+                status=Status.INACTIVE)
+
         self.connection_user_ids = UserConnection.objects.get_user_ids(
             user_id=self.request.user.id)
         return super(UserConnectionsViewMixin, self).dispatch(*args, **kwargs)
@@ -149,27 +218,169 @@ class UserConnectionsViewMixin(BaseUserConnectionsViewMixin):
         # I could also create lambda functions here that just sorts through
         # the user_connections to get the correct status'.  The problem with
         # that is I can't filter the query further by leveraging a queryset.
+        # If that's not needed, set partition_user_connections = True.
         context['user_connections_accepted'] = self.user_connections_accepted
         context['user_connections_declined'] = self.user_connections_declined
         context['user_connections_pending'] = self.user_connections_pending
         context['user_connections_inactivated'] = self.user_connections_inactivated
         context['connection_user_ids'] = self.connection_user_ids
+        context['user_connection_counts'] = SimpleLazyObject(
+            self.get_user_connection_counts)
         return context
 
+    def get_user_connections_by_status(self):
+        """Gets the user's connections split by status. All connections are
+        loaded with a single query the first time this is called and the
+        result is memoized on the view.
+
+        :return: dict of status to a list of connections with that status.
+        """
+        if self._user_connections_by_status is None:
+            user_connections_by_status = dict(
+                (status, []) for status, label in Status.CHOICES)
 
-class UserConnectionsByUserViewMixin(UserConnectionsViewMixin):
+            for conn in self.user_connections:
+                user_connections_by_status[conn.status].append(conn)
+
+            self._user_connections_by_status = user_connections_by_status
+
+        return self._user_connections_by_status
+
+    def get_user_connection_counts(self):
+        """Gets the number of connections by status for the authenticated
+        user. This is a single aggregate query unless the connections have
+        already been loaded and split by status.
+
+        :return: dict of status to the number of connections with that status.
+        """
+        if self._user_connection_counts is None:
+            counts = dict((status, 0) for status, label in Status.CHOICES)
+
+            if self._user_connections_by_status is not None:
+                counts.update((status, len(conns)) for status, conns
+                              in self._user_connections_by_status.items())
+            else:
+                counts.update(
+                    UserConnection.objects.get_by_user(user=self.request.user)
+                                          .order_by()
+                                          .values_list('status')
+                                          .annotate(count=Count('id'))
+                )
+
+            self._user_connection_counts = counts
+
+        return self._user_connection_counts
+
+    def _get_lazy_user_connections(self, status):
+        return SimpleLazyObject(
+            lambda: self.get_user_connections_by_status()[status])
+
+
+class UserConnectionsPageViewMixin(BaseUserConnectionsViewMixin):
+    """View mixin for paging through the authenticated user's connections
+    ordered by activity count with keyset (cursor) pagination so deep pages
+    are as fast as the first one.  See UserConnectionQuerySet.page.
+
+    * user_connections_page: list of the connections on the current page. It's
+        only loaded when it's used.
+    * connections_next_cursor: the cursor for the next page or None if this is
+        the last page.
+    * connections_page_size: the number of connections per page.
+    * connections_cursor_param: the GET param the page cursor is read from.
+    * connections_status: the status of the connections that are paged.
+    """
+    user_connections_page = None
+    connections_page_size = 25
+    connections_cursor_param = 'connections_after'
+    connections_status = Status.ACCEPTED
+    _user_connections_page = None
+
+    def dispatch(self, *args, **kwargs):
+        self.user_connections_page = SimpleLazyObject(
+            lambda: self.get_user_connections_page()[0])
+        return super(UserConnectionsPageViewMixin, self).dispatch(*args,
+                                                                  **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(UserConnectionsPageViewMixin,
+                        self).get_context_data(**kwargs)
+        context['user_connections_page'] = self.user_connections_page
+        # Callables are evaluated by the template only when used.
+        context['connections_next_cursor'] = self.get_connections_next_cursor
+        return context
+
+    def get_connections_cursor(self):
+        """Gets the cursor of the last connection on the previous page from the
+        request or None if this is the first page.
+        """
+        return self.request.GET.get(self.connections_cursor_param) or None
+
+    def get_paged_user_connections(self):
+        """Gets the connections that are paged. This can either be a queryset
+        or a list of connections already ordered by activity count and id.
+        """
+        return self.get_user_connections(status=self.connections_status)
+
+    def get_user_connections_page(self):
+        """Gets the connections for the current page. The result is memoized
+        on the view.
+
+        :return: tuple of the list of connections on the page and the cursor
+            for the next page.
+        """
+        if self._user_connections_page is not None:
+            return self._user_connections_page
+
+        cursor = self.get_connections_cursor()
+        user_connections = self.get_paged_user_connections()
+        page_size = self.connections_page_size
+
+        if isinstance(user_connections, QuerySet):
+            self._user_connections_page = user_connections.page(
+                after=cursor,
+                page_size=page_size
+            )
+            return self._user_connections_page
+
+        # The connections have already been loaded and are in the same
+        # order so page through them in python.
+        cursor = parse_connection_cursor(cursor)
+        conns = [conn for conn in user_connections
+                 if cursor is None or
+                 (conn.activity_count, conn.id) < cursor][:page_size + 1]
+        next_cursor = None
+
+        if len(conns) > page_size:
+            conns = conns[:page_size]
+            next_cursor = get_connection_cursor(conns[-1])
+
+        self._user_connections_page = (conns, next_cursor)
+        return self._user_connections_page
+
+    def get_connections_next_cursor(self):
+        """Gets the cursor for the next page of connections."""
+        return self.get_user_connections_page()[1]
+
+
+class UserConnectionsByUserViewMixin(UserConnectionsPageViewMixin,
+                                     UserConnectionsViewMixin):
     """View mixin for getting the authenticated user's connections and orders
     them by activity count and returns a tuple of the user connected with along
     with the connection.
+
+    The accepted connections are paged with keyset pagination (see
+    UserConnectionsPageViewMixin).  The page is built from the same
+    user_connections_accepted result the parent mixin puts on the view and is
+    only loaded when it's used.
+
+    * user_connections_by_user: dict of connected user id to the connection
+        for the connections on the current page.
     """
     user_connections_by_user = None
-    connections_page_size = 25
 
     def dispatch(self, *args, **kwargs):
-        self.user_connections_by_user = {
-            conn.get_connected_user(self.request.user).id: conn
-            for conn in self.get_user_connections(status=Status.ACCEPTED)[:100]
-        }
+        self.user_connections_by_user = LazyIterable(
+            self.get_user_connections_by_user)
         return super(UserConnectionsByUserViewMixin, self).dispatch(*args,
                                                                     **kwargs)
 
@@ -183,3 +394,17 @@ class UserConnectionsByUserViewMixin(UserConnectionsViewMixin):
                         self).get_context_data(**kwargs)
         context['user_connections_by_user'] = self.user_connections_by_user
         return context
+
+    def get_paged_user_connections(self):
+        return self.user_connections_accepted
+
+    def get_user_connections_by_user(self):
+        """Gets a dict of the connected user id to the connection for the
+        connections on the current page.
+        """
+        user_id = self.request.user.id
+        return OrderedDict(
+            (conn.with_user_id if conn.created_user_id == user_id
+             else conn.created_user_id, conn)
+            for conn in self.get_user_connections_page()[0]
+        )
@@ -1,26 +1,42 @@
+from collections import defaultdict
+from datetime import datetime
+
 from django.conf import settings
 from django.db import models
-from django.db.models import F
-from django_core.db.models import AbstractTokenModel
+from django.db import router
+from django.db import transaction
+from django.db.models.signals import post_save
 from django_core.db.models.mixins.base import AbstractBaseModel
+from django_core.utils.list_utils import make_obj_list
 
+from . import cache
+from .activity import get_activity_count_buffer
 from .constants import Status
+from .managers import UserConnectionDegreeManager
 from .managers import UserConnectionManager
 
 
-class AbstractUserConnection(AbstractTokenModel, AbstractBaseModel):
+class AbstractUserConnection(AbstractBaseModel):
     """Abstract user connection model.
 
     :field status: status of the connection. Can be one of
         user_connections.constants.Status
-    :field token: token shared between the two users
+    :field token: token shared between the two users. Tokens are generated
+        on save for connections that don't have one.
     :field user_ids: list of user ids who are connected. This assumes that at
         most 2 people are connected.
     :field activity_count: the total number of interactions between two users.
         This field becomes useful when you want to start sorting user
         connections by relevance.  The higher the activity count, the more
         likely these two users are interested in each other.
+    :field low_user: the user of the two connected users with the lower id.
+        Together with high_user this is the canonical, order independent pair
+        of users for the connection.  It's kept in sync on save and is unique
+        so there can only ever be one connection between two users.
+    :field high_user: the user of the two connected users with the higher id.
     """
+    token = models.CharField(max_length=100, db_index=True, unique=True)
+    token_length = 15
     status = models.CharField(max_length=25,
                               default=Status.PENDING,
                               choices=Status.CHOICES)
@@ -28,6 +44,14 @@ class AbstractUserConnection(AbstractTokenModel, AbstractBaseModel):
                                   related_name='connections',
                                   db_index=True)
     activity_count = models.IntegerField(default=1)
+    low_user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                 related_name='+',
+                                 db_index=False,
+                                 editable=False)
+    high_user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                  related_name='+',
+                                  db_index=False,
+                                  editable=False)
     objects = UserConnectionManager()
 
     @property
@@ -42,23 +66,161 @@ class AbstractUserConnection(AbstractTokenModel, AbstractBaseModel):
 
     class Meta:
         abstract = True
-        index_together = (('created_user', 'with_user'),)
+        index_together = (
+            ('created_user', 'with_user'),
+            ('created_user', 'status', 'activity_count', 'id'),
+            ('with_user', 'status', 'activity_count', 'id'),
+            # The unique (low_user, high_user) index covers low_user. This
+            # covers high_user for deleting a user and looking up by it.
+            ('high_user', 'low_user'),
+        )
+        unique_together = (('low_user', 'high_user'),)
         ordering = ('-id',)
 
-    def accept(self):
+    def save(self, *args, **kwargs):
+        """Saves the connection and, when degrees are tracked, updates the
+        connection counts of both users in the same transaction.
+        """
+        if not self.tracks_degrees():
+            return super(AbstractUserConnection, self).save(*args, **kwargs)
+
+        using = (kwargs.get('using') or
+                 router.db_for_write(self.__class__, instance=self))
+        update_fields = kwargs.get('update_fields')
+        adding = self._state.adding
+
+        with transaction.atomic(using=using):
+            old_status = None
+
+            if not adding and (update_fields is None or
+                               'status' in update_fields):
+                old_status = self.__class__.objects.using(using).filter(
+                    id=self.id
+                ).select_for_update().values_list('status', flat=True).first()
+
+            result = super(AbstractUserConnection, self).save(*args, **kwargs)
+
+            if adding:
+                self.update_degrees(added=[self.get_degree_row()],
+                                    using=using)
+            elif old_status is not None and old_status != self.status:
+                self.update_degrees(
+                    added=[self.get_degree_row()],
+                    removed=[self.get_degree_row(status=old_status)],
+                    using=using
+                )
+
+        return result
+
+    @classmethod
+    def save_prep(cls, instance_or_instances):
+        """Sets the token and the canonical user pair before the connection
+        is saved. Available tokens are only queried for connections that don't
+        have a token yet so saving existing connections doesn't query for them.
+        """
+        instances = make_obj_list(instance_or_instances)
+        instances_without_token = [instance for instance in instances
+                                   if not instance.token]
+
+        if instances_without_token:
+            tokens = cls.objects.get_available_tokens(
+                count=len(instances_without_token),
+                token_length=cls.token_length
+            )
+
+            for instance, token in zip(instances_without_token, tokens):
+                instance.token = token
+
+        for instance in instances:
+            instance.low_user_id, instance.high_user_id = sorted(
+                instance.user_ids)
+
+        super(AbstractUserConnection, cls).save_prep(
+            instance_or_instances=instances
+        )
+
+    def accept(self, user=None):
         """Accepts a user connection."""
-        self.status = Status.ACCEPTED
-        self.save()
+        return self.transition(Status.ACCEPTED, user=user)
 
-    def decline(self):
+    def decline(self, user=None):
         """Declines a user connection."""
-        self.status = Status.DECLINED
-        self.save()
+        return self.transition(Status.DECLINED, user=user)
 
-    def inactivate(self):
+    def inactivate(self, user=None):
         """Inactivate a user connection."""
-        self.status = Status.INACTIVE
-        self.save()
+        return self.transition(Status.INACTIVE, user=user)
+
+    def transition(self, status, user=None, from_status=None):
+        """Changes the status of the connection. Only the status and last
+        modified columns are written so concurrent changes to other columns,
+        like the activity count, aren't overwritten.
+
+        :param status: the status to change the connection to.
+        :param user: the user making the change. This will be the last modified
+            user for the connection.
+        :param from_status: a status or list of status' the connection must
+            currently be in for it to be changed.
+        :return: boolean indicating if the connection was changed.
+        """
+        if self.pk is None:
+            # Nothing to update yet so the connection is saved with the new
+            # status instead.
+            if (from_status and
+                    self.status not in make_obj_list(from_status)):
+                return False
+
+            self.status = status
+
+            if user is not None:
+                self.last_modified_user = user
+
+            self.save()
+            return True
+
+        queryset = self.__class__.objects.filter(id=self.id)
+
+        if from_status:
+            queryset = queryset.filter(status__in=make_obj_list(from_status))
+
+        values = {
+            'status': status,
+            'last_modified_dttm': datetime.utcnow()
+        }
+
+        if user is not None:
+            values['last_modified_user'] = user
+
+        if not self.tracks_degrees():
+            updated = queryset.update(**values)
+        else:
+            using = router.db_for_write(self.__class__, instance=self)
+            queryset = queryset.using(using)
+
+            with transaction.atomic(using=using):
+                old_status = queryset.select_for_update().values_list(
+                    'status',
+                    flat=True
+                ).first()
+                updated = old_status is not None and queryset.update(**values)
+
+                if updated and old_status != status:
+                    self.update_degrees(
+                        added=[self.get_degree_row(status=status)],
+                        removed=[self.get_degree_row(status=old_status)],
+                        using=using
+                    )
+
+        if not updated:
+            return False
+
+        for field_name, value in values.items():
+            setattr(self, field_name, value)
+
+        post_save.send(sender=self.__class__, instance=self, created=False,
+                       update_fields=frozenset(values), raw=False,
+                       using=self._state.db)
+        return True
 
     def is_accepted(self):
         """Boolean indicating if the status is accepted."""
@@ -79,38 +241,170 @@ class AbstractUserConnection(AbstractTokenModel, AbstractBaseModel):
     def increment_activity_count(self):
         """Increments total activity count for the connection between two
         users.
+
+        The increment goes through the model's activity count buffer so it
+        may be written to the database later. See
+        user_connections.activity.ActivityCountBuffer. The increment is an
+        UPDATE instead of a save() so only the activity count and the last
+        modified datetime are written and the last modified user isn't
+        changed.
         """
-        self.activity_count = F('activity_count') + 1
-        self.save()
+        if isinstance(self.activity_count, int):
+            self.activity_count += 1
+
+        get_activity_count_buffer(self.__class__).increment(self.id)
         return True
 
     @classmethod
     def increment_activity_count_by_users(cls, user_id_1, user_id_2):
         """Increments total activity count for the connection between two
-        users.
+        users. Like increment_activity_count, this is an UPDATE of the
+        activity count and last modified datetime instead of a save().
 
         :param user_id_1: user id of the first user in a connection
         :param user_id_2: user id of the second user in a connection
+        :return: False if the activity count isn't buffered and no connection
+            exists between the users. Otherwise, True.
+        """
+        return get_activity_count_buffer(cls).increment_by_users(user_id_1,
+                                                                 user_id_2)
 
+    def get_connected_user_id(self, user):
+        """Gets the id of the user who's not the user param passed in. This
+        never queries the database.
+
+        :param user: a user object or user id.
+        :return: the id of the other user or None if the user isn't part of
+            this connection.
         """
-        conn = cls.objects.get_for_users(user_id_1, user_id_2)
+        user_id = getattr(user, 'pk', user)
 
-        if not conn:
-            return False
+        if user_id == self.created_user_id:
+            return self.with_user_id
 
-        conn.increment_activity_count()
-        return True
+        if user_id == self.with_user_id:
+            return self.created_user_id
+
+        return None
 
     def get_connected_user(self, user):
-        """Gets the user who's not the user param passed in.
+        """Gets the user who's not the user param passed in. Only the other
+        user is loaded if it hasn't been already.
 
         :param user: return the user who's not this user.
         """
-        if user not in self.users:
-            return None
+        user_id = getattr(user, 'pk', user)
+
+        if user_id == self.created_user_id:
+            return self.with_user
+
+        if user_id == self.with_user_id:
+            return self.created_user
+
+        return None
+
+    @classmethod
+    def tracks_degrees(cls):
+        """Boolean indicating if the number of connections per user and status
+        are kept in the UserConnectionDegree table. This is set with the
+        USER_CONNECTIONS_TRACK_DEGREES setting. Default is False.
+        """
+        return getattr(settings, 'USER_CONNECTIONS_TRACK_DEGREES', False)
+
+    @classmethod
+    def get_degree_model(cls):
+        """Gets the model the connection counts are kept in."""
+        return UserConnectionDegree
+
+    def get_degree_row(self, status=None):
+        """Gets the (user id, user id, status) tuple used to update the
+        connection counts for this connection.
+        """
+        return self.created_user_id, self.with_user_id, status or self.status
+
+    @classmethod
+    def update_degrees(cls, added=(), removed=(), using=None):
+        """Updates the connection counts of the users. This does nothing
+        unless degrees are tracked.
+
+        :param added: iterable of (user id, user id, status) tuples for the
+            connections added to a status.
+        :param removed: iterable of (user id, user id, status) tuples for the
+            connections removed from a status.
+        :param using: the database alias to write to.
+        """
+        if not cls.tracks_degrees():
+            return
+
+        changes = defaultdict(int)
+
+        for rows, delta in ((added, 1), (removed, -1)):
+            for user_id_1, user_id_2, status in rows:
+                # A connection of a user with themselves only counts once.
+                for user_id in set((user_id_1, user_id_2)):
+                    changes[(user_id, status)] += delta
+
+        cls.get_degree_model().objects.adjust(changes, using=using)
+
+    @classmethod
+    def post_save(cls, sender, instance, **kwargs):
+        """Invalidates the cached connection data for both users and the
+        cached record of the connection.
+        """
+        super(AbstractUserConnection, cls).post_save(sender=sender,
+                                                     instance=instance,
+                                                     **kwargs)
+        using = kwargs.get('using')
+        cache.invalidate_user_ids(*instance.user_ids, using=using)
+        cache.invalidate_connection_records(instance.id, using=using)
 
-        return self.users[1] if self.users[0] == user else self.users[0]
+    @classmethod
+    def post_delete(cls, sender, instance, **kwargs):
+        """Invalidates the cached connection data for both users and the
+        cached record and token of the connection and updates the users'
+        connection counts. Deletes send post_delete inside the delete
+        transaction.
+        """
+        super(AbstractUserConnection, cls).post_delete(sender=sender,
+                                                       instance=instance,
+                                                       **kwargs)
+        using = kwargs.get('using')
+        cache.invalidate_connection_records(instance.id, using=using)
+        cache.invalidate_connection_tokens(instance.token, using=using)
+        cls.update_degrees(removed=[instance.get_degree_row()], using=using)
+        cache.invalidate_user_ids(*instance.user_ids, using=using)
 
 
 class UserConnection(AbstractUserConnection):
     """Concrete class for user connections."""
+
+
+class UserConnectionDegree(models.Model):
+    """Denormalized number of connections a user has per status. This is only
+    kept up to date when the USER_CONNECTIONS_TRACK_DEGREES setting is True.
+
+    :field user: the user the connections are for.
+    :field status: the status of the connections.
+    :field count: the number of connections the user has with the status.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    status = models.CharField(max_length=25, choices=Status.CHOICES)
+    count = models.IntegerField(default=0)
+    objects = UserConnectionDegreeManager()
+
+    class Meta:
+        unique_together = (('user', 'status'),)
+
+
+def user_connection_post_save(sender, **kwargs):
+    """Calls the post_save hook of the user connection model. Connected in
+    UserConnectionsConfig.ready.
+    """
+    sender.post_save(sender=sender, **kwargs)
+
+
+def user_connection_post_delete(sender, **kwargs):
+    """Calls the post_delete hook of the user connection model. Connected in
+    UserConnectionsConfig.ready.
+    """
+    sender.post_delete(sender=sender, **kwargs)
@@ -1,5 +1,7 @@
 from django import template
 
+from user_connections import get_user_connection_model
+
 
 register = template.Library()
 
@@ -11,3 +13,19 @@ def get_connected_user(user_connection, auth_user):
         return None
 
     return user_connection.get_connected_user(auth_user)
+
+
+@register.filter
+def with_connected_users(user_connections, auth_user):
+    """Gets a list of (user connection, connected user) tuples for the user
+    connections. All connected users are loaded with at most one query instead
+    of one query per connection.
+    """
+    if not user_connections:
+        return []
+
+    user_connections = list(user_connections)
+    UserConnection = get_user_connection_model()
+    connected_users = UserConnection.objects.connected_users_for(
+        auth_user, user_connections)
+    return [(conn, connected_users[conn.id]) for conn in user_connections]
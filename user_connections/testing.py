@@ -0,0 +1,258 @@
+"""Test utilities for pinning the number of queries the user connection hot
+paths run.
+
+Example::
+
+    from user_connections.testing import QueryBudget
+
+    class MyTestCase(TestCase):
+
+        @QueryBudget({'UserConnectionManager.get_for_users': 1,
+                      'UserConnectionsViewMixin.dispatch': 1}, exact=True)
+        def test_my_view(self):
+            ...
+
+        def test_my_form(self):
+            with QueryBudget({'UserConnectionChoices.choices': 1}) as budget:
+                ...
+
+            self.assertEqual(
+                budget.get_counts()['UserConnectionChoices.choices'], [1])
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from collections import OrderedDict
+from functools import wraps
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.utils.functional import cached_property
+
+from . import get_user_connection_model
+
+
+#: A call to a tracked method and the sql it ran, including the sql of any
+#: tracked methods it called.
+QueryRecord = namedtuple('QueryRecord', ['name', 'sql'])
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a tracked method runs more queries than its budget, or a
+    different number of queries for exact budgets.
+    """
+
+
+class _QueryLog(object):
+    """Stands in for a connection's ``queries_log`` while a budget is active.
+
+    Queries are still added to the connection's log but are also added to
+    the sql lists of the tracked calls that are running. Django's log is a
+    bounded deque so counting its length before and after a call stops
+    working once it's full.
+    """
+
+    def __init__(self, queries_log):
+        self.queries_log = queries_log
+        self.running_calls = []
+
+    def append(self, query):
+        self.queries_log.append(query)
+
+        for sql in self.running_calls:
+            sql.append(query['sql'])
+
+    def __len__(self):
+        return len(self.queries_log)
+
+    def __iter__(self):
+        return iter(self.queries_log)
+
+    def __getattr__(self, name):
+        return getattr(self.queries_log, name)
+
+
+def get_tracked_methods():
+    """Gets the list of (class, attribute name) of the hot paths that are
+    tracked by default. Properties and cached properties are tracked by their
+    getter.
+    """
+    from .forms.fields import BaseUserConnectionChoiceField
+    from .forms.fields import BaseUserConnectionFieldMixin
+    from .forms.fields import UserConnectionChoices
+    from .managers import UserConnectionManager
+    from .managers import UserConnectionQuerySet
+    from .mixins.views import UserConnectionViewMixin
+    from .mixins.views import UserConnectionsByUserViewMixin
+    from .mixins.views import UserConnectionsPageViewMixin
+    from .mixins.views import UserConnectionsViewMixin
+
+    return [
+        (UserConnectionManager, name) for name in (
+            'get_for_users', 'get_record', 'get_for_user_and_username',
+            'get_by_user', 'get_by_user_id', 'get_page_by_user',
+            'search_by_user', 'get_user_ids', 'get_connection_count',
+            'connected_users_for', 'mutual_connection_ids', 'mutual_counts',
+            'second_degree_suggestions', 'create', 'get_or_create',
+            'bulk_create_connections', 'bulk_transition',
+        )
+    ] + [
+        (UserConnectionQuerySet, 'page'),
+        (get_user_connection_model(), 'get_connected_user'),
+        (get_user_connection_model(), 'transition'),
+        (UserConnectionViewMixin, 'dispatch'),
+        (UserConnectionViewMixin, 'get_context_data'),
+        (UserConnectionsViewMixin, 'dispatch'),
+        (UserConnectionsViewMixin, 'get_context_data'),
+        (UserConnectionsPageViewMixin, 'get_user_connections_page'),
+        (UserConnectionsByUserViewMixin, 'dispatch'),
+        (UserConnectionsByUserViewMixin, 'get_context_data'),
+        (UserConnectionsByUserViewMixin, 'get_user_connections_by_user'),
+        (BaseUserConnectionFieldMixin, '__init__'),
+        (BaseUserConnectionFieldMixin, 'validate'),
+        (BaseUserConnectionChoiceField, '__init__'),
+        (UserConnectionChoices, 'connections'),
+        (UserConnectionChoices, 'choices'),
+    ]
+
+
+class QueryBudget(object):
+    """Context manager and decorator that records the sql run by each call to
+    the tracked methods and fails when a call runs more queries than the
+    budget for that method.
+
+    Methods are named ``ClassName.method_name`` using the class the method is
+    defined on, for example ``AbstractUserConnection.get_connected_user``.
+    Querysets are lazy so methods that return a queryset don't run any
+    queries and the queries run when the result is evaluated count towards
+    the tracked method that evaluates it, if any.
+
+    Tracking patches the classes so it isn't thread safe.
+
+    :param budgets: dict of method name to the max number of queries a single
+        call to the method may run.
+    :param using: the database alias to record queries for.
+    :param methods: list of (class, attribute name) to track. Defaults to
+        get_tracked_methods().
+    :param exact: boolean indicating if every call to a method with a budget
+        must run exactly that number of queries. Use this to pin query counts
+        so improvements have to update the budget too. Default is False.
+    """
+
+    def __init__(self, budgets=None, using=DEFAULT_DB_ALIAS, methods=None,
+                 exact=False):
+        self.budgets = budgets or {}
+        self.using = using
+        self.methods = methods
+        self.exact = exact
+        self.calls = []
+        self._originals = []
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self.__class__(budgets=self.budgets, using=self.using,
+                                methods=self.methods, exact=self.exact):
+                return func(*args, **kwargs)
+
+        return inner
+
+    def __enter__(self):
+        self.calls = []
+        connection = connections[self.using]
+        self._force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        self._queries_log = _QueryLog(connection.queries_log)
+        connection.queries_log = self._queries_log
+        methods = self.methods
+        names = set()
+
+        if methods is None:
+            methods = get_tracked_methods()
+
+        for cls, attr_name in methods:
+            # Patch the class the attribute is defined on so calls from
+            # subclasses are tracked too.
+            cls = next(klass for klass in cls.__mro__
+                       if attr_name in klass.__dict__)
+            name = '{0}.{1}'.format(cls.__name__, attr_name)
+
+            if name in names:
+                continue
+
+            names.add(name)
+            attr = cls.__dict__[attr_name]
+
+            if isinstance(attr, cached_property):
+                patched = cached_property(self._wrap(name, attr.func),
+                                          name=attr_name)
+            elif isinstance(attr, property):
+                patched = property(self._wrap(name, attr.fget), attr.fset,
+                                   attr.fdel, attr.__doc__)
+            else:
+                patched = self._wrap(name, attr)
+
+            self._originals.append((cls, attr_name, attr))
+            setattr(cls, attr_name, patched)
+
+        unknown_names = set(self.budgets).difference(names)
+
+        if unknown_names:
+            self._restore()
+            raise ValueError('Budgets for methods that are not tracked: '
+                             '{0}'.format(', '.join(sorted(unknown_names))))
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._restore()
+
+    def _restore(self):
+        while self._originals:
+            cls, attr_name, attr = self._originals.pop()
+            setattr(cls, attr_name, attr)
+
+        connection = connections[self.using]
+        connection.force_debug_cursor = self._force_debug_cursor
+        connection.queries_log = self._queries_log.queries_log
+
+    def _wrap(self, name, func):
+        budget = self.budgets.get(name)
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            running_calls = self._queries_log.running_calls
+            sql = []
+            running_calls.append(sql)
+
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                # Tracked calls nest so the last running call is this one.
+                running_calls.pop()
+
+            self.calls.append(QueryRecord(name=name, sql=sql))
+
+            if budget is not None and (len(sql) > budget or
+                                       (self.exact and len(sql) != budget)):
+                raise QueryBudgetExceeded(
+                    '{0} ran {1} queries, the budget is {2}{3}:\n{4}'.format(
+                        name, len(sql), budget,
+                        ' exactly' if self.exact else '',
+                        '\n'.join('{0}. {1}'.format(i, query_sql)
+                                  for i, query_sql in enumerate(sql, 1))))
+
+            return result
+
+        return inner
+
+    def get_counts(self):
+        """Gets an ordered dict of method name to the list of query counts of
+        each call, in the order the methods were first called.
+        """
+        counts = OrderedDict()
+
+        for record in self.calls:
+            counts.setdefault(record.name, []).append(len(record.sql))
+
+        return counts
@@ -0,0 +1,76 @@
+from __future__ import unicode_literals
+
+from django.core.exceptions import PermissionDenied
+from django.http.response import JsonResponse
+from django.views.generic.base import View
+
+from . import get_user_connection_model
+from .constants import Status
+
+
+class UserConnectionSearchView(View):
+    """JSON endpoint for searching the authenticated user's connections by a
+    prefix of the connected user's name. This is the endpoint the
+    UserConnectionSearchChoiceField and
+    UserConnectionsSearchMultipleChoiceField widgets search with.
+
+    GET params:
+
+    * q: the prefix to search for.
+    * cursor: the cursor from the previous page's response.
+
+    Response:
+
+        {
+            "results": [{"id": CONNECTION_TOKEN,
+                         "text": USERS_FULL_NAME,
+                         "user_id": USER_ID}],
+            "next_cursor": CURSOR or null
+        }
+
+    * limit: the max number of results per page.
+    * status: the status of the connections to search.
+    * min_term_length: the min length of the search term.
+    """
+    limit = 20
+    status = Status.ACCEPTED
+    min_term_length = 1
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            raise PermissionDenied
+
+        term = request.GET.get('q', '').strip()
+        cursor = request.GET.get('cursor')
+
+        if len(term) < self.min_term_length:
+            return JsonResponse({'results': [], 'next_cursor': None})
+
+        after = int(cursor) if cursor and cursor.isdigit() else None
+        UserConnection = get_user_connection_model()
+        conns = list(
+            UserConnection.objects.search_by_user(user=request.user,
+                                                  term=term,
+                                                  after=after,
+                                                  status=self.status)
+                                  .with_users()[:self.limit + 1]
+        )
+        next_cursor = None
+
+        if len(conns) > self.limit:
+            conns = conns[:self.limit]
+            next_cursor = str(conns[-1].id)
+
+        results = []
+        connected_users = UserConnection.objects.connected_users_for(
+            request.user, conns)
+
+        for conn in conns:
+            conn_user = connected_users[conn.id]
+            results.append({
+                'id': conn.token,
+                'text': conn_user.get_full_name(),
+                'user_id': conn_user.id
+            })
+
+        return JsonResponse({'results': results, 'next_cursor': next_cursor})